@@ -0,0 +1,59 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batching of fine-tuning inputs padded to a few lengths."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def batch_by_length(d, batch_size, length_buckets, max_seq_length,
+                    sequence_features, is_training, drop_remainder):
+  """Batches decoded examples padded only to one of `length_buckets`.
+
+  The `sequence_features` of each batch are cut to the smallest bucket which
+  holds all of its sequences, as counted by `input_mask`, or are kept at
+  `max_seq_length` if none does. For training, the examples are first grouped
+  by bucket, so batches mix examples of similar length. Otherwise the
+  examples keep their order.
+  """
+  buckets = tf.constant(
+      sorted(list(length_buckets) + [max_seq_length]), dtype=tf.int32)
+
+  def bucket_index(example):
+    length = tf.reduce_sum(input_tensor=example["input_mask"])
+    return tf.reduce_sum(input_tensor=tf.cast(buckets < length, tf.int64))
+
+  def cut_to_bucket(batch):
+    length = tf.reduce_max(
+        input_tensor=tf.reduce_sum(input_tensor=batch["input_mask"], axis=1))
+    bucket_length = buckets[tf.reduce_sum(
+        input_tensor=tf.cast(buckets < length, tf.int32))]
+    for name in sequence_features:
+      batch[name] = batch[name][:, :bucket_length]
+    return batch
+
+  if is_training:
+    d = d.apply(
+        tf.data.experimental.group_by_window(
+            key_func=bucket_index,
+            reduce_func=lambda _, window: window.batch(
+                batch_size, drop_remainder=drop_remainder),
+            window_size=batch_size))
+  else:
+    d = d.batch(batch_size, drop_remainder=drop_remainder)
+  return d.map(cut_to_bucket)
@@ -0,0 +1,92 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bucketing
+import numpy as np
+import tensorflow as tf
+
+
+def _create_dataset(lengths, seq_length):
+  """Examples whose `input_ids` count from 1 up to their length."""
+  input_ids = np.zeros([len(lengths), seq_length], dtype=np.int32)
+  for (i, length) in enumerate(lengths):
+    input_ids[i, :length] = np.arange(1, length + 1)
+  return tf.data.Dataset.from_tensor_slices({
+      "input_ids": input_ids,
+      "input_mask": (input_ids > 0).astype(np.int32),
+      "label_ids": np.arange(len(lengths), dtype=np.int32),
+  })
+
+
+class BucketingTest(tf.test.TestCase):
+
+  def _run(self, lengths, batch_size, length_buckets, is_training,
+           drop_remainder=False):
+    """Returns the batches of `batch_by_length`."""
+    with tf.Graph().as_default(), self.session() as sess:
+      d = bucketing.batch_by_length(
+          _create_dataset(lengths, 16), batch_size, length_buckets, 16,
+          ["input_ids", "input_mask"], is_training, drop_remainder)
+      next_batch = tf.compat.v1.data.make_one_shot_iterator(d).get_next()
+      batches = []
+      while True:
+        try:
+          batches.append(sess.run(next_batch))
+        except tf.errors.OutOfRangeError:
+          return batches
+
+  def test_batch_by_length(self):
+    lengths = [3, 2, 7, 4, 1, 12, 16, 5]
+    batches = self._run(lengths, 2, [4, 8], is_training=False)
+
+    # Without grouping, the examples keep their order, and each batch is cut
+    # to the smallest bucket which holds its longest sequence. Batches with
+    # sequences longer than every bucket keep all 16 tokens.
+    self.assertEqual([batch["input_ids"].shape[1] for batch in batches],
+                     [4, 8, 16, 16])
+    self.assertAllEqual(
+        np.concatenate([batch["label_ids"] for batch in batches]),
+        np.arange(len(lengths)))
+    for batch in batches:
+      self.assertAllEqual(batch["input_mask"].shape, batch["input_ids"].shape)
+      for (ids, label) in zip(batch["input_ids"], batch["label_ids"]):
+        self.assertAllEqual(
+            ids, np.pad(np.arange(1, lengths[label] + 1),
+                        [0, len(ids) - lengths[label]]))
+
+  def test_batch_by_length_training(self):
+    rng = np.random.RandomState(1)
+    lengths = list(rng.randint(1, 17, [200]))
+    batches = self._run(lengths, 4, [4, 8], is_training=True,
+                        drop_remainder=True)
+
+    # Every batch only has examples of one bucket.
+    self.assertNotEmpty(batches)
+    for batch in batches:
+      self.assertAllEqual(batch["label_ids"].shape, [4])
+      bucket_length = batch["input_ids"].shape[1]
+      smaller_bucket = {4: 0, 8: 4, 16: 8}[bucket_length]
+      for label in batch["label_ids"]:
+        self.assertGreater(lengths[label], smaller_bucket)
+        self.assertLessEqual(lengths[label], bucket_length)
+    self.assertCountEqual(
+        set(batch["input_ids"].shape[1] for batch in batches), [4, 8, 16])
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,51 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Converts a `vocab.txt` file into the memory-mapped compiled vocab format.
+
+The output can be passed as `--vocab_file` anywhere a text vocab is accepted.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tokenization
+import tensorflow as tf
+
+flags = tf.compat.v1.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("vocab_file", None,
+                    "The text vocabulary file, one token per line.")
+
+flags.DEFINE_string("output_file", None,
+                    "Where to write the compiled vocabulary.")
+
+
+def main(_):
+  tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+
+  tokenization.write_compiled_vocab(FLAGS.vocab_file, FLAGS.output_file)
+
+  vocab = tokenization.load_vocab(FLAGS.output_file)
+  tf.compat.v1.logging.info("Wrote %d tokens to %s", len(vocab),
+                            FLAGS.output_file)
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("output_file")
+  tf.compat.v1.app.run()
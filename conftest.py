@@ -0,0 +1,30 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""pytest setup for running the tests of several scripts in one process."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def pytest_collectstart(collector):
+  # Every script defines its own flags, and several scripts have flags with
+  # the same name, e.g. `vocab_file`. Let the script imported by the next
+  # test module redefine the flags of the scripts imported so far.
+  del collector
+  for name in list(tf.compat.v1.flags.FLAGS):
+    tf.compat.v1.flags.FLAGS[name].allow_override = True
@@ -18,8 +18,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import hashlib
+import mmap
+import multiprocessing
+import os
 import random
+import shutil
+import sys
+import tempfile
+import numpy as np
 import tokenization
 import tensorflow as tf
 
@@ -59,11 +68,73 @@ flags.DEFINE_integer(
 
 flags.DEFINE_float("masked_lm_prob", 0.15, "Masked LM probability.")
 
+flags.DEFINE_bool(
+    "vectorized_masking", False,
+    "Whether to choose the masked LM predictions for batches of instances "
+    "with NumPy rather than one instance at a time. The masks follow the same "
+    "distribution but are drawn from a different random stream.")
+
+flags.DEFINE_bool(
+    "compact_records", False,
+    "Whether to write compact records, with unpadded ids packed into bytes, "
+    "for run_pretraining.py --compact_records.")
+
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Whether to write the instances without masked LM predictions, for "
+    "run_pretraining.py --dynamic_masking to mask while training. Every "
+    "epoch then sees new masks, so --dupe_factor=1 is usually enough.")
+
+flags.DEFINE_integer(
+    "max_sequences_per_row", 1,
+    "Maximum number of instances packed into each example, for "
+    "run_pretraining.py with the same --max_sequences_per_row. Short "
+    "instances then share a row instead of being padded to "
+    "--max_seq_length, which mostly pays off with a high --short_seq_prob.")
+
 flags.DEFINE_float(
     "short_seq_prob", 0.1,
     "Probability of creating sequences which are shorter than the "
     "maximum length.")
 
+flags.DEFINE_integer(
+    "num_tokenize_workers", 1,
+    "Number of processes used to tokenize the input text.")
+
+flags.DEFINE_integer(
+    "wordpiece_cache_size", 50000,
+    "Number of words whose WordPieces are cached by each tokenizer process. "
+    "Set to 0 to disable the cache.")
+
+flags.DEFINE_bool(
+    "streaming", False,
+    "Whether to generate the instances without holding the corpus in memory. "
+    "The tokenized corpus is kept in an on-disk token store, each output file "
+    "is generated as a separate shard and instances are shuffled with a "
+    "bounded buffer.")
+
+flags.DEFINE_string(
+    "token_store_dir", None,
+    "Local directory for the token store used by --streaming. Defaults to a "
+    "temporary directory which is removed afterwards.")
+
+flags.DEFINE_string(
+    "token_cache_dir", None,
+    "Local directory in which tokenized corpora are cached. A corpus is "
+    "stored under a hash of the input files, the vocab file and "
+    "--do_lower_case, and later runs with the same inputs skip tokenization.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 100000,
+    "Number of instances held in memory to shuffle each output shard with "
+    "--streaming. Must be at least 1.")
+
+flags.DEFINE_integer(
+    "num_workers", 1,
+    "Number of processes generating output shards in parallel. Implies "
+    "--streaming when greater than 1. If a single output file is given, it is "
+    "split into `num_workers` shards named <output_file>-00000-of-0000N.")
+
 
 class TrainingInstance(object):
   """A single training instance (sentence pair)."""
@@ -94,49 +165,46 @@ class TrainingInstance(object):
 
 
 def write_instance_to_example_files(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_files):
-  """Create TF example files from `TrainingInstance`s."""
+                                    max_predictions_per_seq, output_files,
+                                    write_masked_lm=True, compact=False,
+                                    max_sequences_per_row=1):
+  """Create TF example files from `TrainingInstance`s.
+
+  With `write_masked_lm=False` the masked LM features are left out, for
+  unmasked instances. With `compact=True` the examples are written by
+  `create_compact_features` rather than padded to fixed lengths. With
+  `max_sequences_per_row > 1` the instances are packed into rows by
+  `pack_instances` and written by `create_packed_features`.
+  """
+  if compact and max_sequences_per_row > 1:
+    raise ValueError("Compact records cannot hold packed sequences.")
+
   writers = []
   for output_file in output_files:
     writers.append(tf.io.TFRecordWriter(output_file))
 
   writer_index = 0
+  # Duplicate lines of the vocab file leave ids unused, so the number of
+  # tokens can be less than the number of ids.
+  id_dtype = compact_id_dtype(max(tokenizer.vocab.values()) + 1)
+  if max_sequences_per_row > 1:
+    instances = pack_instances(instances, max_seq_length,
+                               max_predictions_per_seq, max_sequences_per_row)
 
   total_written = 0
   for (inst_index, instance) in enumerate(instances):
-    input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-    input_mask = [1] * len(input_ids)
-    segment_ids = list(instance.segment_ids)
-    assert len(input_ids) <= max_seq_length
-
-    while len(input_ids) < max_seq_length:
-      input_ids.append(0)
-      input_mask.append(0)
-      segment_ids.append(0)
-
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-
-    masked_lm_positions = list(instance.masked_lm_positions)
-    masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-    masked_lm_weights = [1.0] * len(masked_lm_ids)
-
-    while len(masked_lm_positions) < max_predictions_per_seq:
-      masked_lm_positions.append(0)
-      masked_lm_ids.append(0)
-      masked_lm_weights.append(0.0)
-
-    next_sentence_label = 1 if instance.is_random_next else 0
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(input_ids)
-    features["input_mask"] = create_int_feature(input_mask)
-    features["segment_ids"] = create_int_feature(segment_ids)
-    features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
-    features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
-    features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
-    features["next_sentence_labels"] = create_int_feature([next_sentence_label])
+    if compact:
+      features = create_compact_features(instance, tokenizer, max_seq_length,
+                                         id_dtype, write_masked_lm)
+    elif max_sequences_per_row > 1:
+      features = create_packed_features(instance, tokenizer, max_seq_length,
+                                        max_predictions_per_seq,
+                                        max_sequences_per_row,
+                                        write_masked_lm)
+    else:
+      features = create_padded_features(instance, tokenizer, max_seq_length,
+                                        max_predictions_per_seq,
+                                        write_masked_lm)
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
 
@@ -147,8 +215,10 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
 
     if inst_index < 20:
       tf.compat.v1.logging.info("*** Example ***")
+      tokens = (instance.tokens if max_sequences_per_row <= 1 else
+                [x for packed in instance for x in packed.tokens])
       tf.compat.v1.logging.info("tokens: %s" % " ".join(
-          [tokenization.printable_text(x) for x in instance.tokens]))
+          [tokenization.printable_text(x) for x in tokens]))
 
       for feature_name in features.keys():
         feature = features[feature_name]
@@ -157,6 +227,11 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
           values = feature.int64_list.value
         elif feature.float_list.value:
           values = feature.float_list.value
+        elif feature.bytes_list.value:
+          values = np.frombuffer(
+              feature.bytes_list.value[0],
+              dtype=(_COMPACT_POSITION_DTYPE if feature_name ==
+                     "masked_lm_positions" else id_dtype))
         tf.compat.v1.logging.info(
             "%s: %s" % (feature_name, " ".join([str(x) for x in values])))
 
@@ -166,6 +241,193 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
   tf.compat.v1.logging.info("Wrote %d total instances", total_written)
 
 
+def create_padded_features(instance, tokenizer, max_seq_length,
+                           max_predictions_per_seq, write_masked_lm=True):
+  """Creates the features of an instance, padded to fixed lengths."""
+  input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
+  input_mask = [1] * len(input_ids)
+  segment_ids = list(instance.segment_ids)
+  assert len(input_ids) <= max_seq_length
+
+  while len(input_ids) < max_seq_length:
+    input_ids.append(0)
+    input_mask.append(0)
+    segment_ids.append(0)
+
+  assert len(input_ids) == max_seq_length
+  assert len(input_mask) == max_seq_length
+  assert len(segment_ids) == max_seq_length
+
+  masked_lm_positions = list(instance.masked_lm_positions)
+  masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
+  masked_lm_weights = [1.0] * len(masked_lm_ids)
+
+  while len(masked_lm_positions) < max_predictions_per_seq:
+    masked_lm_positions.append(0)
+    masked_lm_ids.append(0)
+    masked_lm_weights.append(0.0)
+
+  next_sentence_label = 1 if instance.is_random_next else 0
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(input_ids)
+  features["input_mask"] = create_int_feature(input_mask)
+  features["segment_ids"] = create_int_feature(segment_ids)
+  if write_masked_lm:
+    features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
+    features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
+    features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
+  features["next_sentence_labels"] = create_int_feature([next_sentence_label])
+  return features
+
+
+def create_packed_features(row, tokenizer, max_seq_length,
+                           max_predictions_per_seq, max_sequences_per_row,
+                           write_masked_lm=True):
+  """Creates the features of a row of packed instances.
+
+  `input_mask` numbers the instances of the row from 1 (with 0 for padding)
+  and `position_ids` restart at every instance. `masked_lm_positions` are
+  offsets into the row, and `next_sentence_positions` are the offsets of the
+  [CLS] token of every instance, with one label and weight each.
+  """
+  input_ids = []
+  input_mask = []
+  segment_ids = []
+  position_ids = []
+  masked_lm_positions = []
+  masked_lm_labels = []
+  next_sentence_positions = []
+  next_sentence_labels = []
+  for (sequence_index, instance) in enumerate(row):
+    offset = len(input_ids)
+    length = len(instance.tokens)
+    input_ids.extend(tokenizer.convert_tokens_to_ids(instance.tokens))
+    input_mask.extend([sequence_index + 1] * length)
+    segment_ids.extend(instance.segment_ids)
+    position_ids.extend(range(length))
+    masked_lm_positions.extend(offset + x for x in instance.masked_lm_positions)
+    masked_lm_labels.extend(instance.masked_lm_labels)
+    next_sentence_positions.append(offset)
+    next_sentence_labels.append(1 if instance.is_random_next else 0)
+  assert len(input_ids) <= max_seq_length
+  assert len(masked_lm_positions) <= max_predictions_per_seq
+  assert len(row) <= max_sequences_per_row
+
+  num_padding = max_seq_length - len(input_ids)
+  input_ids.extend([0] * num_padding)
+  input_mask.extend([0] * num_padding)
+  segment_ids.extend([0] * num_padding)
+  position_ids.extend([0] * num_padding)
+
+  masked_lm_ids = tokenizer.convert_tokens_to_ids(masked_lm_labels)
+  masked_lm_weights = [1.0] * len(masked_lm_ids)
+  num_padding = max_predictions_per_seq - len(masked_lm_ids)
+  masked_lm_positions.extend([0] * num_padding)
+  masked_lm_ids.extend([0] * num_padding)
+  masked_lm_weights.extend([0.0] * num_padding)
+
+  next_sentence_weights = [1.0] * len(row)
+  num_padding = max_sequences_per_row - len(row)
+  next_sentence_positions.extend([0] * num_padding)
+  next_sentence_labels.extend([0] * num_padding)
+  next_sentence_weights.extend([0.0] * num_padding)
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(input_ids)
+  features["input_mask"] = create_int_feature(input_mask)
+  features["segment_ids"] = create_int_feature(segment_ids)
+  features["position_ids"] = create_int_feature(position_ids)
+  if write_masked_lm:
+    features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
+    features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
+    features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
+  features["next_sentence_positions"] = create_int_feature(
+      next_sentence_positions)
+  features["next_sentence_labels"] = create_int_feature(next_sentence_labels)
+  features["next_sentence_weights"] = create_float_feature(
+      next_sentence_weights)
+  return features
+
+
+def pack_instances(instances, max_seq_length, max_predictions_per_seq,
+                   max_sequences_per_row, max_open_rows=64):
+  """Packs `TrainingInstance`s into rows of at most `max_seq_length` tokens.
+
+  Every instance goes into the first open row with room for its tokens, its
+  masked LM predictions and one more sequence, so at most `max_open_rows`
+  rows are held at a time. Yields the rows as lists of instances.
+  """
+  # Each open row is [instances, num_tokens, num_predictions].
+  open_rows = []
+  for instance in instances:
+    for row in open_rows:
+      if (len(row[0]) < max_sequences_per_row and
+          row[1] + len(instance.tokens) <= max_seq_length and
+          row[2] + len(instance.masked_lm_positions) <=
+          max_predictions_per_seq):
+        break
+    else:
+      row = [[], 0, 0]
+      open_rows.append(row)
+      if len(open_rows) > max_open_rows:
+        yield open_rows.pop(0)[0]
+    row[0].append(instance)
+    row[1] += len(instance.tokens)
+    row[2] += len(instance.masked_lm_positions)
+    if len(row[0]) == max_sequences_per_row or row[1] == max_seq_length:
+      open_rows.remove(row)
+      yield row[0]
+  for row in open_rows:
+    yield row[0]
+
+
+def create_compact_features(instance, tokenizer, max_seq_length, id_dtype,
+                            write_masked_lm=True):
+  """Creates the features of an instance in the compact record format.
+
+  The ids and masked LM fields are stored unpadded, as little-endian packed
+  bytes: ids as `id_dtype` (see `compact_id_dtype`), whose size is stored in
+  `id_bytes`, and positions as uint16. `input_mask`, `segment_ids` and
+  `masked_lm_weights` are not stored: they follow from the lengths and from
+  `segment_a_length`, the number of leading tokens in segment 0 ([CLS], A and
+  the first [SEP]). The records are read by run_pretraining.py with
+  --compact_records.
+  """
+  input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
+  assert len(input_ids) <= max_seq_length
+  segment_a_length = list(instance.segment_ids).index(1)
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_bytes_feature(input_ids, id_dtype)
+  features["id_bytes"] = create_int_feature([id_dtype.itemsize])
+  features["segment_a_length"] = create_int_feature([segment_a_length])
+  if write_masked_lm:
+    features["masked_lm_positions"] = create_bytes_feature(
+        instance.masked_lm_positions, _COMPACT_POSITION_DTYPE)
+    features["masked_lm_ids"] = create_bytes_feature(
+        tokenizer.convert_tokens_to_ids(instance.masked_lm_labels), id_dtype)
+  features["next_sentence_labels"] = create_int_feature(
+      [1 if instance.is_random_next else 0])
+  return features
+
+
+_COMPACT_POSITION_DTYPE = np.dtype("<u2")
+
+
+def compact_id_dtype(vocab_size):
+  """Returns the packed type of ids in compact records for ids < vocab_size."""
+  if vocab_size <= 1 << 16:
+    return np.dtype("<u2")
+  return np.dtype("<i4")
+
+
+def create_bytes_feature(values, dtype):
+  value = np.asarray(values, dtype=dtype).tobytes()
+  feature = tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+  return feature
+
+
 def create_int_feature(values):
   feature = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
   return feature
@@ -178,7 +440,10 @@ def create_float_feature(values):
 
 def create_training_instances(input_files, tokenizer, max_seq_length,
                               dupe_factor, short_seq_prob, masked_lm_prob,
-                              max_predictions_per_seq, rng):
+                              max_predictions_per_seq, rng,
+                              num_tokenize_workers=1,
+                              vectorized_masking=False,
+                              dynamic_masking=False):
   """Create `TrainingInstance`s from raw text."""
   all_documents = [[]]
 
@@ -188,23 +453,33 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
   # sentence boundaries for the "next sentence prediction" task).
   # (2) Blank lines between documents. Document boundaries are needed so
   # that the "next sentence prediction" task doesn't span between documents.
-  for input_file in input_files:
-    with tf.io.gfile.GFile(input_file, "r") as reader:
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-
-        # Empty lines are used as document delimiters
-        if not line:
-          all_documents.append([])
-        tokens = tokenizer.tokenize(line)
-        if tokens:
-          all_documents[-1].append(tokens)
+  for lines in read_line_batches(input_files):
+    for (line, tokens) in zip(
+        lines, tokenizer.tokenize_batch(lines, num_tokenize_workers)):
+      # Empty lines are used as document delimiters
+      if not line:
+        all_documents.append([])
+      if tokens:
+        all_documents[-1].append(tokens)
 
   # Remove empty documents
   all_documents = [x for x in all_documents if x]
+  return create_instances_from_documents(
+      all_documents, tokenizer, max_seq_length, dupe_factor, short_seq_prob,
+      masked_lm_prob, max_predictions_per_seq, rng, vectorized_masking,
+      dynamic_masking)
+
+
+def create_instances_from_documents(all_documents, tokenizer, max_seq_length,
+                                    dupe_factor, short_seq_prob,
+                                    masked_lm_prob, max_predictions_per_seq,
+                                    rng, vectorized_masking=False,
+                                    dynamic_masking=False):
+  """Create `TrainingInstance`s from tokenized documents.
+
+  With `dynamic_masking` the instances are left without masked LM
+  predictions.
+  """
   rng.shuffle(all_documents)
 
   vocab_words = list(tokenizer.vocab.keys())
@@ -214,16 +489,371 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
       instances.extend(
           create_instances_from_document(
               all_documents, document_index, max_seq_length, short_seq_prob,
-              masked_lm_prob, max_predictions_per_seq, vocab_words, rng))
-
+              masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+              mask_tokens=not (vectorized_masking or dynamic_masking)))
+
+  if vectorized_masking and not dynamic_masking:
+    instances = list(
+        mask_instances(instances, tokenizer, max_seq_length, masked_lm_prob,
+                       max_predictions_per_seq,
+                       np.random.default_rng(rng.getrandbits(64))))
   rng.shuffle(instances)
   return instances
 
 
+def cached_token_store(cache_dir, input_files, tokenizer, vocab_file,
+                       do_lower_case, num_tokenize_workers=1):
+  """Returns the directory of the cached token store of `input_files`.
+
+  The store is looked up by `token_store_key`. If it isn't in `cache_dir` yet,
+  the input is tokenized into a temporary directory which is then renamed
+  into place, so an interrupted run never leaves a partial store behind.
+  """
+  store_dir = os.path.join(
+      cache_dir, token_store_key(input_files, vocab_file, do_lower_case))
+  if os.path.isdir(store_dir):
+    tf.compat.v1.logging.info("Reusing tokenized corpus in %s", store_dir)
+    return store_dir
+
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+  try:
+    build_token_store(input_files, tokenizer, tmp_dir, num_tokenize_workers)
+    os.rename(tmp_dir, store_dir)
+  except OSError:
+    # Another run may have cached the same corpus in the meantime.
+    if not os.path.isdir(store_dir):
+      raise
+  finally:
+    if os.path.isdir(tmp_dir):
+      shutil.rmtree(tmp_dir)
+  tf.compat.v1.logging.info("Cached tokenized corpus in %s", store_dir)
+  return store_dir
+
+
+def token_store_key(input_files, vocab_file, do_lower_case):
+  """Returns a hash of everything the tokenized corpus depends on."""
+  sha = hashlib.sha256()
+  sha.update(("token_store:%d:%s\n" % (
+      _TOKEN_STORE_VERSION, bool(do_lower_case))).encode("utf-8"))
+  for path in [vocab_file] + list(input_files):
+    # The length is hashed first so that the file boundaries count too.
+    sha.update(("%d\n" % tf.io.gfile.stat(path).length).encode("utf-8"))
+    with tf.io.gfile.GFile(path, "rb") as reader:
+      while True:
+        chunk = reader.read(1 << 20)
+        if not chunk:
+          break
+        sha.update(chunk)
+  return sha.hexdigest()
+
+
+def build_token_store(input_files, tokenizer, store_dir,
+                      num_tokenize_workers=1):
+  """Tokenizes raw text into an on-disk `TokenStore` in `store_dir`."""
+  writer = TokenStoreWriter(store_dir)
+  # Same input file format as `create_training_instances`.
+  for lines in read_line_batches(input_files):
+    for (line, tokens) in zip(
+        lines, tokenizer.tokenize_batch(lines, num_tokenize_workers)):
+      if not line:
+        writer.end_document()
+      if tokens:
+        writer.add_sentence(tokenizer.convert_tokens_to_ids(tokens))
+  writer.close()
+
+
+def write_streaming_instances(store_dir, tokenizer, output_files,
+                              max_seq_length, dupe_factor, short_seq_prob,
+                              masked_lm_prob, max_predictions_per_seq,
+                              random_seed, shuffle_buffer_size, num_workers=1,
+                              vectorized_masking=False, dynamic_masking=False,
+                              compact_records=False, max_sequences_per_row=1):
+  """Creates and writes `TrainingInstance`s one output shard at a time.
+
+  The documents of the token store in `store_dir` are shuffled and dealt out
+  to the output files. Each shard is generated and written on its own, so a
+  process holds at most `shuffle_buffer_size` instances at any time. Random
+  next sentences are still drawn from the whole corpus.
+
+  Every shard uses its own random seed derived from `random_seed` and its
+  index, so the output only depends on `random_seed` and `output_files`, and
+  not on `num_workers`.
+  """
+  rng = random.Random(random_seed)
+  store = TokenStore(store_dir, tokenizer.inv_vocab)
+  documents = array.array("q", range(len(store)))
+  store.close()
+  tf.compat.v1.logging.info("Generating %d shards from %d documents",
+                            len(output_files), len(documents))
+  rng.shuffle(documents)
+
+  shards = []
+  for (shard_index, output_file) in enumerate(output_files):
+    shards.append((shard_index, output_file,
+                   documents[shard_index::len(output_files)]))
+  shard_options = (max_seq_length, dupe_factor, short_seq_prob, masked_lm_prob,
+                   max_predictions_per_seq, random_seed, shuffle_buffer_size,
+                   vectorized_masking, dynamic_masking, compact_records,
+                   max_sequences_per_row)
+
+  if num_workers <= 1:
+    store = TokenStore(store_dir, tokenizer.inv_vocab)
+    for shard in shards:
+      write_shard(store, tokenizer, shard, *shard_options)
+    store.close()
+    return
+
+  pool = multiprocessing.Pool(
+      processes=num_workers,
+      initializer=_init_shard_worker,
+      initargs=(store_dir, tokenizer, shard_options, sys.argv))
+  try:
+    pool.map(_write_shard_in_worker, shards, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def write_shard(store, tokenizer, shard, max_seq_length, dupe_factor,
+                short_seq_prob, masked_lm_prob, max_predictions_per_seq,
+                random_seed, shuffle_buffer_size, vectorized_masking=False,
+                dynamic_masking=False, compact_records=False,
+                max_sequences_per_row=1):
+  """Creates and writes the instances of one `(index, file, documents)`."""
+  (shard_index, output_file, shard_documents) = shard
+  tf.compat.v1.logging.info("*** Writing shard %d to %s ***", shard_index,
+                            output_file)
+  rng = random.Random(shard_seed(random_seed, shard_index))
+  vocab_words = list(tokenizer.vocab.keys())
+  instances = create_shard_instances(
+      store, shard_documents, max_seq_length, dupe_factor, short_seq_prob,
+      masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+      mask_tokens=not (vectorized_masking or dynamic_masking))
+  if vectorized_masking and not dynamic_masking:
+    instances = mask_instances(instances, tokenizer, max_seq_length,
+                               masked_lm_prob, max_predictions_per_seq,
+                               np.random.default_rng(rng.getrandbits(64)))
+  write_instance_to_example_files(
+      shuffle_instances(instances, shuffle_buffer_size, rng), tokenizer,
+      max_seq_length, max_predictions_per_seq, [output_file],
+      write_masked_lm=not dynamic_masking, compact=compact_records,
+      max_sequences_per_row=max_sequences_per_row)
+
+
+def shard_seed(random_seed, shard_index):
+  """Returns the seed of the random stream of a shard."""
+  # String seeds are hashed with SHA-512, so neighbouring shards get
+  # unrelated streams.
+  return "%d:%d" % (random_seed, shard_index)
+
+
+_worker_shard_state = None
+
+
+def _init_shard_worker(store_dir, tokenizer, shard_options, argv):
+  global _worker_shard_state
+  # Flags are only parsed in the main process when workers are not forked.
+  if not FLAGS.is_parsed():
+    FLAGS(argv, known_only=True)
+  _worker_shard_state = (TokenStore(store_dir, tokenizer.inv_vocab), tokenizer,
+                         shard_options)
+
+
+def _write_shard_in_worker(shard):
+  (store, tokenizer, shard_options) = _worker_shard_state
+  write_shard(store, tokenizer, shard, *shard_options)
+
+
+def sharded_output_files(output_files, num_workers):
+  """Splits a single output file into `num_workers` shards."""
+  if len(output_files) != 1 or num_workers <= 1:
+    return output_files
+  return ["%s-%05d-of-%05d" % (output_files[0], i, num_workers)
+          for i in range(num_workers)]
+
+
+def create_shard_instances(all_documents, shard_documents, max_seq_length,
+                           dupe_factor, short_seq_prob, masked_lm_prob,
+                           max_predictions_per_seq, vocab_words, rng,
+                           mask_tokens=True):
+  """Yields the `TrainingInstance`s for the documents of one shard."""
+  for _ in range(dupe_factor):
+    rng.shuffle(shard_documents)
+    for document_index in shard_documents:
+      for instance in create_instances_from_document(
+          all_documents, document_index, max_seq_length, short_seq_prob,
+          masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+          mask_tokens):
+        yield instance
+
+
+def shuffle_instances(instances, buffer_size, rng):
+  """Shuffles an iterable while holding at most `buffer_size` items."""
+  buffer = []
+  for instance in instances:
+    if len(buffer) < buffer_size:
+      buffer.append(instance)
+      continue
+    index = rng.randint(0, buffer_size - 1)
+    yield buffer[index]
+    buffer[index] = instance
+  rng.shuffle(buffer)
+  for instance in buffer:
+    yield instance
+
+
+_TOKEN_STORE_VERSION = 1
+_TOKEN_STORE_IDS = "ids.int32"
+_TOKEN_STORE_SENTENCES = "sentences.int64"
+_TOKEN_STORE_DOCUMENTS = "documents.int64"
+_TOKEN_STORE_FLUSH_SIZE = 65536
+
+
+class TokenStoreWriter(object):
+  """Appends tokenized documents to an on-disk token store.
+
+  A token store is a directory with three flat files: the int32 WordPiece ids
+  of every sentence, one after the other, the int64 offset of each sentence in
+  the ids and the int64 offset of each document in the sentences. Both offset
+  files start with 0 and end with the total count.
+  """
+
+  def __init__(self, store_dir):
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+    self._ids_file = open(os.path.join(store_dir, _TOKEN_STORE_IDS), "wb")
+    self._sentences_file = open(
+        os.path.join(store_dir, _TOKEN_STORE_SENTENCES), "wb")
+    self._documents_file = open(
+        os.path.join(store_dir, _TOKEN_STORE_DOCUMENTS), "wb")
+    self._sentences = array.array("q", [0])
+    self._documents = array.array("q", [0])
+    self._num_ids = 0
+    self._num_sentences = 0
+    self._document_start = 0
+
+  def add_sentence(self, ids):
+    """Appends a sentence of ids to the current document."""
+    array.array("i", ids).tofile(self._ids_file)
+    self._num_ids += len(ids)
+    self._num_sentences += 1
+    self._sentences.append(self._num_ids)
+    if len(self._sentences) >= _TOKEN_STORE_FLUSH_SIZE:
+      self._sentences.tofile(self._sentences_file)
+      self._sentences = array.array("q")
+
+  def end_document(self):
+    """Ends the current document. Empty documents are dropped."""
+    if self._num_sentences == self._document_start:
+      return
+    self._document_start = self._num_sentences
+    self._documents.append(self._num_sentences)
+    if len(self._documents) >= _TOKEN_STORE_FLUSH_SIZE:
+      self._documents.tofile(self._documents_file)
+      self._documents = array.array("q")
+
+  def close(self):
+    self.end_document()
+    self._sentences.tofile(self._sentences_file)
+    self._documents.tofile(self._documents_file)
+    self._ids_file.close()
+    self._sentences_file.close()
+    self._documents_file.close()
+
+
+class TokenStore(object):
+  """Read-only view of a token store written by `TokenStoreWriter`.
+
+  This can be used in place of the `all_documents` list of
+  `create_training_instances`: `store[i]` is a document, which is a sequence
+  of sentences, each a list of WordPiece tokens. The files are memory-mapped,
+  so only the documents in use are paged in.
+  """
+
+  def __init__(self, store_dir, inv_vocab):
+    self._inv_vocab = inv_vocab
+    self._mmaps = []
+    self._ids = self._map(os.path.join(store_dir, _TOKEN_STORE_IDS), "i")
+    self._sentences = self._map(
+        os.path.join(store_dir, _TOKEN_STORE_SENTENCES), "q")
+    self._documents = self._map(
+        os.path.join(store_dir, _TOKEN_STORE_DOCUMENTS), "q")
+
+  def _map(self, path, typecode):
+    with open(path, "rb") as reader:
+      if os.fstat(reader.fileno()).st_size == 0:
+        return array.array(typecode)
+      mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+    self._mmaps.append(mm)
+    return memoryview(mm).cast(typecode)
+
+  def __len__(self):
+    return len(self._documents) - 1
+
+  def __getitem__(self, index):
+    return _StoredDocument(self, self._documents[index],
+                           self._documents[index + 1])
+
+  def sentence_tokens(self, sentence_index):
+    """Returns the WordPiece tokens of a sentence."""
+    ids = self._ids[self._sentences[sentence_index]:
+                    self._sentences[sentence_index + 1]]
+    return [self._inv_vocab[i] for i in ids]
+
+  def close(self):
+    for view in (self._ids, self._sentences, self._documents):
+      if isinstance(view, memoryview):
+        view.release()
+    for mm in self._mmaps:
+      mm.close()
+    self._mmaps = []
+
+
+class _StoredDocument(object):
+  """A document of a `TokenStore`, as a sequence of token lists."""
+
+  def __init__(self, store, start, end):
+    self._store = store
+    self._start = start
+    self._end = end
+
+  def __len__(self):
+    return self._end - self._start
+
+  def __getitem__(self, index):
+    if not 0 <= index < self._end - self._start:
+      raise IndexError("sentence index out of range")
+    return self._store.sentence_tokens(self._start + index)
+
+
+def read_line_batches(input_files, batch_size=10000):
+  """Yields lists of up to `batch_size` stripped lines from `input_files`."""
+  lines = []
+  for input_file in input_files:
+    with tf.io.gfile.GFile(input_file, "r") as reader:
+      while True:
+        line = tokenization.convert_to_unicode(reader.readline())
+        if not line:
+          break
+        lines.append(line.strip())
+        if len(lines) >= batch_size:
+          yield lines
+          lines = []
+  if lines:
+    yield lines
+
+
 def create_instances_from_document(
     all_documents, document_index, max_seq_length, short_seq_prob,
-    masked_lm_prob, max_predictions_per_seq, vocab_words, rng):
-  """Creates `TrainingInstance`s for a single document."""
+    masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+    mask_tokens=True):
+  """Creates `TrainingInstance`s for a single document.
+
+  With `mask_tokens=False` the instances are left without masked LM
+  predictions, for `mask_instances` to fill in.
+  """
   document = all_documents[document_index]
 
   # Account for [CLS], [SEP], [SEP]
@@ -318,9 +948,12 @@ def create_instances_from_document(
         tokens.append("[SEP]")
         segment_ids.append(1)
 
-        (tokens, masked_lm_positions,
-         masked_lm_labels) = create_masked_lm_predictions(
-             tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
+        (masked_lm_positions, masked_lm_labels) = ([], [])
+        if mask_tokens:
+          (tokens, masked_lm_positions,
+           masked_lm_labels) = create_masked_lm_predictions(
+               tokens, masked_lm_prob, max_predictions_per_seq, vocab_words,
+               rng)
         instance = TrainingInstance(
             tokens=tokens,
             segment_ids=segment_ids,
@@ -415,6 +1048,176 @@ def create_masked_lm_predictions(tokens, masked_lm_prob,
   return (output_tokens, masked_lm_positions, masked_lm_labels)
 
 
+MaskedLmVocab = collections.namedtuple(
+    "MaskedLmVocab", ["mask_id", "vocab_size", "is_special", "is_subword"])
+
+
+def create_masked_lm_vocab(vocab):
+  """Creates the `MaskedLmVocab` for `create_masked_lm_predictions_batch`.
+
+  `is_special` and `is_subword` are boolean arrays indexed by id, which mark
+  the tokens that are never masked and the "##" WordPieces.
+  """
+  vocab_size = max(vocab.values()) + 1
+  is_special = np.zeros([vocab_size], dtype=np.bool_)
+  is_subword = np.zeros([vocab_size], dtype=np.bool_)
+  for (token, index) in vocab.items():
+    is_special[index] = token == "[CLS]" or token == "[SEP]"
+    is_subword[index] = token.startswith("##")
+  return MaskedLmVocab(
+      mask_id=vocab["[MASK]"],
+      vocab_size=vocab_size,
+      is_special=is_special,
+      is_subword=is_subword)
+
+
+def create_masked_lm_predictions_batch(input_ids, input_lengths,
+                                       masked_lm_prob, max_predictions_per_seq,
+                                       masked_lm_vocab, do_whole_word_mask,
+                                       rng):
+  """Creates the predictions for the masked LM objective for a batch.
+
+  This chooses masks with the same distribution as
+  `create_masked_lm_predictions`, but for a whole batch of id arrays at once.
+
+  Args:
+    input_ids: int array of shape [batch_size, seq_length]. Positions past
+      `input_lengths` are padding and are never masked.
+    input_lengths: int array of shape [batch_size].
+    masked_lm_prob: Masked LM probability.
+    max_predictions_per_seq: Maximum number of masked LM predictions per row.
+    masked_lm_vocab: A `MaskedLmVocab`.
+    do_whole_word_mask: Whether to mask all of the WordPieces of a word.
+    rng: A `np.random.Generator`.
+
+  Returns:
+    A tuple `(output_ids, masked_lm_positions, masked_lm_ids,
+    masked_lm_weights)`. `output_ids` has the shape of `input_ids`, the others
+    have shape [batch_size, max_predictions_per_seq]. The positions of a row
+    are sorted and padded with 0, with a weight of 0 for padding.
+  """
+  input_ids = np.asarray(input_ids)
+  input_lengths = np.asarray(input_lengths)
+  (batch_size, seq_length) = input_ids.shape
+  positions = np.arange(seq_length)
+
+  is_candidate = ((positions[None, :] < input_lengths[:, None]) &
+                  ~masked_lm_vocab.is_special[input_ids])
+
+  # Number the candidate words of each row. A "##" WordPiece belongs to the
+  # word before it, as in `create_masked_lm_predictions`.
+  is_word_start = is_candidate
+  if do_whole_word_mask:
+    has_previous = np.cumsum(is_candidate, axis=1) > 1
+    is_word_start = is_candidate & ~(masked_lm_vocab.is_subword[input_ids] &
+                                     has_previous)
+  word_index = np.cumsum(is_word_start, axis=1) - 1
+  row_offsets = np.arange(batch_size)[:, None] * seq_length
+  word_lengths = np.bincount(
+      (word_index + row_offsets)[is_candidate],
+      minlength=batch_size * seq_length).reshape(batch_size, seq_length)
+
+  num_to_predict = np.minimum(
+      max_predictions_per_seq,
+      np.maximum(1, np.round(input_lengths * masked_lm_prob).astype(np.int64)))
+
+  # Visit the words of each row in a random order and take each word which
+  # still fits in the row's budget.
+  scores = rng.random((batch_size, seq_length))
+  scores[word_lengths == 0] = np.inf
+  order = np.argsort(scores, axis=1)
+  ordered_lengths = np.take_along_axis(word_lengths, order, axis=1)
+  if do_whole_word_mask:
+    is_taken = np.zeros([batch_size, seq_length], dtype=np.bool_)
+    num_taken = np.zeros([batch_size], dtype=np.int64)
+    for j in range(int(np.max(np.sum(word_lengths > 0, axis=1), initial=0))):
+      length = ordered_lengths[:, j]
+      fits = (length > 0) & (num_taken + length <= num_to_predict)
+      is_taken[:, j] = fits
+      num_taken += np.where(fits, length, 0)
+  else:
+    # Every word is a single WordPiece, so this is just the first
+    # `num_to_predict` of them.
+    is_taken = ((ordered_lengths > 0) &
+                (np.cumsum(ordered_lengths, axis=1) <=
+                 num_to_predict[:, None]))
+  is_word_masked = np.zeros([batch_size, seq_length], dtype=np.bool_)
+  np.put_along_axis(is_word_masked, order, is_taken, axis=1)
+  is_masked = is_candidate & np.take_along_axis(
+      is_word_masked, np.maximum(word_index, 0), axis=1)
+
+  # 80% of the time, replace with [MASK], 10% of the time, keep the original
+  # and 10% of the time, replace with a random word.
+  replacement = rng.random((batch_size, seq_length))
+  random_ids = rng.integers(
+      0, masked_lm_vocab.vocab_size, size=(batch_size, seq_length))
+  output_ids = np.where(
+      replacement < 0.8, masked_lm_vocab.mask_id,
+      np.where(replacement < 0.9, input_ids, random_ids))
+  output_ids = np.where(is_masked, output_ids, input_ids).astype(
+      input_ids.dtype)
+
+  # A stable sort puts the masked positions of each row first, in order.
+  masked_lm_positions = np.argsort(
+      ~is_masked, axis=1, kind="stable")[:, :max_predictions_per_seq]
+  masked_lm_weights = (np.arange(max_predictions_per_seq)[None, :] <
+                       np.sum(is_masked, axis=1)[:, None])
+  masked_lm_positions = np.where(masked_lm_weights, masked_lm_positions, 0)
+  masked_lm_ids = np.where(
+      masked_lm_weights,
+      np.take_along_axis(input_ids, masked_lm_positions, axis=1), 0)
+  return (output_ids, masked_lm_positions, masked_lm_ids,
+          masked_lm_weights.astype(np.float32))
+
+
+def mask_instances(instances, tokenizer, max_seq_length, masked_lm_prob,
+                   max_predictions_per_seq, rng, batch_size=1024):
+  """Yields `instances` with masks from `create_masked_lm_predictions_batch`.
+
+  The instances are masked in batches of `batch_size` and are expected to
+  have no masked LM predictions yet.
+  """
+  masked_lm_vocab = create_masked_lm_vocab(tokenizer.vocab)
+  batch = []
+  for instance in instances:
+    batch.append(instance)
+    if len(batch) == batch_size:
+      _mask_instance_batch(batch, tokenizer, max_seq_length, masked_lm_prob,
+                           max_predictions_per_seq, masked_lm_vocab, rng)
+      for masked_instance in batch:
+        yield masked_instance
+      batch = []
+  if batch:
+    _mask_instance_batch(batch, tokenizer, max_seq_length, masked_lm_prob,
+                         max_predictions_per_seq, masked_lm_vocab, rng)
+    for masked_instance in batch:
+      yield masked_instance
+
+
+def _mask_instance_batch(batch, tokenizer, max_seq_length, masked_lm_prob,
+                         max_predictions_per_seq, masked_lm_vocab, rng):
+  input_ids = np.zeros([len(batch), max_seq_length], dtype=np.int32)
+  input_lengths = np.zeros([len(batch)], dtype=np.int32)
+  for (i, instance) in enumerate(batch):
+    input_ids[i, :len(instance.tokens)] = tokenizer.convert_tokens_to_ids(
+        instance.tokens)
+    input_lengths[i] = len(instance.tokens)
+
+  (output_ids, masked_lm_positions, masked_lm_ids,
+   masked_lm_weights) = create_masked_lm_predictions_batch(
+       input_ids, input_lengths, masked_lm_prob, max_predictions_per_seq,
+       masked_lm_vocab, FLAGS.do_whole_word_mask, rng)
+
+  num_predictions = np.sum(masked_lm_weights, axis=1).astype(np.int64)
+  for (i, instance) in enumerate(batch):
+    instance.tokens = tokenizer.convert_ids_to_tokens(
+        output_ids[i, :input_lengths[i]].tolist())
+    instance.masked_lm_positions = (
+        masked_lm_positions[i, :num_predictions[i]].tolist())
+    instance.masked_lm_labels = tokenizer.convert_ids_to_tokens(
+        masked_lm_ids[i, :num_predictions[i]].tolist())
+
+
 def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
   """Truncates a pair of sequences to a maximum sequence length."""
   while True:
@@ -436,8 +1239,12 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
 def main(_):
   tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
 
+  if FLAGS.shuffle_buffer_size < 1:
+    raise ValueError("`shuffle_buffer_size` must be at least 1.")
+
   tokenizer = tokenization.FullTokenizer(
-      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case,
+      cache_size=FLAGS.wordpiece_cache_size)
 
   input_files = []
   for input_pattern in FLAGS.input_file.split(","):
@@ -447,19 +1254,64 @@ def main(_):
   for input_file in input_files:
     tf.compat.v1.logging.info("  %s", input_file)
 
+  output_files = FLAGS.output_file.split(",")
+
+  cached_store_dir = None
+  if FLAGS.token_cache_dir:
+    cached_store_dir = cached_token_store(
+        FLAGS.token_cache_dir, input_files, tokenizer, FLAGS.vocab_file,
+        FLAGS.do_lower_case, FLAGS.num_tokenize_workers)
+    tokenizer.close_pool()
+
+  if FLAGS.streaming or FLAGS.num_workers > 1:
+    output_files = sharded_output_files(output_files, FLAGS.num_workers)
+    store_dir = (cached_store_dir or FLAGS.token_store_dir or
+                 tempfile.mkdtemp())
+    try:
+      if not cached_store_dir:
+        build_token_store(input_files, tokenizer, store_dir,
+                          FLAGS.num_tokenize_workers)
+        tokenizer.close_pool()
+      write_streaming_instances(
+          store_dir, tokenizer, output_files, FLAGS.max_seq_length,
+          FLAGS.dupe_factor, FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+          FLAGS.max_predictions_per_seq, FLAGS.random_seed,
+          FLAGS.shuffle_buffer_size, FLAGS.num_workers,
+          FLAGS.vectorized_masking, FLAGS.dynamic_masking,
+          FLAGS.compact_records, FLAGS.max_sequences_per_row)
+    finally:
+      if not cached_store_dir and not FLAGS.token_store_dir:
+        shutil.rmtree(store_dir)
+    return
+
   rng = random.Random(FLAGS.random_seed)
-  instances = create_training_instances(
-      input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
-      FLAGS.short_seq_prob, FLAGS.masked_lm_prob, FLAGS.max_predictions_per_seq,
-      rng)
+  if cached_store_dir:
+    store = TokenStore(cached_store_dir, tokenizer.inv_vocab)
+    all_documents = [list(document) for document in store]
+    store.close()
+    instances = create_instances_from_documents(
+        all_documents, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
+        FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+        FLAGS.max_predictions_per_seq, rng, FLAGS.vectorized_masking,
+        FLAGS.dynamic_masking)
+  else:
+    instances = create_training_instances(
+        input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
+        FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+        FLAGS.max_predictions_per_seq, rng, FLAGS.num_tokenize_workers,
+        FLAGS.vectorized_masking, FLAGS.dynamic_masking)
+    tokenizer.close_pool()
 
-  output_files = FLAGS.output_file.split(",")
   tf.compat.v1.logging.info("*** Writing to output files ***")
   for output_file in output_files:
     tf.compat.v1.logging.info("  %s", output_file)
 
   write_instance_to_example_files(instances, tokenizer, FLAGS.max_seq_length,
-                                  FLAGS.max_predictions_per_seq, output_files)
+                                  FLAGS.max_predictions_per_seq, output_files,
+                                  write_masked_lm=not FLAGS.dynamic_masking,
+                                  compact=FLAGS.compact_records,
+                                  max_sequences_per_row=(
+                                      FLAGS.max_sequences_per_row))
 
 
 if __name__ == "__main__":
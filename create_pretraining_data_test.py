@@ -0,0 +1,394 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import random
+import time
+import create_pretraining_data
+import numpy as np
+import tokenization
+import tensorflow as tf
+
+
+_VOCAB_TOKENS = [
+    "[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "the", "un", "##want",
+    "##ed", "runn", "##ing", "man", "is", "a", "##n", ",", "."
+]
+
+
+def _create_batch(rng, batch_size, seq_length):
+  """Random [CLS] A [SEP] B [SEP] id arrays, padded to `seq_length`."""
+  input_ids = np.zeros([batch_size, seq_length], dtype=np.int32)
+  input_lengths = np.zeros([batch_size], dtype=np.int32)
+  for i in range(batch_size):
+    length = rng.randint(5, seq_length)
+    ids = [rng.randint(5, len(_VOCAB_TOKENS) - 1) for _ in range(length)]
+    ids[0] = 2
+    ids[rng.randint(2, length - 2)] = 3
+    ids[-1] = 3
+    input_ids[i, :length] = ids
+    input_lengths[i] = length
+  return (input_ids, input_lengths)
+
+
+def _create_corpus(rng, num_documents):
+  """Random documents of sentences made of words of `_VOCAB_TOKENS`."""
+  words = ["the", "unwanted", "running", "man", "is", "a", "an", ",", "."]
+  return [[" ".join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+           for _ in range(rng.randint(1, 6))]
+          for _ in range(num_documents)]
+
+
+def _read_records(path):
+  return list(tf.compat.v1.io.tf_record_iterator(path))
+
+
+class CreatePretrainingDataTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(CreatePretrainingDataTest, self).setUp()
+    self.vocab = collections.OrderedDict(
+        (token, i) for (i, token) in enumerate(_VOCAB_TOKENS))
+    self.masked_lm_vocab = create_pretraining_data.create_masked_lm_vocab(
+        self.vocab)
+
+  def _check_batch(self, do_whole_word_mask):
+    (input_ids, input_lengths) = _create_batch(random.Random(1), 200, 32)
+    (output_ids, positions, masked_lm_ids,
+     weights) = create_pretraining_data.create_masked_lm_predictions_batch(
+         input_ids, input_lengths, 0.15, 5, self.masked_lm_vocab,
+         do_whole_word_mask, np.random.default_rng(2))
+
+    self.assertAllEqual(positions.shape, [200, 5])
+    for i in range(200):
+      length = input_lengths[i]
+      num_predictions = int(np.sum(weights[i]))
+      num_to_predict = min(5, max(1, int(round(length * 0.15))))
+      row_positions = list(positions[i, :num_predictions])
+
+      self.assertLessEqual(num_predictions, num_to_predict)
+      if not do_whole_word_mask:
+        self.assertEqual(num_predictions, num_to_predict)
+      self.assertAllEqual(row_positions, sorted(set(row_positions)))
+      self.assertAllEqual(positions[i, num_predictions:], [0] *
+                          (5 - num_predictions))
+      self.assertAllEqual(masked_lm_ids[i, :num_predictions],
+                          input_ids[i, row_positions])
+      for j in range(32):
+        if j in row_positions:
+          self.assertLess(j, length)
+          self.assertNotIn(input_ids[i, j], (2, 3))
+        else:
+          self.assertEqual(output_ids[i, j], input_ids[i, j])
+
+      if do_whole_word_mask:
+        # A "##" piece is masked exactly when the piece before it is.
+        for j in range(1, length):
+          if (_VOCAB_TOKENS[input_ids[i, j]].startswith("##") and
+              input_ids[i, j - 1] not in (2, 3)):
+            self.assertEqual(j in row_positions, j - 1 in row_positions)
+
+  def test_masked_lm_predictions_batch(self):
+    self._check_batch(do_whole_word_mask=False)
+
+  def test_masked_lm_predictions_batch_whole_word(self):
+    self._check_batch(do_whole_word_mask=True)
+
+  def test_masked_lm_predictions_batch_replacement(self):
+    input_ids = np.full([20000, 8], 5, dtype=np.int32)
+    input_lengths = np.full([20000], 8, dtype=np.int32)
+    (output_ids, positions, _,
+     _) = create_pretraining_data.create_masked_lm_predictions_batch(
+         input_ids, input_lengths, 0.15, 1, self.masked_lm_vocab, False,
+         np.random.default_rng(3))
+
+    replaced = np.take_along_axis(output_ids, positions, axis=1)[:, 0]
+    # Random replacements are uniform over the vocab, so a few of them are
+    # the original token or [MASK].
+    self.assertNear(np.mean(replaced == 4), 0.8 + 0.1 / 17, 0.01)
+    self.assertNear(np.mean(replaced == 5), 0.1 + 0.1 / 17, 0.01)
+
+  def test_pack_instances(self):
+    rng = random.Random(4)
+    instances = []
+    for _ in range(100):
+      length = rng.randint(5, 32)
+      num_predictions = rng.randint(1, 5)
+      instances.append(
+          create_pretraining_data.TrainingInstance(
+              tokens=["[CLS]"] + ["the"] * (length - 3) + ["[SEP]", "."],
+              segment_ids=[0] * (length - 1) + [1],
+              masked_lm_positions=list(range(1, num_predictions + 1)),
+              masked_lm_labels=["man"] * num_predictions,
+              is_random_next=rng.random() < 0.5))
+
+    rows = list(
+        create_pretraining_data.pack_instances(
+            instances, 64, 8, 3, max_open_rows=4))
+    packed = [instance for row in rows for instance in row]
+    self.assertCountEqual([id(x) for x in packed], [id(x) for x in instances])
+    self.assertLess(len(rows), len(instances))
+    for row in rows:
+      self.assertLessEqual(len(row), 3)
+      self.assertLessEqual(sum(len(x.tokens) for x in row), 64)
+      self.assertLessEqual(sum(len(x.masked_lm_positions) for x in row), 8)
+
+  def test_create_packed_features(self):
+    tokenizer = collections.namedtuple("Tokenizer", ["convert_tokens_to_ids"])(
+        lambda tokens: [self.vocab[x] for x in tokens])
+    row = [
+        create_pretraining_data.TrainingInstance(
+            tokens=["[CLS]", "the", "[SEP]", "man", "[SEP]"],
+            segment_ids=[0, 0, 0, 1, 1],
+            masked_lm_positions=[3],
+            masked_lm_labels=["man"],
+            is_random_next=True),
+        create_pretraining_data.TrainingInstance(
+            tokens=["[CLS]", "a", "[SEP]", "is", "[SEP]"],
+            segment_ids=[0, 0, 0, 1, 1],
+            masked_lm_positions=[1],
+            masked_lm_labels=["a"],
+            is_random_next=False),
+    ]
+    features = create_pretraining_data.create_packed_features(
+        row, tokenizer, 12, 3, 3)
+
+    def values(name):
+      feature = features[name]
+      return list(feature.int64_list.value or feature.float_list.value)
+
+    self.assertAllEqual(values("input_mask"),
+                        [1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 0, 0])
+    self.assertAllEqual(values("position_ids"),
+                        [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 0])
+    self.assertAllEqual(values("segment_ids"),
+                        [0, 0, 0, 1, 1, 0, 0, 0, 1, 1, 0, 0])
+    self.assertAllEqual(values("masked_lm_positions"), [3, 6, 0])
+    self.assertAllEqual(values("masked_lm_ids"), [11, 13, 0])
+    self.assertAllEqual(values("next_sentence_positions"), [0, 5, 0])
+    self.assertAllEqual(values("next_sentence_labels"), [1, 0, 0])
+    self.assertAllEqual(values("next_sentence_weights"), [1.0, 1.0, 0.0])
+
+  def _write_corpus(self, corpus, name="corpus.txt"):
+    """Writes `corpus` in the input file format and returns its path."""
+    path = os.path.join(self.get_temp_dir(), name)
+    with tf.io.gfile.GFile(path, "w") as writer:
+      for document in corpus:
+        writer.write("\n".join(document) + "\n\n")
+    return path
+
+  def _create_tokenizer(self, do_lower_case=True):
+    vocab_file = os.path.join(self.get_temp_dir(), "vocab.txt")
+    with tf.io.gfile.GFile(vocab_file, "w") as writer:
+      writer.write("".join([x + "\n" for x in _VOCAB_TOKENS]))
+    return (tokenization.FullTokenizer(vocab_file, do_lower_case), vocab_file)
+
+  def test_token_store(self):
+    (tokenizer, _) = self._create_tokenizer()
+    documents = [[["the", "man"], ["is"]], [["a", "runn", "##ing"]],
+                 [["un", "##want", "##ed", "."], ["the"], [","]]]
+    store_dir = os.path.join(self.get_temp_dir(), "store")
+    # A small flush size covers the offsets written in several parts.
+    with tf.compat.v1.test.mock.patch.object(
+        create_pretraining_data, "_TOKEN_STORE_FLUSH_SIZE", 2):
+      writer = create_pretraining_data.TokenStoreWriter(store_dir)
+      writer.end_document()
+      for document in documents:
+        for sentence in document:
+          writer.add_sentence(tokenizer.convert_tokens_to_ids(sentence))
+        # Empty documents are dropped.
+        writer.end_document()
+        writer.end_document()
+      writer.close()
+
+    store = create_pretraining_data.TokenStore(store_dir, tokenizer.inv_vocab)
+    self.assertLen(store, len(documents))
+    self.assertEqual([list(document) for document in store], documents)
+    self.assertLen(store[2], 3)
+    with self.assertRaises(IndexError):
+      store[2][3]  # pylint: disable=expression-not-assigned
+    store.close()
+
+  def _write_in_memory_shards(self, all_documents, tokenizer, output_files,
+                              random_seed, shuffle_buffer_size):
+    """Does what `write_streaming_instances` does, from in-memory documents."""
+    rng = random.Random(random_seed)
+    documents = list(range(len(all_documents)))
+    rng.shuffle(documents)
+    for (shard_index, output_file) in enumerate(output_files):
+      shard_rng = random.Random(
+          create_pretraining_data.shard_seed(random_seed, shard_index))
+      instances = create_pretraining_data.create_shard_instances(
+          all_documents, documents[shard_index::len(output_files)], 32, 2,
+          0.1, 0.15, 5, list(tokenizer.vocab.keys()), shard_rng)
+      create_pretraining_data.write_instance_to_example_files(
+          create_pretraining_data.shuffle_instances(
+              instances, shuffle_buffer_size, shard_rng), tokenizer, 32, 5,
+          [output_file])
+
+  def _write_streaming_shards(self, store_dir, tokenizer, output_files,
+                              num_workers=1):
+    create_pretraining_data.write_streaming_instances(
+        store_dir, tokenizer, output_files, 32, 2, 0.1, 0.15, 5, 7, 10,
+        num_workers=num_workers)
+
+  def test_write_streaming_instances(self):
+    tf.compat.v1.flags.FLAGS.mark_as_parsed()
+    (tokenizer, _) = self._create_tokenizer()
+    corpus = _create_corpus(random.Random(5), 12)
+    store_dir = os.path.join(self.get_temp_dir(), "streaming_store")
+    create_pretraining_data.build_token_store([self._write_corpus(corpus)],
+                                              tokenizer, store_dir)
+    all_documents = [[tokenizer.tokenize(line) for line in document]
+                     for document in corpus]
+    store = create_pretraining_data.TokenStore(store_dir, tokenizer.inv_vocab)
+    self.assertEqual([list(document) for document in store], all_documents)
+    store.close()
+
+    output_files = [
+        os.path.join(self.get_temp_dir(), "streaming-%d" % i) for i in range(2)]
+    expected_files = [
+        os.path.join(self.get_temp_dir(), "in_memory-%d" % i) for i in range(2)]
+    self._write_streaming_shards(store_dir, tokenizer, output_files)
+    self._write_in_memory_shards(all_documents, tokenizer, expected_files, 7,
+                                 10)
+    for (output_file, expected_file) in zip(output_files, expected_files):
+      self.assertNotEmpty(_read_records(expected_file))
+      self.assertEqual(_read_records(output_file), _read_records(expected_file))
+
+  def test_write_streaming_instances_num_workers(self):
+    tf.compat.v1.flags.FLAGS.mark_as_parsed()
+    (tokenizer, _) = self._create_tokenizer()
+    store_dir = os.path.join(self.get_temp_dir(), "workers_store")
+    create_pretraining_data.build_token_store(
+        [self._write_corpus(_create_corpus(random.Random(7), 20))], tokenizer,
+        store_dir)
+
+    shards = {}
+    for num_workers in [1, 2]:
+      output_files = [
+          os.path.join(self.get_temp_dir(), "workers_%d-%d" % (num_workers, i))
+          for i in range(3)]
+      self._write_streaming_shards(store_dir, tokenizer, output_files,
+                                   num_workers)
+      shards[num_workers] = [_read_records(x) for x in output_files]
+    for records in shards[1]:
+      self.assertNotEmpty(records)
+    self.assertEqual(shards[2], shards[1])
+    # The shards are different parts of the corpus.
+    self.assertNotEqual(shards[1][0], shards[1][1])
+
+  def test_cached_token_store(self):
+    (tokenizer, vocab_file) = self._create_tokenizer()
+    corpus = _create_corpus(random.Random(8), 4)
+    input_files = [self._write_corpus(corpus[:2], "cached-0.txt"),
+                   self._write_corpus(corpus[2:], "cached-1.txt")]
+    cache_dir = os.path.join(self.get_temp_dir(), "cache")
+
+    def cached_store(input_files, vocab_file, do_lower_case):
+      """Returns the store directory and whether it was built."""
+      with tf.compat.v1.test.mock.patch.object(
+          create_pretraining_data, "build_token_store",
+          wraps=create_pretraining_data.build_token_store) as build:
+        store_dir = create_pretraining_data.cached_token_store(
+            cache_dir, input_files, tokenizer, vocab_file, do_lower_case)
+      return (store_dir, build.called)
+
+    (store_dir, built) = cached_store(input_files, vocab_file, True)
+    self.assertTrue(built)
+    store = create_pretraining_data.TokenStore(store_dir, tokenizer.inv_vocab)
+    self.assertEqual(
+        [list(document) for document in store],
+        [[tokenizer.tokenize(line) for line in document]
+         for document in corpus])
+    store.close()
+    self.assertEqual(cached_store(input_files, vocab_file, True),
+                     (store_dir, False))
+    # Only the store is left in the cache.
+    self.assertEqual(os.listdir(cache_dir), [os.path.basename(store_dir)])
+
+    # Changing anything the tokens depend on gives a new store.
+    other_vocab_file = os.path.join(self.get_temp_dir(), "other_vocab.txt")
+    with tf.io.gfile.GFile(other_vocab_file, "w") as writer:
+      writer.write("".join([x + "\n" for x in _VOCAB_TOKENS + ["running"]]))
+    other_corpus = [list(document) for document in corpus[2:]]
+    other_corpus[0][0] += " man"
+    moved_boundary = [self._write_corpus(corpus[:1], "moved-0.txt"),
+                      self._write_corpus(corpus[1:], "moved-1.txt")]
+    store_dirs = set([store_dir])
+    for (files, vocab, do_lower_case) in [
+        (input_files[:1] + [self._write_corpus(other_corpus, "other.txt")],
+         vocab_file, True),
+        (moved_boundary, vocab_file, True),
+        (input_files, other_vocab_file, True),
+        (input_files, vocab_file, False)]:
+      (new_store_dir, built) = cached_store(files, vocab, do_lower_case)
+      self.assertTrue(built)
+      self.assertNotIn(new_store_dir, store_dirs)
+      store_dirs.add(new_store_dir)
+
+  def test_shuffle_instances(self):
+    for buffer_size in [1, 3, 100]:
+      shuffled = list(create_pretraining_data.shuffle_instances(
+          iter(range(20)), buffer_size, random.Random(6)))
+      self.assertCountEqual(shuffled, range(20))
+    self.assertNotEqual(shuffled, list(range(20)))
+
+
+class CreatePretrainingDataBenchmark(tf.test.Benchmark):
+
+  def _run_benchmark(self, name, mask_fn, num_sequences, iters=5):
+    start = time.time()
+    for _ in range(iters):
+      mask_fn()
+    wall_time = (time.time() - start) / iters
+    self.report_benchmark(
+        iters=iters,
+        wall_time=wall_time,
+        name=name,
+        extras={"sequences_per_sec": num_sequences / wall_time})
+
+  def benchmark_masked_lm_predictions(self):
+    tf.compat.v1.flags.FLAGS.mark_as_parsed()
+    vocab = collections.OrderedDict(
+        (token, i) for (i, token) in enumerate(_VOCAB_TOKENS))
+    masked_lm_vocab = create_pretraining_data.create_masked_lm_vocab(vocab)
+    (input_ids, input_lengths) = _create_batch(random.Random(1), 1024, 128)
+    sequences = [[_VOCAB_TOKENS[x] for x in input_ids[i, :input_lengths[i]]]
+                 for i in range(len(input_ids))]
+    rng = random.Random(2)
+    np_rng = np.random.default_rng(2)
+
+    def mask_one_at_a_time():
+      for tokens in sequences:
+        create_pretraining_data.create_masked_lm_predictions(
+            tokens, 0.15, 20, _VOCAB_TOKENS, rng)
+
+    def mask_batch():
+      create_pretraining_data.create_masked_lm_predictions_batch(
+          input_ids, input_lengths, 0.15, 20, masked_lm_vocab, False, np_rng)
+
+    self._run_benchmark("masked_lm_predictions", mask_one_at_a_time,
+                        len(sequences))
+    self._run_benchmark("masked_lm_predictions_batch", mask_batch,
+                        len(sequences))
+
+
+if __name__ == "__main__":
+  tf.test.main()
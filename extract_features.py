@@ -212,21 +212,21 @@ def convert_examples_to_features(examples, seq_length, tokenizer):
 
   features = []
   for (ex_index, example) in enumerate(examples):
-    tokens_a = tokenizer.tokenize(example.text_a)
+    ids_a = tokenizer.encode(example.text_a)
 
-    tokens_b = None
+    ids_b = None
     if example.text_b:
-      tokens_b = tokenizer.tokenize(example.text_b)
+      ids_b = tokenizer.encode(example.text_b)
 
-    if tokens_b:
-      # Modifies `tokens_a` and `tokens_b` in place so that the total
+    if ids_b:
+      # Modifies `ids_a` and `ids_b` in place so that the total
       # length is less than the specified length.
       # Account for [CLS], [SEP], [SEP] with "- 3"
-      _truncate_seq_pair(tokens_a, tokens_b, seq_length - 3)
+      _truncate_seq_pair(ids_a, ids_b, seq_length - 3)
     else:
       # Account for [CLS] and [SEP] with "- 2"
-      if len(tokens_a) > seq_length - 2:
-        tokens_a = tokens_a[0:(seq_length - 2)]
+      if len(ids_a) > seq_length - 2:
+        ids_a = ids_a[0:(seq_length - 2)]
 
     # The convention in BERT is:
     # (a) For sequence pairs:
@@ -246,24 +246,23 @@ def convert_examples_to_features(examples, seq_length, tokenizer):
     # For classification tasks, the first vector (corresponding to [CLS]) is
     # used as as the "sentence vector". Note that this only makes sense because
     # the entire model is fine-tuned.
-    tokens = []
+    cls_id = tokenizer.vocab["[CLS]"]
+    sep_id = tokenizer.vocab["[SEP]"]
+    input_ids = []
     input_type_ids = []
-    tokens.append("[CLS]")
-    input_type_ids.append(0)
-    for token in tokens_a:
-      tokens.append(token)
-      input_type_ids.append(0)
-    tokens.append("[SEP]")
-    input_type_ids.append(0)
-
-    if tokens_b:
-      for token in tokens_b:
-        tokens.append(token)
-        input_type_ids.append(1)
-      tokens.append("[SEP]")
-      input_type_ids.append(1)
-
-    input_ids = tokenizer.convert_tokens_to_ids(tokens)
+    input_ids.append(cls_id)
+    input_ids.extend(ids_a)
+    input_ids.append(sep_id)
+    input_type_ids.extend([0] * len(input_ids))
+
+    if ids_b:
+      input_ids.extend(ids_b)
+      input_ids.append(sep_id)
+      input_type_ids.extend([1] * (len(ids_b) + 1))
+
+    # The output refers to each token by its string, which we can look up
+    # from the ids instead of keeping the tokenizer's output around.
+    tokens = tokenizer.convert_ids_to_tokens(input_ids)
 
     # The mask has 1 for real tokens and 0 for padding tokens. Only real
     # tokens are attended to.
@@ -19,16 +19,24 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import contextlib
 import copy
 import json
 import math
 import re
+import weakref
 import numpy as np
 import six
 import tensorflow as tf
 tf.compat.v1.disable_resource_variables()
 tf.compat.v1.disable_eager_execution()
 
+# The seed and the number of calls so far of `dropout` inside `recompute_grad`.
+_dropout_seeds = []
+
+# The Keras layers of `layer_norm`, by graph and by variable scope.
+_layer_norm_layers = weakref.WeakKeyDictionary()
+
 
 class BertConfig(object):
   """Configuration for `BertModel`."""
@@ -44,7 +52,12 @@ class BertConfig(object):
                attention_probs_dropout_prob=0.1,
                max_position_embeddings=512,
                type_vocab_size=16,
-               initializer_range=0.02):
+               initializer_range=0.02,
+               fused_qkv=False,
+               attention_block_size=None,
+               recompute_layers=False,
+               remove_padding=False,
+               int8_inference=False):
     """Constructs BertConfig.
 
     Args:
@@ -68,6 +81,26 @@ class BertConfig(object):
         `BertModel`.
       initializer_range: The stdev of the truncated_normal_initializer for
         initializing all weight matrices.
+      fused_qkv: Whether the self-attention layers compute the query, key and
+        value projections with a single "qkv" matmul. Checkpoints of unfused
+        models can still be loaded with `get_assignment_map_from_checkpoint`.
+      attention_block_size: (optional) If set, the attention layers go
+        through the keys and values in blocks of this many tokens with an
+        online softmax, so that the full attention matrix is never stored.
+        This saves memory for long sequences at inference time.
+      recompute_layers: Whether to recompute the activations of each
+        Transformer layer in the backward pass instead of keeping them from the
+        forward pass. This saves memory during training at the cost of a second
+        forward pass through the encoder.
+      remove_padding: Whether the Transformer layers only run on the tokens
+        where `input_mask` is non-zero, gathered into one matrix. The attention
+        still sees padded sequences, and the sequence output is zero at the
+        padding positions. This saves compute on batches of sequences of mixed
+        lengths, but gives the layers dynamic shapes, which TPUs do not
+        support.
+      int8_inference: Whether the dense layers of the encoder multiply int8
+        inputs with int8 weights, for inference on CPUs. The weights are those
+        of a checkpoint written by `quantize_checkpoint.py`.
     """
     self.vocab_size = vocab_size
     self.hidden_size = hidden_size
@@ -80,6 +113,11 @@ class BertConfig(object):
     self.max_position_embeddings = max_position_embeddings
     self.type_vocab_size = type_vocab_size
     self.initializer_range = initializer_range
+    self.fused_qkv = fused_qkv
+    self.attention_block_size = attention_block_size
+    self.recompute_layers = recompute_layers
+    self.remove_padding = remove_padding
+    self.int8_inference = int8_inference
 
   @classmethod
   def from_dict(cls, json_object):
@@ -137,7 +175,11 @@ class BertModel(object):
                input_mask=None,
                token_type_ids=None,
                use_one_hot_embeddings=False,
-               scope=None):
+               scope=None,
+               position_ids=None,
+               packed_sequences=False,
+               pooled_positions=None,
+               compute_type=tf.float32):
     """Constructor for BertModel.
 
     Args:
@@ -150,6 +192,20 @@ class BertModel(object):
       use_one_hot_embeddings: (optional) bool. Whether to use one-hot word
         embeddings or tf.embedding_lookup() for the word embeddings.
       scope: (optional) variable scope. Defaults to "bert".
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length]
+        with the position of each token. Defaults to 0, 1, 2, ...
+      packed_sequences: (optional) bool. Whether each row packs several
+        sequences. `input_mask` then numbers the sequences of a row from 1
+        (with 0 for padding), and tokens only attend to their own sequence.
+      pooled_positions: (optional) int32 Tensor of shape [batch_size,
+        num_pooled] with the positions of the tokens to pool, e.g. the [CLS]
+        token of every sequence of a packed row. The pooled output then has
+        shape [batch_size * num_pooled, hidden_size]. Defaults to the first
+        token of each row.
+      compute_type: (optional) The dtype of the transformer layers, e.g.
+        tf.float16 or tf.bfloat16 for mixed precision. The variables, the
+        embeddings, layer normalization, the attention softmax and the
+        outputs (other than `get_all_encoder_layers`) stay in float32.
 
     Raises:
       ValueError: The config is invalid or one of the input tensor shapes
@@ -170,7 +226,9 @@ class BertModel(object):
     if token_type_ids is None:
       token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
 
-    with tf.compat.v1.variable_scope(scope, default_name="bert"):
+    with tf.compat.v1.variable_scope(
+        scope, default_name="bert",
+        custom_getter=get_custom_getter(compute_type)):
       with tf.compat.v1.variable_scope("embeddings"):
         # Perform embedding lookup on the word ids.
         (self.embedding_output, self.embedding_table) = embedding_lookup(
@@ -193,20 +251,23 @@ class BertModel(object):
             position_embedding_name="position_embeddings",
             initializer_range=config.initializer_range,
             max_position_embeddings=config.max_position_embeddings,
-            dropout_prob=config.hidden_dropout_prob)
+            dropout_prob=config.hidden_dropout_prob,
+            position_ids=position_ids)
 
       with tf.compat.v1.variable_scope("encoder"):
         # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
         # mask of shape [batch_size, seq_length, seq_length] which is used
         # for the attention scores.
         attention_mask = create_attention_mask_from_input_mask(
-            input_ids, input_mask)
+            input_ids, input_mask,
+            from_mask=input_mask if packed_sequences else None)
 
         # Run the stacked transformer.
         # `sequence_output` shape = [batch_size, seq_length, hidden_size].
         self.all_encoder_layers = transformer_model(
-            input_tensor=self.embedding_output,
+            input_tensor=tf.saturate_cast(self.embedding_output, compute_type),
             attention_mask=attention_mask,
+            input_mask=input_mask if config.remove_padding else None,
             hidden_size=config.hidden_size,
             num_hidden_layers=config.num_hidden_layers,
             num_attention_heads=config.num_attention_heads,
@@ -215,9 +276,13 @@ class BertModel(object):
             hidden_dropout_prob=config.hidden_dropout_prob,
             attention_probs_dropout_prob=config.attention_probs_dropout_prob,
             initializer_range=config.initializer_range,
-            do_return_all_layers=True)
+            do_return_all_layers=True,
+            fused_qkv=config.fused_qkv,
+            attention_block_size=config.attention_block_size,
+            recompute_layers=config.recompute_layers,
+            int8_inference=config.int8_inference)
 
-      self.sequence_output = self.all_encoder_layers[-1]
+      self.sequence_output = tf.cast(self.all_encoder_layers[-1], tf.float32)
       # The "pooler" converts the encoded sequence tensor of shape
       # [batch_size, seq_length, hidden_size] to a tensor of shape
       # [batch_size, hidden_size]. This is necessary for segment-level
@@ -226,7 +291,13 @@ class BertModel(object):
       with tf.compat.v1.variable_scope("pooler"):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token. We assume that this has been pre-trained
-        first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :], axis=1)
+        if pooled_positions is None:
+          first_token_tensor = tf.squeeze(
+              self.sequence_output[:, 0:1, :], axis=1)
+        else:
+          first_token_tensor = tf.reshape(
+              tf.gather(self.sequence_output, pooled_positions, batch_dims=1),
+              [-1, config.hidden_size])
         self.pooled_output = tf.compat.v1.layers.dense(
             first_token_tensor,
             config.hidden_size,
@@ -320,7 +391,13 @@ def get_activation(activation_string):
 
 
 def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
-  """Compute the union of the current variables and checkpoint variables."""
+  """Compute the union of the current variables and checkpoint variables.
+
+  The fused "qkv" variables of a model with `fused_qkv`, which a checkpoint
+  of an unfused model does not have, are not in the assignment map. Their
+  initializers are instead replaced by ones which concatenate the "query",
+  "key" and "value" variables from the checkpoint.
+  """
   assignment_map = {}
   initialized_variable_names = {}
 
@@ -339,20 +416,57 @@ def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
     (name, var) = (x[0], x[1])
     if name not in name_to_variable:
       continue
-    assignment_map[name] = name
+    # The variables of the Keras layer normalization layers are not in the
+    # variable store, so they cannot be looked up by name.
+    assignment_map[name] = name_to_variable[name]
+    initialized_variable_names[name] = 1
+    initialized_variable_names[name + ":0"] = 1
+
+  init_var_names = set(x[0] for x in init_vars)
+  for (name, var) in six.iteritems(name_to_variable):
+    m = re.match("^(.*)/qkv/(kernel|bias)$", name)
+    if m is None or name in init_var_names:
+      continue
+    unfused_names = ["%s/%s/%s" % (m.group(1), x, m.group(2))
+                     for x in ("query", "key", "value")]
+    if not all(x in init_var_names for x in unfused_names):
+      continue
+    init_from_concatenated_checkpoint_variables(var, init_checkpoint,
+                                                unfused_names)
     initialized_variable_names[name] = 1
     initialized_variable_names[name + ":0"] = 1
 
   return (assignment_map, initialized_variable_names)
 
 
-def dropout(input_tensor, dropout_prob):
+def init_from_concatenated_checkpoint_variables(variable, init_checkpoint,
+                                                names):
+  """Initializes `variable` with checkpoint variables concatenated on axis -1."""
+  if tf.io.gfile.isdir(init_checkpoint):
+    init_checkpoint = tf.train.latest_checkpoint(init_checkpoint)
+  with tf.compat.v1.device(variable.device), tf.compat.v1.device("/cpu:0"):
+    tensors = tf.raw_ops.RestoreV2(
+        prefix=init_checkpoint,
+        tensor_names=names,
+        shape_and_slices=[""] * len(names),
+        dtypes=[variable.dtype.base_dtype] * len(names))
+    initial_value = tf.concat(tensors, axis=-1)
+  # This is how `tf.compat.v1.train.init_from_checkpoint` replaces the
+  # initializers of the variables it restores.
+  variable._initializer_op = tf.compat.v1.assign(variable, initial_value)
+  variable._initial_value = initial_value
+
+
+def dropout(input_tensor, dropout_prob, step=None):
   """Perform dropout.
 
   Args:
     input_tensor: float Tensor.
     dropout_prob: Python float. The probability of dropping out a value (NOT of
       *keeping* a dimension as in `tf.nn.dropout`).
+    step: (optional) int32 scalar Tensor. The iteration of a `tf.while_loop`
+      that the dropout is in, so that every iteration gets its own mask inside
+      `recompute_grad`.
 
   Returns:
     A version of `input_tensor` with dropout applied.
@@ -360,6 +474,18 @@ def dropout(input_tensor, dropout_prob):
   if dropout_prob is None or dropout_prob == 0.0:
     return input_tensor
 
+  if _dropout_seeds:
+    # Inside `recompute_grad`, the masks are drawn from a seed that depends
+    # only on the order of the calls, so that the recomputation draws the same
+    # masks as the forward pass.
+    seed_state = _dropout_seeds[-1]
+    seed = seed_state[0] + [seed_state[1], 0]
+    seed_state[1] += 1
+    if step is not None:
+      seed += tf.stack([0, tf.cast(step, tf.int64)])
+    return tf.nn.experimental.stateless_dropout(
+        input_tensor, rate=dropout_prob, seed=seed)
+
   output = tf.nn.dropout(input_tensor, 1 - (1.0 - dropout_prob))
   return output
 
@@ -368,7 +494,18 @@ def layer_norm(input_tensor, name=None):
   """Run layer normalization on the last dimension of the tensor."""
   # return tf.contrib.layers.layer_norm(
   #     inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
-  return tf.keras.layers.LayerNormalization(axis=-1, epsilon=1e-12)(inputs=input_tensor)
+  if input_tensor.dtype != tf.float32:
+    # Layer normalization is done in float32 for mixed precision.
+    output_tensor = layer_norm(tf.cast(input_tensor, tf.float32), name)
+    return tf.cast(output_tensor, input_tensor.dtype)
+  # The Keras layer creates its variables outside of the variable scope, so it
+  # is looked up by scope to reuse its variables when the scope is reused.
+  scope = tf.compat.v1.get_variable_scope()
+  layers = _layer_norm_layers.setdefault(tf.compat.v1.get_default_graph(), {})
+  key = (scope.name, name)
+  if not scope.reuse or key not in layers:
+    layers[key] = tf.keras.layers.LayerNormalization(axis=-1, epsilon=1e-12)
+  return layers[key](inputs=input_tensor)
 
 
 def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
@@ -378,11 +515,137 @@ def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
   return output_tensor
 
 
+def dense_layer(input_tensor,
+                units,
+                activation=None,
+                name=None,
+                kernel_initializer=None,
+                int8_inference=False):
+  """Runs a dense layer on a matrix, optionally with int8 weights.
+
+  Args:
+    input_tensor: float Tensor of shape [batch_size, width].
+    units: int. The output width.
+    activation: (optional) Activation function of the output.
+    name: (optional) string. The variable scope of the layer.
+    kernel_initializer: (optional) Initializer of the float kernel.
+    int8_inference: bool. If False, this is `tf.compat.v1.layers.dense`. If
+      True, the layer has an int8 "kernel" with a float "kernel_scale" per
+      output and a float "input_scale" per input, which are only for
+      inference. The input is divided by "input_scale" and rounded to int8
+      for `int8_matmul`, whose outputs are multiplied by "kernel_scale".
+
+  Returns:
+    float Tensor of shape [batch_size, units].
+  """
+  if not int8_inference:
+    return tf.compat.v1.layers.dense(
+        input_tensor,
+        units,
+        activation=activation,
+        name=name,
+        kernel_initializer=kernel_initializer)
+
+  width = input_tensor.shape[-1]
+  with tf.compat.v1.variable_scope(name, default_name="dense"):
+    variables = []
+    for (variable_name, shape, dtype) in [("kernel", [width, units], tf.int8),
+                                          ("kernel_scale", [units], tf.float32),
+                                          ("input_scale", [width], tf.float32),
+                                          ("bias", [units], tf.float32)]:
+      variables.append(
+          tf.compat.v1.get_variable(
+              variable_name,
+              shape,
+              dtype=dtype,
+              initializer=tf.compat.v1.zeros_initializer(),
+              trainable=False,
+              collections=[tf.compat.v1.GraphKeys.GLOBAL_VARIABLES,
+                           tf.compat.v1.GraphKeys.MODEL_VARIABLES]))
+    (kernel, kernel_scale, input_scale, bias) = variables
+
+    output = int8_matmul(tf.cast(input_tensor, tf.float32) / input_scale,
+                         kernel)
+    output = output * kernel_scale + bias
+    if activation is not None:
+      output = activation(output)
+  return tf.cast(output, input_tensor.dtype)
+
+
+def int8_matmul(input_tensor, kernel):
+  """Rounds a float matrix to int8 and multiplies it with an int8 kernel.
+
+  The products are accumulated in int32. With oneDNN, which TensorFlow uses on
+  x86 CPUs by default, this runs the int8 kernel of `QuantizedMatMulWithBias`.
+  That kernel takes the input as uint8, so the input is offset by 128 here and
+  the offset is subtracted from the result.
+
+  Args:
+    input_tensor: float32 Tensor of shape [batch_size, width].
+    kernel: int8 Tensor of shape [width, units].
+
+  Returns:
+    float32 Tensor of shape [batch_size, units].
+  """
+  quantized_input = tf.clip_by_value(tf.round(input_tensor), -127.0, 127.0)
+  kernel = tf.convert_to_tensor(kernel)
+  if not _onednn_enabled():
+    output = tf.matmul(
+        tf.cast(quantized_input, tf.int32), tf.cast(kernel, tf.int32))
+    return tf.cast(output, tf.float32)
+
+  (output, _, _) = tf.raw_ops.QuantizedMatMulWithBias(
+      a=tf.bitcast(tf.cast(quantized_input + 128.0, tf.uint8), tf.quint8),
+      b=tf.bitcast(kernel, tf.qint8),
+      bias=tf.zeros([kernel.shape[-1]]),
+      min_a=0.0,
+      max_a=255.0,
+      min_b=-127.0,
+      max_b=127.0,
+      Toutput=tf.qint32)
+  output = tf.bitcast(output, tf.int32) - 128 * tf.reduce_sum(
+      input_tensor=tf.cast(kernel, tf.int32), axis=0)
+  return tf.cast(output, tf.float32)
+
+
+def _onednn_enabled():
+  """Returns whether TensorFlow runs its oneDNN kernels."""
+  try:
+    from tensorflow.python.util import _pywrap_util_port  # pylint: disable=g-import-not-at-top
+  except ImportError:
+    return False
+  return _pywrap_util_port.IsMklEnabled()
+
+
 def create_initializer(initializer_range=0.02):
   """Creates a `truncated_normal_initializer` with the given range."""
   return tf.compat.v1.truncated_normal_initializer(stddev=initializer_range)
 
 
+def get_custom_getter(compute_type):
+  """Returns the variable getter for layers computing in `compute_type`."""
+  if compute_type == tf.float32:
+    return None
+  return float32_variable_storage_getter
+
+
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None,
+                                    initializer=None, regularizer=None,
+                                    trainable=True, *args, **kwargs):
+  """Creates trainable variables in float32 and casts them to `dtype`.
+
+  This keeps float32 master weights for layers computing in float16 or
+  bfloat16, so that small updates are not lost to rounding.
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, dtype=storage_dtype, initializer=initializer,
+                    regularizer=regularizer, trainable=trainable, *args,
+                    **kwargs)
+  if trainable and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+
 def embedding_lookup(input_ids,
                      vocab_size,
                      embedding_size=128,
@@ -440,7 +703,8 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            position_ids=None):
   """Performs various post-processing on a word embedding tensor.
 
   Args:
@@ -461,6 +725,9 @@ def embedding_postprocessor(input_tensor,
       used with this model. This can be longer than the sequence length of
       input_tensor, but cannot be shorter.
     dropout_prob: float. Dropout probability applied to the final output tensor.
+    position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+      The positions to look up embeddings for. Defaults to the position of
+      each token in the sequence.
 
   Returns:
     float tensor with same shape as `input_tensor`.
@@ -508,31 +775,43 @@ def embedding_postprocessor(input_tensor,
       # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
       # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
       # perform a slice.
-      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-      num_dims = len(output.shape.as_list())
-
-      # Only the last two dimensions are relevant (`seq_length` and `width`), so
-      # we broadcast among the first dimensions, which is typically just
-      # the batch size.
-      position_broadcast_shape = []
-      for _ in range(num_dims - 2):
-        position_broadcast_shape.append(1)
-      position_broadcast_shape.extend([seq_length, width])
-      position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
-      output += position_embeddings
+      if position_ids is not None:
+        # Rows which pack several sequences restart their positions, so we
+        # look them up like the word embeddings.
+        position_embeddings = tf.gather(full_position_embeddings,
+                                        position_ids)
+        output += position_embeddings
+      else:
+        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                       [seq_length, -1])
+        num_dims = len(output.shape.as_list())
+
+        # Only the last two dimensions are relevant (`seq_length` and
+        # `width`), so we broadcast among the first dimensions, which is
+        # typically just the batch size.
+        position_broadcast_shape = []
+        for _ in range(num_dims - 2):
+          position_broadcast_shape.append(1)
+        position_broadcast_shape.extend([seq_length, width])
+        position_embeddings = tf.reshape(position_embeddings,
+                                         position_broadcast_shape)
+        output += position_embeddings
 
   output = layer_norm_and_dropout(output, dropout_prob)
   return output
 
 
-def create_attention_mask_from_input_mask(from_tensor, to_mask):
+def create_attention_mask_from_input_mask(from_tensor, to_mask,
+                                          from_mask=None):
   """Create 3D attention mask from a 2D tensor mask.
 
   Args:
     from_tensor: 2D or 3D Tensor of shape [batch_size, from_seq_length, ...].
     to_mask: int32 Tensor of shape [batch_size, to_seq_length].
+    from_mask: (optional) int32 Tensor of shape [batch_size, from_seq_length].
+      If given, the masks number the sequences packed into each row from 1,
+      and a token only attends to the tokens of its own sequence. This gives
+      a block-diagonal mask.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length, to_seq_length].
@@ -544,6 +823,13 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
   to_shape = get_shape_list(to_mask, expected_rank=2)
   to_seq_length = to_shape[1]
 
+  if from_mask is not None:
+    same_sequence = tf.equal(
+        tf.reshape(from_mask, [batch_size, from_seq_length, 1]),
+        tf.reshape(to_mask, [batch_size, 1, to_seq_length]))
+    is_real_token = tf.reshape(to_mask, [batch_size, 1, to_seq_length]) > 0
+    return tf.cast(tf.logical_and(same_sequence, is_real_token), tf.float32)
+
   to_mask = tf.cast(
       tf.reshape(to_mask, [batch_size, 1, to_seq_length]), tf.float32)
 
@@ -574,7 +860,11 @@ def attention_layer(from_tensor,
                     do_return_2d_tensor=False,
                     batch_size=None,
                     from_seq_length=None,
-                    to_seq_length=None):
+                    to_seq_length=None,
+                    fused_qkv=False,
+                    attention_block_size=None,
+                    token_indices=None,
+                    int8_inference=False):
   """Performs multi-headed attention from `from_tensor` to `to_tensor`.
 
   This is an implementation of multi-headed attention based on "Attention
@@ -621,6 +911,16 @@ def attention_layer(from_tensor,
       of the 3D version of the `from_tensor`.
     to_seq_length: (Optional) If the input is 2D, this might be the seq length
       of the 3D version of the `to_tensor`.
+    fused_qkv: (Optional) bool. Whether to compute the query, key and value
+      projections with one "qkv" dense layer. Only for self-attention, i.e.
+      if `from_tensor` is `to_tensor`.
+    attention_block_size: (Optional) int. If set, see `blockwise_attention`.
+    token_indices: (Optional) int32 Tensor of shape [num_tokens, 1]. If set,
+      `from_tensor` and `to_tensor` only hold the rows at these indices of
+      their [batch_size * seq_length, width] forms, e.g. the tokens that are
+      not padding, and so does the output. Requires `do_return_2d_tensor`.
+    int8_inference: (Optional) bool. Whether the projections are int8
+      `dense_layer`s.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length,
@@ -647,6 +947,12 @@ def attention_layer(from_tensor,
     raise ValueError(
         "The rank of `from_tensor` must match the rank of `to_tensor`.")
 
+  if fused_qkv and from_tensor is not to_tensor:
+    raise ValueError("`fused_qkv` is only supported for self-attention.")
+
+  if token_indices is not None and not do_return_2d_tensor:
+    raise ValueError("`token_indices` requires `do_return_2d_tensor`.")
+
   if len(from_shape) == 3:
     batch_size = from_shape[0]
     from_seq_length = from_shape[1]
@@ -668,29 +974,60 @@ def attention_layer(from_tensor,
   from_tensor_2d = reshape_to_matrix(from_tensor)
   to_tensor_2d = reshape_to_matrix(to_tensor)
 
-  # `query_layer` = [B*F, N*H]
-  query_layer = tf.compat.v1.layers.dense(
-      from_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=query_act,
-      name="query",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `key_layer` = [B*T, N*H]
-  key_layer = tf.compat.v1.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=key_act,
-      name="key",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `value_layer` = [B*T, N*H]
-  value_layer = tf.compat.v1.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=value_act,
-      name="value",
-      kernel_initializer=create_initializer(initializer_range))
+  if fused_qkv:
+    # `qkv_layer` = [B*F, 3*N*H]
+    qkv_layer = dense_layer(
+        from_tensor_2d,
+        3 * num_attention_heads * size_per_head,
+        name="qkv",
+        kernel_initializer=create_initializer(initializer_range),
+        int8_inference=int8_inference)
+
+    # `query_layer`, `key_layer`, `value_layer` = [B*F, N*H]
+    (query_layer, key_layer, value_layer) = tf.split(qkv_layer, 3, axis=-1)
+    if query_act is not None:
+      query_layer = query_act(query_layer)
+    if key_act is not None:
+      key_layer = key_act(key_layer)
+    if value_act is not None:
+      value_layer = value_act(value_layer)
+  else:
+    # `query_layer` = [B*F, N*H]
+    query_layer = dense_layer(
+        from_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=query_act,
+        name="query",
+        kernel_initializer=create_initializer(initializer_range),
+        int8_inference=int8_inference)
+
+    # `key_layer` = [B*T, N*H]
+    key_layer = dense_layer(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=key_act,
+        name="key",
+        kernel_initializer=create_initializer(initializer_range),
+        int8_inference=int8_inference)
+
+    # `value_layer` = [B*T, N*H]
+    value_layer = dense_layer(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=value_act,
+        name="value",
+        kernel_initializer=create_initializer(initializer_range),
+        int8_inference=int8_inference)
+
+  if token_indices is not None:
+    # The projections of the padding, which is masked out of the attention,
+    # are zero.
+    query_layer = restore_padding(query_layer, token_indices,
+                                  batch_size * from_seq_length)
+    key_layer = restore_padding(key_layer, token_indices,
+                                batch_size * to_seq_length)
+    value_layer = restore_padding(value_layer, token_indices,
+                                  batch_size * to_seq_length)
 
   # `query_layer` = [B, N, F, H]
   query_layer = transpose_for_scores(query_layer, batch_size,
@@ -701,12 +1038,69 @@ def attention_layer(from_tensor,
   key_layer = transpose_for_scores(key_layer, batch_size, num_attention_heads,
                                    to_seq_length, size_per_head)
 
+  # `value_layer` = [B, N, T, H]
+  value_layer = transpose_for_scores(value_layer, batch_size,
+                                     num_attention_heads, to_seq_length,
+                                     size_per_head)
+
+  if attention_block_size:
+    # `context_layer` = [B, N, F, H]
+    context_layer = blockwise_attention(
+        query_layer, key_layer, value_layer, attention_block_size,
+        attention_mask=attention_mask,
+        attention_probs_dropout_prob=attention_probs_dropout_prob)
+  else:
+    context_layer = dense_attention(
+        query_layer, key_layer, value_layer,
+        attention_mask=attention_mask,
+        attention_probs_dropout_prob=attention_probs_dropout_prob)
+
+  # `context_layer` = [B, F, N, H]
+  context_layer = tf.transpose(a=context_layer, perm=[0, 2, 1, 3])
+
+  if do_return_2d_tensor:
+    # `context_layer` = [B*F, N*H]
+    context_layer = tf.reshape(
+        context_layer,
+        [batch_size * from_seq_length, num_attention_heads * size_per_head])
+    if token_indices is not None:
+      context_layer = tf.gather_nd(context_layer, token_indices)
+  else:
+    # `context_layer` = [B, F, N*H]
+    context_layer = tf.reshape(
+        context_layer,
+        [batch_size, from_seq_length, num_attention_heads * size_per_head])
+
+  return context_layer
+
+
+def dense_attention(query_layer, key_layer, value_layer, attention_mask=None,
+                    attention_probs_dropout_prob=0.0):
+  """Scaled dot-product attention over the full [B, N, F, T] score matrix.
+
+  Args:
+    query_layer: float Tensor of shape [B, N, F, H].
+    key_layer: float Tensor of shape [B, N, T, H].
+    value_layer: float Tensor of shape [B, N, T, H].
+    attention_mask: (optional) int32 Tensor of shape [B, F, T], with 1 for
+      the positions that can be attended to and 0 for the others.
+    attention_probs_dropout_prob: (optional) float. Dropout probability of the
+      attention probabilities.
+
+  Returns:
+    float Tensor of shape [B, N, F, H].
+  """
+  size_per_head = get_shape_list(query_layer, expected_rank=4)[3]
+
   # Take the dot product between "query" and "key" to get the raw
   # attention scores.
   # `attention_scores` = [B, N, F, T]
   attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
   attention_scores = tf.multiply(attention_scores,
                                  1.0 / math.sqrt(float(size_per_head)))
+  # The mask and the softmax are applied in float32 for mixed precision.
+  compute_type = attention_scores.dtype
+  attention_scores = tf.cast(attention_scores, tf.float32)
 
   if attention_mask is not None:
     # `attention_mask` = [B, 1, F, T]
@@ -723,42 +1117,170 @@ def attention_layer(from_tensor,
 
   # Normalize the attention scores to probabilities.
   # `attention_probs` = [B, N, F, T]
-  attention_probs = tf.nn.softmax(attention_scores)
+  attention_probs = tf.cast(tf.nn.softmax(attention_scores), compute_type)
 
   # This is actually dropping out entire tokens to attend to, which might
   # seem a bit unusual, but is taken from the original Transformer paper.
   attention_probs = dropout(attention_probs, attention_probs_dropout_prob)
 
-  # `value_layer` = [B, T, N, H]
-  value_layer = tf.reshape(
-      value_layer,
-      [batch_size, to_seq_length, num_attention_heads, size_per_head])
+  # `context_layer` = [B, N, F, H]
+  return tf.matmul(attention_probs, value_layer)
 
-  # `value_layer` = [B, N, T, H]
-  value_layer = tf.transpose(a=value_layer, perm=[0, 2, 1, 3])
+
+def blockwise_attention(query_layer, key_layer, value_layer, block_size,
+                        attention_mask=None, attention_probs_dropout_prob=0.0):
+  """Computes `dense_attention` one block of keys and values at a time.
+
+  The blocks are visited in a `tf.while_loop`, which keeps a running maximum
+  and sum of the exponentiated scores of every query (an "online softmax").
+  Only a [B, N, F, block_size] slice of the scores exists at any time.
+  During training, the loop still keeps the probabilities of every block for
+  the backward pass.
+
+  Args:
+    query_layer: float Tensor of shape [B, N, F, H].
+    key_layer: float Tensor of shape [B, N, T, H].
+    value_layer: float Tensor of shape [B, N, T, H].
+    block_size: int. The number of keys and values in each block. `T` is
+      padded to a multiple of it.
+    attention_mask: (optional) int32 Tensor of shape [B, F, T], with 1 for
+      the positions that can be attended to and 0 for the others.
+    attention_probs_dropout_prob: (optional) float. Dropout probability of the
+      attention probabilities.
+
+  Returns:
+    float Tensor of shape [B, N, F, H].
+  """
+  (batch_size, num_attention_heads, from_seq_length,
+   size_per_head) = get_shape_list(query_layer, expected_rank=4)
+  to_seq_length = get_shape_list(key_layer, expected_rank=4)[2]
+  compute_type = query_layer.dtype
+
+  if attention_mask is None:
+    attention_mask = tf.ones([batch_size, from_seq_length, to_seq_length],
+                             dtype=tf.int32)
+  pad_length = -to_seq_length % block_size
+  key_layer = tf.pad(key_layer, [[0, 0], [0, 0], [0, pad_length], [0, 0]])
+  value_layer = tf.pad(value_layer, [[0, 0], [0, 0], [0, pad_length], [0, 0]])
+  attention_mask = tf.pad(attention_mask, [[0, 0], [0, 0], [0, pad_length]])
+  # The padding keys get no weight at all, unlike the masked ones, so that
+  # queries which are masked from every key still average over exactly `T`
+  # values as in `dense_attention`. The last block always has a real key.
+  padding_adder = tf.pad(tf.zeros([to_seq_length]), [[0, pad_length]],
+                         constant_values=-1e9)
+  num_blocks = (to_seq_length + pad_length) // block_size
+
+  def body(i, max_score, sum_exp, context_layer):
+    """Adds the `i`-th block of keys and values to the running softmax."""
+    start = i * block_size
+    # `key_block` = [B, N, block_size, H]
+    key_block = key_layer[:, :, start:start + block_size]
+    value_block = value_layer[:, :, start:start + block_size]
+    # `mask_block` = [B, 1, F, block_size]
+    mask_block = tf.expand_dims(
+        attention_mask[:, :, start:start + block_size], axis=[1])
+
+    # `scores` = [B, N, F, block_size]
+    scores = tf.matmul(query_layer, key_block, transpose_b=True)
+    scores = tf.multiply(scores, 1.0 / math.sqrt(float(size_per_head)))
+    scores = tf.cast(scores, tf.float32)
+    scores += (1.0 - tf.cast(mask_block, tf.float32)) * -10000.0
+    scores += padding_adder[start:start + block_size]
+
+    next_max_score = tf.maximum(
+        max_score, tf.reduce_max(input_tensor=scores, axis=-1, keepdims=True))
+    # Rescales what was summed so far to the new maximum.
+    correction = tf.exp(max_score - next_max_score)
+    exp_scores = tf.exp(scores - next_max_score)
+    sum_exp = sum_exp * correction + tf.reduce_sum(
+        input_tensor=exp_scores, axis=-1, keepdims=True)
+
+    # Dropout of the normalized probabilities is the same as dropout of
+    # `exp_scores`, as both are elementwise.
+    exp_scores = dropout(tf.cast(exp_scores, compute_type),
+                         attention_probs_dropout_prob, step=i)
+    context_layer = context_layer * correction + tf.cast(
+        tf.matmul(exp_scores, value_block), tf.float32)
+    return (i + 1, next_max_score, sum_exp, context_layer)
+
+  (_, _, sum_exp, context_layer) = tf.while_loop(
+      cond=lambda i, *_: i < num_blocks,
+      body=body,
+      loop_vars=(tf.constant(0),
+                 tf.fill([batch_size, num_attention_heads, from_seq_length, 1],
+                         float("-inf")),
+                 tf.zeros([batch_size, num_attention_heads, from_seq_length,
+                           1]),
+                 tf.zeros([batch_size, num_attention_heads, from_seq_length,
+                           size_per_head])),
+      parallel_iterations=1)
 
   # `context_layer` = [B, N, F, H]
-  context_layer = tf.matmul(attention_probs, value_layer)
+  return tf.cast(context_layer / sum_exp, compute_type)
 
-  # `context_layer` = [B, F, N, H]
-  context_layer = tf.transpose(a=context_layer, perm=[0, 2, 1, 3])
 
-  if do_return_2d_tensor:
-    # `context_layer` = [B*F, N*H]
-    context_layer = tf.reshape(
-        context_layer,
-        [batch_size * from_seq_length, num_attention_heads * size_per_head])
-  else:
-    # `context_layer` = [B, F, N*H]
-    context_layer = tf.reshape(
-        context_layer,
-        [batch_size, from_seq_length, num_attention_heads * size_per_head])
+@contextlib.contextmanager
+def _stateless_dropout(seed):
+  """Makes `dropout` draw its masks from `seed` in the order of the calls."""
+  _dropout_seeds.append([seed, 0])
+  try:
+    yield
+  finally:
+    _dropout_seeds.pop()
 
-  return context_layer
+
+def recompute_grad(layer_fn):
+  """Wraps `layer_fn` to recompute its activations in the backward pass.
+
+  The intermediate activations of `layer_fn` are only used in the forward pass.
+  The gradient runs `layer_fn` again on the same input, in the same variable
+  scope with reuse and with the same dropout masks, and backpropagates through
+  the recomputation. This trades a second forward pass for the memory of the
+  activations.
+
+  Args:
+    layer_fn: Function from a float Tensor to a float Tensor. It is called in
+      the variable scope of the layer, and all the trainable variables that it
+      uses must be in that scope.
+
+  Returns:
+    A function that computes the same as `layer_fn`.
+  """
+
+  def wrapped_fn(layer_input):
+    scope = tf.compat.v1.get_variable_scope()
+    seed = tf.random.uniform([2], maxval=tf.int64.max, dtype=tf.int64)
+    with _stateless_dropout(seed):
+      layer_output = layer_fn(layer_input)
+    variables = tf.compat.v1.trainable_variables(scope.name + "/")
+
+    @tf.custom_gradient
+    def recompute(layer_input, *unused_variable_values):
+      """Returns `layer_output`, with gradients through a recomputation."""
+
+      def grad_fn(output_grad):
+        # The control dependency keeps the recomputation from running before
+        # the backward pass reaches this layer.
+        with tf.control_dependencies([output_grad]):
+          recompute_input = tf.identity(layer_input)
+        with tf.compat.v1.variable_scope(scope, reuse=True):
+          with _stateless_dropout(seed):
+            recomputed_output = layer_fn(recompute_input)
+        return tf.gradients(
+            ys=recomputed_output,
+            xs=[recompute_input] + variables,
+            grad_ys=output_grad)
+
+      return tf.identity(tf.stop_gradient(layer_output)), grad_fn
+
+    return recompute(layer_input, *variables)
+
+  return wrapped_fn
 
 
 def transformer_model(input_tensor,
                       attention_mask=None,
+                      input_mask=None,
                       hidden_size=768,
                       num_hidden_layers=12,
                       num_attention_heads=12,
@@ -767,7 +1289,11 @@ def transformer_model(input_tensor,
                       hidden_dropout_prob=0.1,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
-                      do_return_all_layers=False):
+                      do_return_all_layers=False,
+                      fused_qkv=False,
+                      attention_block_size=None,
+                      recompute_layers=False,
+                      int8_inference=False):
   """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
   This is almost an exact implementation of the original Transformer encoder.
@@ -783,6 +1309,9 @@ def transformer_model(input_tensor,
     attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length,
       seq_length], with 1 for positions that can be attended to and 0 in
       positions that should not be.
+    input_mask: (optional) int32 Tensor of shape [batch_size, seq_length]. If
+      set, the layers only run on the tokens where it is non-zero, and the
+      outputs are zero at the other positions.
     hidden_size: int. Hidden size of the Transformer.
     num_hidden_layers: int. Number of layers (blocks) in the Transformer.
     num_attention_heads: int. Number of attention heads in the Transformer.
@@ -797,6 +1326,13 @@ def transformer_model(input_tensor,
       normal).
     do_return_all_layers: Whether to also return all layers or just the final
       layer.
+    fused_qkv: Whether to compute the query, key and value projections of the
+      self-attention layers with a single matmul.
+    attention_block_size: (optional) int. If set, the attention is computed
+      with `blockwise_attention` in blocks of this many keys and values.
+    recompute_layers: Whether to recompute the activations of each layer in
+      the backward pass with `recompute_grad`.
+    int8_inference: Whether the dense layers are int8 `dense_layer`s.
 
   Returns:
     float Tensor of shape [batch_size, seq_length, hidden_size], the final
@@ -828,64 +1364,93 @@ def transformer_model(input_tensor,
   # help the optimizer.
   prev_output = reshape_to_matrix(input_tensor)
 
+  token_indices = None
+  if input_mask is not None:
+    # `token_indices` = [num_tokens, 1]
+    token_indices = tf.cast(
+        tf.compat.v1.where(tf.reshape(input_mask, [-1]) > 0), tf.int32)
+    # `prev_output` = [num_tokens, hidden_size]
+    prev_output = tf.gather_nd(prev_output, token_indices)
+
+  def transformer_layer(layer_input):
+    """Runs one layer of the Transformer in the current variable scope."""
+    with tf.compat.v1.variable_scope("attention"):
+      attention_heads = []
+      with tf.compat.v1.variable_scope("self"):
+        attention_head = attention_layer(
+            from_tensor=layer_input,
+            to_tensor=layer_input,
+            attention_mask=attention_mask,
+            num_attention_heads=num_attention_heads,
+            size_per_head=attention_head_size,
+            attention_probs_dropout_prob=attention_probs_dropout_prob,
+            initializer_range=initializer_range,
+            do_return_2d_tensor=True,
+            batch_size=batch_size,
+            from_seq_length=seq_length,
+            to_seq_length=seq_length,
+            fused_qkv=fused_qkv,
+            attention_block_size=attention_block_size,
+            token_indices=token_indices,
+            int8_inference=int8_inference)
+        attention_heads.append(attention_head)
+
+      attention_output = None
+      if len(attention_heads) == 1:
+        attention_output = attention_heads[0]
+      else:
+        # In the case where we have other sequences, we just concatenate
+        # them to the self-attention head before the projection.
+        attention_output = tf.concat(attention_heads, axis=-1)
+
+      # Run a linear projection of `hidden_size` then add a residual
+      # with `layer_input`.
+      with tf.compat.v1.variable_scope("output"):
+        attention_output = dense_layer(
+            attention_output,
+            hidden_size,
+            kernel_initializer=create_initializer(initializer_range),
+            int8_inference=int8_inference)
+        attention_output = dropout(attention_output, hidden_dropout_prob)
+        attention_output = layer_norm(attention_output + layer_input)
+
+    # The activation is only applied to the "intermediate" hidden layer.
+    with tf.compat.v1.variable_scope("intermediate"):
+      intermediate_output = dense_layer(
+          attention_output,
+          intermediate_size,
+          activation=intermediate_act_fn,
+          kernel_initializer=create_initializer(initializer_range),
+          int8_inference=int8_inference)
+
+    # Down-project back to `hidden_size` then add the residual.
+    with tf.compat.v1.variable_scope("output"):
+      layer_output = dense_layer(
+          intermediate_output,
+          hidden_size,
+          kernel_initializer=create_initializer(initializer_range),
+          int8_inference=int8_inference)
+      layer_output = dropout(layer_output, hidden_dropout_prob)
+      layer_output = layer_norm(layer_output + attention_output)
+    return layer_output
+
+  if recompute_layers:
+    transformer_layer = recompute_grad(transformer_layer)
+
   all_layer_outputs = []
   for layer_idx in range(num_hidden_layers):
     with tf.compat.v1.variable_scope("layer_%d" % layer_idx):
-      layer_input = prev_output
-
-      with tf.compat.v1.variable_scope("attention"):
-        attention_heads = []
-        with tf.compat.v1.variable_scope("self"):
-          attention_head = attention_layer(
-              from_tensor=layer_input,
-              to_tensor=layer_input,
-              attention_mask=attention_mask,
-              num_attention_heads=num_attention_heads,
-              size_per_head=attention_head_size,
-              attention_probs_dropout_prob=attention_probs_dropout_prob,
-              initializer_range=initializer_range,
-              do_return_2d_tensor=True,
-              batch_size=batch_size,
-              from_seq_length=seq_length,
-              to_seq_length=seq_length)
-          attention_heads.append(attention_head)
-
-        attention_output = None
-        if len(attention_heads) == 1:
-          attention_output = attention_heads[0]
-        else:
-          # In the case where we have other sequences, we just concatenate
-          # them to the self-attention head before the projection.
-          attention_output = tf.concat(attention_heads, axis=-1)
-
-        # Run a linear projection of `hidden_size` then add a residual
-        # with `layer_input`.
-        with tf.compat.v1.variable_scope("output"):
-          attention_output = tf.compat.v1.layers.dense(
-              attention_output,
-              hidden_size,
-              kernel_initializer=create_initializer(initializer_range))
-          attention_output = dropout(attention_output, hidden_dropout_prob)
-          attention_output = layer_norm(attention_output + layer_input)
-
-      # The activation is only applied to the "intermediate" hidden layer.
-      with tf.compat.v1.variable_scope("intermediate"):
-        intermediate_output = tf.compat.v1.layers.dense(
-            attention_output,
-            intermediate_size,
-            activation=intermediate_act_fn,
-            kernel_initializer=create_initializer(initializer_range))
-
-      # Down-project back to `hidden_size` then add the residual.
-      with tf.compat.v1.variable_scope("output"):
-        layer_output = tf.compat.v1.layers.dense(
-            intermediate_output,
-            hidden_size,
-            kernel_initializer=create_initializer(initializer_range))
-        layer_output = dropout(layer_output, hidden_dropout_prob)
-        layer_output = layer_norm(layer_output + attention_output)
-        prev_output = layer_output
-        all_layer_outputs.append(layer_output)
+      prev_output = transformer_layer(prev_output)
+      all_layer_outputs.append(prev_output)
+
+  if token_indices is not None:
+    if not do_return_all_layers:
+      all_layer_outputs = all_layer_outputs[-1:]
+    all_layer_outputs = [
+        restore_padding(layer_output, token_indices, batch_size * seq_length)
+        for layer_output in all_layer_outputs
+    ]
+    prev_output = all_layer_outputs[-1]
 
   if do_return_all_layers:
     final_outputs = []
@@ -949,6 +1514,12 @@ def reshape_to_matrix(input_tensor):
   return output_tensor
 
 
+def restore_padding(input_tensor, token_indices, num_rows):
+  """Scatters the rows of a matrix to `token_indices` of a zero matrix."""
+  width = input_tensor.shape[-1]
+  return tf.scatter_nd(token_indices, input_tensor, [num_rows, width])
+
+
 def reshape_from_matrix(output_tensor, orig_shape_list):
   """Reshapes a rank 2 tensor back to its original rank >= 2 tensor."""
   if len(orig_shape_list) == 2:
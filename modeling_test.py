@@ -18,10 +18,12 @@ from __future__ import print_function
 
 import collections
 import json
+import os
 import random
 import re
 
 import modeling
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -132,6 +134,332 @@ class BertModelTest(tf.test.TestCase):
     self.assertEqual(obj["vocab_size"], 99)
     self.assertEqual(obj["hidden_size"], 37)
 
+  def test_attention_mask_from_packed_input_mask(self):
+    input_mask = tf.constant([[1, 1, 2, 2, 2, 0]])
+    mask = modeling.create_attention_mask_from_input_mask(
+        input_mask, input_mask, from_mask=input_mask)
+    with self.test_session() as sess:
+      mask = sess.run(mask)
+    self.assertAllEqual(
+        mask[0],
+        [[1, 1, 0, 0, 0, 0],
+         [1, 1, 0, 0, 0, 0],
+         [0, 0, 1, 1, 1, 0],
+         [0, 0, 1, 1, 1, 0],
+         [0, 0, 1, 1, 1, 0],
+         [0, 0, 0, 0, 0, 0]])
+
+  def test_packed_sequences(self):
+    config = modeling.BertConfig(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=37)
+    rng = random.Random(1)
+    sequence_a = [rng.randint(1, 98) for _ in range(4)]
+    sequence_b = [rng.randint(1, 98) for _ in range(5)]
+
+    # The two sequences padded in their own rows, and packed into one row.
+    padded_model = modeling.BertModel(
+        config=config,
+        is_training=False,
+        input_ids=tf.constant([sequence_a + [0] * 6, sequence_b + [0] * 5]),
+        input_mask=tf.constant([[1] * 4 + [0] * 6, [1] * 5 + [0] * 5]),
+        scope="bert")
+    with tf.compat.v1.variable_scope(
+        tf.compat.v1.get_variable_scope(), reuse=True):
+      packed_model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=tf.constant([sequence_a + sequence_b + [0]]),
+          input_mask=tf.constant([[1] * 4 + [2] * 5 + [0]]),
+          scope="bert",
+          position_ids=tf.constant([list(range(4)) + list(range(5)) + [0]]),
+          packed_sequences=True,
+          pooled_positions=tf.constant([[0, 4]]))
+
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      (padded_output, padded_pooled, packed_output, packed_pooled) = sess.run(
+          [padded_model.get_sequence_output(),
+           padded_model.get_pooled_output(),
+           packed_model.get_sequence_output(),
+           packed_model.get_pooled_output()])
+
+    self.assertAllClose(packed_output[0, :4], padded_output[0, :4], atol=1e-5)
+    self.assertAllClose(packed_output[0, 4:9], padded_output[1, :5], atol=1e-5)
+    self.assertAllClose(packed_pooled, padded_pooled, atol=1e-5)
+
+  def test_mixed_precision(self):
+    config = modeling.BertConfig(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=37)
+    input_ids = BertModelTest.ids_tensor([3, 7], 99, rng=random.Random(1))
+    input_mask = tf.constant([[1] * 7, [1] * 5 + [0] * 2, [1] * 3 + [0] * 4])
+
+    float32_model = modeling.BertModel(
+        config=config,
+        is_training=False,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        scope="bert")
+    with tf.compat.v1.variable_scope(
+        tf.compat.v1.get_variable_scope(), reuse=True):
+      float16_model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert",
+          compute_type=tf.float16)
+
+    for variable in tf.compat.v1.trainable_variables():
+      self.assertEqual(variable.dtype.base_dtype, tf.float32)
+    self.assertEqual(float16_model.get_all_encoder_layers()[-1].dtype,
+                     tf.float16)
+    self.assertEqual(float16_model.get_sequence_output().dtype, tf.float32)
+    self.assertEqual(float16_model.get_pooled_output().dtype, tf.float32)
+
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      (float32_output, float32_pooled, float16_output,
+       float16_pooled) = sess.run([
+           float32_model.get_sequence_output(),
+           float32_model.get_pooled_output(),
+           float16_model.get_sequence_output(),
+           float16_model.get_pooled_output()
+       ])
+
+    self.assertAllClose(float16_output, float32_output, atol=1e-2)
+    self.assertAllClose(float16_pooled, float32_pooled, atol=1e-2)
+
+  def test_blockwise_attention(self):
+    input_ids = BertModelTest.ids_tensor([3, 7], 99, rng=random.Random(2))
+    input_mask = tf.constant([[1] * 7, [1] * 5 + [0] * 2, [1] * 3 + [0] * 4])
+    outputs = []
+    for (i, attention_block_size) in enumerate([None, 3]):
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          attention_block_size=attention_block_size)
+      with tf.compat.v1.variable_scope(
+          tf.compat.v1.get_variable_scope(), reuse=i > 0):
+        model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert")
+      sequence_output = model.get_sequence_output()
+      kernel = tf.compat.v1.get_default_graph().get_tensor_by_name(
+          "bert/encoder/layer_0/attention/self/key/kernel:0")
+      outputs.append(
+          [sequence_output,
+           tf.gradients(ys=tf.reduce_sum(input_tensor=sequence_output**2),
+                        xs=kernel)[0]])
+
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      ((dense_output, dense_grad),
+       (blockwise_output, blockwise_grad)) = sess.run(outputs)
+
+    self.assertAllClose(blockwise_output, dense_output, atol=1e-5)
+    self.assertAllClose(blockwise_grad, dense_grad, atol=1e-4)
+
+  def test_fused_qkv(self):
+    init_checkpoint = os.path.join(self.get_temp_dir(), "unfused.ckpt")
+    input_ids = [[31, 51, 99, 5], [15, 5, 0, 0]]
+    input_mask = [[1, 1, 1, 1], [1, 1, 0, 0]]
+
+    def run_model(fused_qkv, init_checkpoint=None):
+      """Returns the sequence output, and saves or restores a checkpoint."""
+      config = modeling.BertConfig(
+          vocab_size=100,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          fused_qkv=fused_qkv)
+      with tf.Graph().as_default(), self.session() as sess:
+        # Keeps the names of the layer normalization layers the same in both
+        # graphs.
+        tf.keras.backend.reset_uids()
+        model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=tf.constant(input_ids),
+            input_mask=tf.constant(input_mask))
+        tvars = tf.compat.v1.trainable_variables()
+        if init_checkpoint:
+          (assignment_map, initialized_variable_names
+          ) = modeling.get_assignment_map_from_checkpoint(
+              tvars, init_checkpoint)
+          tf.compat.v1.train.init_from_checkpoint(init_checkpoint,
+                                                  assignment_map)
+          self.assertCountEqual(
+              [x.name for x in tvars if x.name in initialized_variable_names],
+              [x.name for x in tvars])
+        sess.run(tf.compat.v1.global_variables_initializer())
+        if not init_checkpoint:
+          tf.compat.v1.train.Saver().save(
+              sess, os.path.join(self.get_temp_dir(), "unfused.ckpt"))
+        return (sess.run(model.get_sequence_output()),
+                [x.name for x in tvars])
+
+    (unfused_output, unfused_names) = run_model(fused_qkv=False)
+    (fused_output, fused_names) = run_model(
+        fused_qkv=True, init_checkpoint=init_checkpoint)
+
+    self.assertIn("bert/encoder/layer_0/attention/self/query/kernel:0",
+                  unfused_names)
+    self.assertIn("bert/encoder/layer_0/attention/self/qkv/kernel:0",
+                  fused_names)
+    self.assertLess(len(fused_names), len(unfused_names))
+    self.assertAllClose(fused_output, unfused_output, atol=1e-5)
+
+  def test_assignment_map_from_checkpoint(self):
+    init_checkpoint = os.path.join(self.get_temp_dir(), "model.ckpt")
+    with tf.Graph().as_default(), self.session() as sess:
+      kernel = tf.compat.v1.get_variable("kernel", [2, 3])
+      int8_kernel = tf.compat.v1.get_variable(
+          "int8_kernel", [2, 3], dtype=tf.int8,
+          initializer=tf.compat.v1.zeros_initializer(), trainable=False,
+          collections=[tf.compat.v1.GraphKeys.GLOBAL_VARIABLES,
+                       tf.compat.v1.GraphKeys.MODEL_VARIABLES])
+      sess.run(tf.compat.v1.global_variables_initializer())
+      tf.compat.v1.train.Saver().save(sess, init_checkpoint)
+
+      # Only the given variables are mapped, even if the checkpoint has other
+      # variables of the graph.
+      (assignment_map, initialized_variable_names
+      ) = modeling.get_assignment_map_from_checkpoint([kernel],
+                                                      init_checkpoint)
+      self.assertEqual(assignment_map, {"kernel": kernel})
+      self.assertCountEqual(initialized_variable_names, ["kernel", "kernel:0"])
+
+      (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+          [kernel, int8_kernel], init_checkpoint)
+      self.assertEqual(assignment_map,
+                       {"kernel": kernel, "int8_kernel": int8_kernel})
+
+  def test_recompute_layers(self):
+    input_ids = BertModelTest.ids_tensor([3, 7], 99, rng=random.Random(3))
+    input_mask = tf.constant([[1] * 7, [1] * 5 + [0] * 2, [1] * 3 + [0] * 4])
+    projection = tf.random.normal([3, 7, 32], seed=4)
+    results = []
+    for (i, recompute_layers) in enumerate([False, True]):
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          hidden_dropout_prob=0.0,
+          attention_probs_dropout_prob=0.0,
+          recompute_layers=recompute_layers)
+      with tf.compat.v1.variable_scope(
+          tf.compat.v1.get_variable_scope(), reuse=i > 0):
+        model = modeling.BertModel(
+            config=config,
+            is_training=True,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert")
+      loss = tf.reduce_sum(input_tensor=model.get_sequence_output() *
+                           projection)
+      tvars = [x for x in tf.compat.v1.trainable_variables()
+               if "pooler" not in x.name]
+      grads = [tf.convert_to_tensor(x)
+               for x in tf.gradients(ys=loss, xs=tvars)]
+      results.append([loss] + grads)
+
+    # Both models share their variables, the layer normalization included.
+    self.assertLen(tvars, 5 + 2 * 16)
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      (expected, actual) = sess.run(results)
+
+    for (x, y) in zip(actual, expected):
+      self.assertAllClose(x, y, rtol=1e-4, atol=1e-5)
+
+  def test_remove_padding(self):
+    input_ids = BertModelTest.ids_tensor([3, 7], 99, rng=random.Random(6))
+    input_mask = [[1] * 7, [1] * 5 + [0] * 2, [1] * 3 + [0] * 4]
+    outputs = []
+    for (i, remove_padding) in enumerate([False, True]):
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          remove_padding=remove_padding)
+      with tf.compat.v1.variable_scope(
+          tf.compat.v1.get_variable_scope(), reuse=i > 0):
+        model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=tf.constant(input_mask),
+            scope="bert")
+      outputs.append([model.get_sequence_output(), model.get_pooled_output()])
+
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      ((padded_sequence, padded_pooled),
+       (unpadded_sequence, unpadded_pooled)) = sess.run(outputs)
+
+    is_token = np.array(input_mask, dtype=bool)
+    self.assertAllClose(unpadded_sequence[is_token], padded_sequence[is_token],
+                        atol=1e-5)
+    self.assertAllEqual(unpadded_sequence[~is_token],
+                        np.zeros_like(padded_sequence[~is_token]))
+    self.assertAllClose(unpadded_pooled, padded_pooled, atol=1e-5)
+
+  def test_int8_matmul(self):
+    rng = np.random.RandomState(7)
+    inputs = rng.uniform(-130.0, 130.0, [5, 24]).astype(np.float32)
+    kernel = rng.randint(-127, 128, [24, 9]).astype(np.int8)
+    expected = np.matmul(np.clip(np.round(inputs), -127, 127), kernel)
+    for onednn_enabled in [True, False]:
+      with tf.compat.v1.test.mock.patch.object(
+          modeling, "_onednn_enabled", return_value=onednn_enabled):
+        output = modeling.int8_matmul(tf.constant(inputs), tf.constant(kernel))
+      with self.test_session() as sess:
+        self.assertAllEqual(sess.run(output), expected)
+
+  def test_recompute_grad_dropout(self):
+    inputs = tf.random.uniform([50, 8], seed=5)
+
+    def layer_fn(layer_input):
+      scale = tf.compat.v1.get_variable(
+          "scale", [], initializer=tf.compat.v1.ones_initializer())
+      return modeling.dropout(layer_input * scale, 0.5)
+
+    with tf.compat.v1.variable_scope("layer"):
+      outputs = modeling.recompute_grad(layer_fn)(inputs)
+    [scale] = tf.compat.v1.trainable_variables()
+    (scale_grad, input_grad) = tf.gradients(
+        ys=tf.reduce_sum(input_tensor=outputs), xs=[scale, inputs])
+
+    with self.test_session() as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      (inputs, outputs, scale_grad, input_grad) = sess.run(
+          [inputs, outputs, scale_grad, input_grad])
+
+    # The recomputation drops the same values as the forward pass.
+    self.assertAllClose(input_grad, 2.0 * (outputs != 0.0))
+    self.assertAllClose(scale_grad, outputs.sum(), rtol=1e-5)
+    self.assertAllClose(outputs[outputs != 0.0],
+                        2.0 * inputs[outputs != 0.0])
+
   def run_tester(self, tester):
     with self.test_session() as sess:
       ops = tester.create_model()
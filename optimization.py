@@ -19,17 +19,37 @@ from __future__ import division
 from __future__ import print_function
 
 import re
+import numpy as np
 import tensorflow as tf
 tf.compat.v1.disable_resource_variables()
 tf.compat.v1.disable_eager_execution()
+# The optimizers create their slots in `apply_gradients`, which gradient
+# accumulation runs inside a `tf.cond`.
+tf.compat.v1.disable_control_flow_v2()
 
 try:
   import horovod.tensorflow as hvd
 except:
   hvd = None
 
-def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu, use_hvd=False, optimizer_type="adam"):
-  """Creates an optimizer training op."""
+def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu, use_hvd=False, optimizer_type="adam",
+                     gradient_accumulation_steps=1, dynamic_loss_scaling=False,
+                     fused=False):
+  """Creates an optimizer training op.
+
+  With `gradient_accumulation_steps` > 1, the gradients of that many runs of
+  the op are summed into non-trainable variables, and only every last run
+  clips and applies their mean. `global_step`, and so the learning rate
+  schedule, counts the applied updates.
+
+  With `dynamic_loss_scaling`, for float16 models, the gradients are taken of
+  the loss times a `loss_scale` variable so that they do not underflow. An
+  update whose gradients overflow is skipped and halves the scale, which is
+  doubled again after 2000 updates without overflow.
+
+  With `fused`, the "adam" and "lamb" optimizers update all the parameters
+  through a few flat buffers instead of a handful of ops per variable.
+  """
   global_step = tf.compat.v1.train.get_or_create_global_step()
 
   learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
@@ -82,7 +102,8 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
         beta_1=0.9,
         beta_2=0.999,
         epsilon=1e-6,
-        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+        fused=fused)
   elif optimizer_type == "lamb":
     print("Initializing LAMB Optimizer")
     optimizer = LAMBOptimizer(
@@ -91,7 +112,8 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
         beta_1=0.9,
         beta_2=0.999,
         epsilon=1e-6,
-        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+        fused=fused)
   elif optimizer_type == "nadam":
     print("Initializing NADAM Optimizer")
     optimizer = NadamWeightDecayOptimizer(
@@ -119,8 +141,25 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
   if use_tpu:
     optimizer = tf.compat.v1.tpu.CrossShardOptimizer(optimizer)
 
+  loss_scale = None
+  if dynamic_loss_scaling:
+    loss_scale = tf.compat.v1.get_variable(
+        name="loss_scale",
+        shape=[],
+        dtype=tf.float32,
+        trainable=False,
+        initializer=tf.compat.v1.constant_initializer(2.0**15))
+    loss = loss * loss_scale
+
   tvars = tf.compat.v1.trainable_variables()
-  if use_hvd:
+  if gradient_accumulation_steps > 1:
+    # The accumulated gradients are only averaged across workers when they
+    # are applied.
+    grads = unscale_gradients(tf.gradients(ys=loss, xs=tvars), loss_scale)
+    return create_accumulating_train_op(optimizer, grads, tvars, global_step,
+                                        gradient_accumulation_steps, use_hvd,
+                                        loss_scale)
+  elif use_hvd:
     # [HVD] Use distributed optimizer to compute gradients
     grads_and_vars=optimizer.compute_gradients(loss, tvars)
     grads = [grad for grad,var in grads_and_vars]
@@ -129,16 +168,126 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
     # Use standard TF gradients
     grads = tf.gradients(ys=loss, xs=tvars)
 
-  # This is how the model was pre-trained.
-  (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
-  train_op = optimizer.apply_gradients(zip(grads, tvars), global_step=global_step)
+  grads = unscale_gradients(grads, loss_scale)
+  return apply_clipped_gradients(optimizer, grads, tvars, global_step,
+                                 loss_scale)
+
 
-  # Normally the global step update is done inside of `apply_gradients`.
-  # However, `AdamWeightDecayOptimizer` doesn't do this. But if you use
-  # a different optimizer, you should probably take this line out.
-  new_global_step = global_step + 1
-  train_op = tf.group(train_op, [global_step.assign(new_global_step)])
-  return train_op
+def apply_clipped_gradients(optimizer, grads, tvars, global_step,
+                            loss_scale=None):
+  """Clips `grads` by their global norm and applies them.
+
+  With a `loss_scale`, an update with non-finite gradients is skipped, and
+  the scale is updated either way.
+  """
+  # This is how the model was pre-trained.
+  (grads, global_norm) = tf.clip_by_global_norm(grads, clip_norm=1.0)
+
+  def apply_gradients():
+    train_op = optimizer.apply_gradients(
+        zip(grads, tvars), global_step=global_step)
+
+    # Normally the global step update is done inside of `apply_gradients`.
+    # However, `AdamWeightDecayOptimizer` doesn't do this. But if you use
+    # a different optimizer, you should probably take this line out.
+    new_global_step = global_step + 1
+    return tf.group(train_op, [global_step.assign(new_global_step)])
+
+  if loss_scale is None:
+    return apply_gradients()
+
+  is_finite = tf.math.is_finite(global_norm)
+  train_op = tf.cond(pred=is_finite, true_fn=apply_gradients,
+                     false_fn=tf.no_op)
+  # The gradients have been unscaled by the time `train_op` has run.
+  with tf.control_dependencies([train_op]):
+    return tf.group(train_op, update_loss_scale(loss_scale, is_finite))
+
+
+def unscale_gradients(grads, loss_scale):
+  """Divides the gradients of a scaled loss by `loss_scale`."""
+  if loss_scale is None:
+    return grads
+  unscaled_grads = []
+  for grad in grads:
+    if grad is None:
+      unscaled_grads.append(None)
+    elif isinstance(grad, tf.IndexedSlices):
+      unscaled_grads.append(tf.IndexedSlices(
+          grad.values / loss_scale, grad.indices, grad.dense_shape))
+    else:
+      unscaled_grads.append(grad / loss_scale)
+  return unscaled_grads
+
+
+def update_loss_scale(loss_scale, is_finite, increment_period=2000,
+                      multiplier=2.0):
+  """Halves `loss_scale` on overflow and grows it after stable updates."""
+  good_steps = tf.compat.v1.get_variable(
+      name="loss_scale_good_steps",
+      shape=[],
+      dtype=tf.int32,
+      trainable=False,
+      initializer=tf.compat.v1.zeros_initializer())
+  new_good_steps = tf.where(is_finite, good_steps + 1, 0)
+  should_grow = new_good_steps >= increment_period
+  new_loss_scale = tf.where(
+      is_finite,
+      tf.where(should_grow, loss_scale * multiplier, loss_scale),
+      tf.maximum(loss_scale / multiplier, 1.0))
+  return tf.group(
+      loss_scale.assign(new_loss_scale),
+      good_steps.assign(tf.where(should_grow, 0, new_good_steps)))
+
+
+def create_accumulating_train_op(optimizer, grads, tvars, global_step,
+                                 gradient_accumulation_steps, use_hvd=False,
+                                 loss_scale=None):
+  """Creates a training op which applies the mean of several runs' gradients."""
+  grads_and_vars = [(grad, var) for (grad, var) in zip(grads, tvars)
+                    if grad is not None]
+  accumulation_step = tf.compat.v1.get_variable(
+      name="gradient_accumulation_step",
+      shape=[],
+      dtype=tf.int32,
+      trainable=False,
+      initializer=tf.compat.v1.zeros_initializer())
+  accumulators = []
+  for (_, var) in grads_and_vars:
+    accumulators.append(tf.compat.v1.get_variable(
+        name=re.sub(":\\d+$", "", var.name) + "/accum_grad",
+        shape=var.shape.as_list(),
+        dtype=tf.float32,
+        trainable=False,
+        initializer=tf.compat.v1.zeros_initializer()))
+
+  # The embedding gradients are `IndexedSlices`, which are summed densely.
+  accumulate_ops = [
+      accumulator.assign_add(tf.convert_to_tensor(value=grad))
+      for (accumulator, (grad, _)) in zip(accumulators, grads_and_vars)]
+
+  def apply_accumulated_gradients():
+    grads = [accumulator / gradient_accumulation_steps
+             for accumulator in accumulators]
+    if use_hvd:
+      grads = [hvd.allreduce(grad) for grad in grads]
+    train_op = apply_clipped_gradients(
+        optimizer, grads, [var for (_, var) in grads_and_vars], global_step,
+        loss_scale)
+    with tf.control_dependencies([train_op]):
+      reset_ops = [accumulator.assign(tf.zeros_like(accumulator))
+                   for accumulator in accumulators]
+      return tf.group(reset_ops, accumulation_step.assign(0))
+
+  def count_accumulation_step():
+    return tf.group(accumulation_step.assign_add(1))
+
+  with tf.control_dependencies(accumulate_ops):
+    is_last_step = tf.equal(accumulation_step.read_value(),
+                            gradient_accumulation_steps - 1)
+    return tf.cond(pred=is_last_step,
+                   true_fn=apply_accumulated_gradients,
+                   false_fn=count_accumulation_step)
 
 class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
   """A basic Adam optimizer that includes "correct" L2 weight decay."""
@@ -150,8 +299,14 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
                beta_2=0.999,
                epsilon=1e-6,
                exclude_from_weight_decay=None,
-               name="AdamWeightDecayOptimizer"):
-    """Constructs a AdamWeightDecayOptimizer."""
+               name="AdamWeightDecayOptimizer",
+               fused=False):
+    """Constructs a AdamWeightDecayOptimizer.
+
+    With `fused`, the m/v slots are flat variables, one pair for the
+    parameters with weight decay and one for those without, so checkpoints
+    are not interchangeable with the unfused optimizer.
+    """
     super(AdamWeightDecayOptimizer, self).__init__(False, name)
 
     self.learning_rate = tf.identity(learning_rate, name='learning_rate')
@@ -160,9 +315,12 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
     self.beta_2 = beta_2
     self.epsilon = epsilon
     self.exclude_from_weight_decay = exclude_from_weight_decay
+    self.fused = fused
 
   def apply_gradients(self, grads_and_vars, global_step=None, name=None):
     """See base class."""
+    if self.fused:
+      return self._apply_fused_gradients(grads_and_vars, name)
     assignments = []
     for (grad, param) in grads_and_vars:
       if grad is None or param is None:
@@ -212,6 +370,35 @@ class AdamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
           v.assign(next_v)])
     return tf.group(*assignments, name=name)
 
+  def _apply_fused_gradients(self, grads_and_vars, name=None):
+    """Applies the same update as `apply_gradients` to flat buffers."""
+    assignments = []
+    for (i, (use_weight_decay, grads, params)) in enumerate(
+        group_for_fused_update(self, grads_and_vars)):
+      m = create_flat_slot(self.get_name() + "/adam_m_%d" % i, params)
+      v = create_flat_slot(self.get_name() + "/adam_v_%d" % i, params)
+      # The chunks are updated one after another, so that only one chunk's
+      # flat buffers are in memory at a time.
+      with tf.control_dependencies(assignments):
+        grad = flatten_tensors(grads)
+        param = flatten_tensors(params)
+
+        next_m = (
+          tf.multiply(self.beta_1, m) + tf.multiply(1.0 - self.beta_1, grad))
+        next_v = (
+          tf.multiply(self.beta_2, v) + tf.multiply(1.0 - self.beta_2,
+                                                      tf.square(grad)))
+
+        update = next_m / (tf.sqrt(next_v) + self.epsilon)
+        if use_weight_decay:
+          update += self.weight_decay_rate * param
+
+        next_param = param - self.learning_rate * update
+
+        assignments.extend(assign_flat_tensor(params, next_param))
+        assignments.extend([m.assign(next_m), v.assign(next_v)])
+    return tf.group(*assignments, name=name)
+
   def _do_use_weight_decay(self, param_name):
     """Whether to use L2 weight decay for `param_name`."""
     if not self.weight_decay_rate:
@@ -250,8 +437,14 @@ class LAMBOptimizer(tf.compat.v1.train.Optimizer):
               beta_2=0.999,
               epsilon=1e-6,
               exclude_from_weight_decay=None,
-              name="LAMBOptimizer"):
-    """Constructs a LAMBOptimizer."""
+              name="LAMBOptimizer",
+              fused=False):
+    """Constructs a LAMBOptimizer.
+
+    With `fused`, the m/v slots are flat variables as in
+    `AdamWeightDecayOptimizer`, and the per-tensor trust ratios are computed
+    with segment sums over the flat buffers.
+    """
     super(LAMBOptimizer, self).__init__(False, name)
 
     self.learning_rate = tf.identity(learning_rate, name='learning_rate')
@@ -260,9 +453,12 @@ class LAMBOptimizer(tf.compat.v1.train.Optimizer):
     self.beta_2 = beta_2
     self.epsilon = epsilon
     self.exclude_from_weight_decay = exclude_from_weight_decay
+    self.fused = fused
 
   def apply_gradients(self, grads_and_vars, global_step=None, name=None):
     """See base class."""
+    if self.fused:
+      return self._apply_fused_gradients(grads_and_vars, name)
     assignments = []
     for (grad, param) in grads_and_vars:
       if grad is None or param is None:
@@ -330,6 +526,44 @@ class LAMBOptimizer(tf.compat.v1.train.Optimizer):
            v.assign(next_v)])
     return tf.group(*assignments, name=name)
 
+  def _apply_fused_gradients(self, grads_and_vars, name=None):
+    """Applies the same update as `apply_gradients` to flat buffers."""
+    assignments = []
+    for (i, (use_weight_decay, grads, params)) in enumerate(
+        group_for_fused_update(self, grads_and_vars)):
+      m = create_flat_slot(self.get_name() + "/lamb_m_%d" % i, params)
+      v = create_flat_slot(self.get_name() + "/lamb_v_%d" % i, params)
+      # The chunks are updated one after another, so that only one chunk's
+      # flat buffers are in memory at a time.
+      with tf.control_dependencies(assignments):
+        grad = flatten_tensors(grads)
+        param = flatten_tensors(params)
+
+        next_m = (
+            tf.multiply(self.beta_1, m) + tf.multiply(1.0 - self.beta_1, grad))
+        next_v = (
+            tf.multiply(self.beta_2, v) + tf.multiply(1.0 - self.beta_2,
+                                                      tf.square(grad)))
+
+        update = next_m / (tf.sqrt(next_v) + self.epsilon)
+        if use_weight_decay:
+          update += self.weight_decay_rate * param
+
+        segment_ids = create_segment_ids(params)
+        r1 = tf.sqrt(tf.math.segment_sum(tf.square(param), segment_ids))
+        r2 = tf.sqrt(tf.math.segment_sum(tf.square(update), segment_ids))
+
+        r = tf.compat.v1.where(tf.greater(r1, 0.0), tf.compat.v1.where(
+          tf.greater(r2, 0.0), r1/r2, tf.ones_like(r1)), tf.ones_like(r1))
+
+        eta = self.learning_rate * tf.gather(r, segment_ids)
+
+        next_param = param - eta * update
+
+        assignments.extend(assign_flat_tensor(params, next_param))
+        assignments.extend([m.assign(next_m), v.assign(next_v)])
+    return tf.group(*assignments, name=name)
+
   def _do_use_weight_decay(self, param_name):
     """Whether to use L2 weight decay for `param_name`."""
     if not self.weight_decay_rate:
@@ -346,6 +580,75 @@ class LAMBOptimizer(tf.compat.v1.train.Optimizer):
     if m is not None:
       param_name = m.group(1)
     return param_name
+
+
+def group_for_fused_update(optimizer, grads_and_vars, max_chunk_size=2**25):
+  """Splits `grads_and_vars` into chunks for a fused update.
+
+  The parameters of a chunk either all use weight decay or none does, and
+  hold at most `max_chunk_size` elements unless a single one is larger.
+  Returns a list of `(use_weight_decay, grads, params)` tuples.
+  """
+  groups = {True: [], False: []}
+  for (grad, param) in grads_and_vars:
+    if grad is None or param is None:
+      continue
+    use_weight_decay = optimizer._do_use_weight_decay(
+        optimizer._get_variable_name(param.name))
+    groups[use_weight_decay].append((grad, param))
+
+  chunks = []
+  for (use_weight_decay, group) in groups.items():
+    chunk_size = 0
+    for (grad, param) in group:
+      size = param.shape.num_elements()
+      if not chunks or chunks[-1][0] != use_weight_decay or (
+          chunk_size + size > max_chunk_size):
+        chunks.append((use_weight_decay, [], []))
+        chunk_size = 0
+      chunks[-1][1].append(grad)
+      chunks[-1][2].append(param)
+      chunk_size += size
+  return chunks
+
+
+def create_flat_slot(name, params):
+  """Creates a zero float32 vector with one element for each in `params`."""
+  return tf.compat.v1.get_variable(
+      name=name,
+      shape=[sum(param.shape.num_elements() for param in params)],
+      dtype=tf.float32,
+      trainable=False,
+      initializer=tf.compat.v1.zeros_initializer())
+
+
+def create_segment_ids(params):
+  """Returns the index in `params` of each element of their flat buffer."""
+  sizes = [param.shape.num_elements() for param in params]
+  # Marks the first element of every parameter but the first.
+  starts = tf.scatter_nd(
+      indices=tf.constant([[x] for x in np.cumsum(sizes)[:-1]],
+                          shape=[len(sizes) - 1, 1], dtype=tf.int64),
+      updates=tf.ones([len(sizes) - 1], dtype=tf.int32),
+      shape=[sum(sizes)])
+  return tf.cumsum(starts)
+
+
+def flatten_tensors(tensors):
+  """Concatenates `tensors`, which may be `IndexedSlices`, into a vector."""
+  return tf.concat(
+      [tf.reshape(tf.convert_to_tensor(value=x), [-1]) for x in tensors],
+      axis=0)
+
+
+def assign_flat_tensor(params, flat_tensor):
+  """Returns the ops which assign the pieces of `flat_tensor` to `params`."""
+  pieces = tf.split(flat_tensor,
+                    [param.shape.num_elements() for param in params])
+  return [param.assign(tf.reshape(piece, param.shape))
+          for (param, piece) in zip(params, pieces)]
+
+
 class NadamWeightDecayOptimizer(tf.compat.v1.train.Optimizer):
   """
   Optimizer that implements the Nadam algorithm.  Nadam is Adam with
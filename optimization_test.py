@@ -16,11 +16,43 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+import modeling
 import optimization
+import numpy as np
 import tensorflow as tf
 tf.compat.v1.disable_resource_variables()
 
 
+def _bert_variable_shapes(config):
+  """Returns the names and shapes of the trainable variables of `config`."""
+  hidden_size = config.hidden_size
+  shapes = [
+      ("word_embeddings", [config.vocab_size, hidden_size]),
+      ("token_type_embeddings", [config.type_vocab_size, hidden_size]),
+      ("position_embeddings", [config.max_position_embeddings, hidden_size]),
+      ("embeddings/LayerNorm/gamma", [hidden_size]),
+      ("embeddings/LayerNorm/beta", [hidden_size]),
+  ]
+  for i in range(config.num_hidden_layers):
+    for (name, input_size, output_size) in [
+        ("attention/self/query", hidden_size, hidden_size),
+        ("attention/self/key", hidden_size, hidden_size),
+        ("attention/self/value", hidden_size, hidden_size),
+        ("attention/output/dense", hidden_size, hidden_size),
+        ("intermediate/dense", hidden_size, config.intermediate_size),
+        ("output/dense", config.intermediate_size, hidden_size)]:
+      shapes.append(("layer_%d/%s/kernel" % (i, name),
+                     [input_size, output_size]))
+      shapes.append(("layer_%d/%s/bias" % (i, name), [output_size]))
+    for name in ["attention/output/LayerNorm", "output/LayerNorm"]:
+      shapes.append(("layer_%d/%s/gamma" % (i, name), [hidden_size]))
+      shapes.append(("layer_%d/%s/beta" % (i, name), [hidden_size]))
+  shapes.append(("pooler/dense/kernel", [hidden_size, hidden_size]))
+  shapes.append(("pooler/dense/bias", [hidden_size]))
+  return shapes
+
+
 class OptimizationTest(tf.test.TestCase):
 
   def test_adam(self):
@@ -44,6 +76,150 @@ class OptimizationTest(tf.test.TestCase):
       w_np = sess.run(w)
       self.assertAllClose(w_np.flat, [0.4, 0.2, -0.5], rtol=1e-2, atol=1e-2)
 
+  def _train(self, batches, gradient_accumulation_steps):
+    """Returns `w` and the global step after one run per batch."""
+    with tf.Graph().as_default(), self.session() as sess:
+      w = tf.compat.v1.get_variable(
+          "w",
+          shape=[3],
+          initializer=tf.compat.v1.constant_initializer([0.1, -0.2, -0.1]))
+      x = tf.compat.v1.placeholder(tf.float32, shape=[None, 3])
+      loss = tf.reduce_mean(input_tensor=tf.square(x - w))
+      # A long schedule, so that the learning rate is about the same whether
+      # or not it sees the global step increment of the same run.
+      train_op = optimization.create_optimizer(
+          loss, 0.1, 10**9, 0, False,
+          gradient_accumulation_steps=gradient_accumulation_steps)
+      sess.run(tf.compat.v1.global_variables_initializer())
+      for batch in batches:
+        sess.run(train_op, feed_dict={x: batch})
+      return sess.run([w, tf.compat.v1.train.get_global_step()])
+
+  def test_gradient_accumulation(self):
+    micro_batches = [[[0.4, 0.2, -0.5]], [[0.3, -0.1, 0.2]],
+                     [[-0.2, 0.5, 0.1]], [[0.1, 0.1, 0.1]]]
+    (w_accumulated, step_accumulated) = self._train(micro_batches, 2)
+    (w_full, step_full) = self._train(
+        [micro_batches[0] + micro_batches[1],
+         micro_batches[2] + micro_batches[3]], 1)
+    self.assertEqual(step_accumulated, 2)
+    self.assertEqual(step_full, 2)
+    self.assertAllClose(w_accumulated, w_full)
+
+  def test_dynamic_loss_scaling(self):
+    with self.session() as sess:
+      w = tf.compat.v1.get_variable(
+          "w",
+          shape=[3],
+          initializer=tf.compat.v1.constant_initializer([0.1, -0.2, -0.1]))
+      x = tf.compat.v1.placeholder(tf.float32, shape=[3])
+      loss = tf.reduce_mean(input_tensor=tf.square(x - w))
+      train_op = optimization.create_optimizer(
+          loss, 0.1, 100, 0, False, dynamic_loss_scaling=True)
+      global_step = tf.compat.v1.train.get_global_step()
+      [loss_scale] = [x for x in tf.compat.v1.global_variables()
+                      if x.op.name == "loss_scale"]
+      sess.run(tf.compat.v1.global_variables_initializer())
+
+      # An overflow skips the update and halves the scale.
+      sess.run(train_op, feed_dict={x: [float("inf"), 0.2, -0.5]})
+      self.assertAllClose(sess.run(w), [0.1, -0.2, -0.1])
+      self.assertEqual(sess.run(global_step), 0)
+      self.assertEqual(sess.run(loss_scale), 2.0**14)
+
+      sess.run(train_op, feed_dict={x: [0.4, 0.2, -0.5]})
+      self.assertNotAllClose(sess.run(w), [0.1, -0.2, -0.1])
+      self.assertEqual(sess.run(global_step), 1)
+      self.assertEqual(sess.run(loss_scale), 2.0**14)
+
+  def _run_optimizer(self, optimizer_class, fused):
+    """Returns the variables after a few steps of `optimizer_class`."""
+    with tf.Graph().as_default(), self.session() as sess:
+      rng = np.random.RandomState(1)
+      initial_values = [
+          ("layer/kernel", rng.uniform(-0.1, 0.1, [4, 3])),
+          ("layer/bias", rng.uniform(-0.1, 0.1, [3])),
+          ("LayerNorm/gamma", rng.uniform(0.9, 1.1, [3])),
+          # Covers the trust ratio of a parameter and update with zero norm.
+          ("unused/kernel", np.zeros([2, 2])),
+      ]
+      params = [
+          tf.compat.v1.get_variable(name, initializer=value.astype(np.float32))
+          for (name, value) in initial_values]
+      # The gradients are fed, as they would otherwise read the variables
+      # while they are being updated.
+      grads = [tf.compat.v1.placeholder(tf.float32, shape=value.shape)
+               for (_, value) in initial_values]
+      optimizer = optimizer_class(
+          learning_rate=0.01,
+          weight_decay_rate=0.01,
+          exclude_from_weight_decay=["LayerNorm", "bias"],
+          fused=fused)
+      train_op = optimizer.apply_gradients(zip(grads, params))
+      sess.run(tf.compat.v1.global_variables_initializer())
+      for _ in range(5):
+        feed_dict = {grad: rng.uniform(-1.0, 1.0, grad.shape)
+                     for grad in grads[:3]}
+        feed_dict[grads[3]] = np.zeros([2, 2])
+        sess.run(train_op, feed_dict=feed_dict)
+      return sess.run(params)
+
+  def test_fused_update(self):
+    for optimizer_class in [optimization.AdamWeightDecayOptimizer,
+                            optimization.LAMBOptimizer]:
+      expected = self._run_optimizer(optimizer_class, fused=False)
+      actual = self._run_optimizer(optimizer_class, fused=True)
+      for (x, y) in zip(actual, expected):
+        self.assertAllClose(x, y, rtol=1e-5, atol=1e-6)
+
+
+class OptimizationBenchmark(tf.test.Benchmark):
+
+  def _run_benchmark(self, name, config, optimizer_class, fused, iters=10):
+    with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+      params = [
+          tf.compat.v1.get_variable(
+              name, shape, initializer=tf.compat.v1.zeros_initializer())
+          for (name, shape) in _bert_variable_shapes(config)]
+      grads = [param + 1e-3 for param in params]
+      optimizer = optimizer_class(
+          learning_rate=1e-4,
+          weight_decay_rate=0.01,
+          exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+          fused=fused)
+      train_op = optimizer.apply_gradients(zip(grads, params))
+      sess.run(tf.compat.v1.global_variables_initializer())
+      sess.run(train_op)
+      start = time.time()
+      for _ in range(iters):
+        sess.run(train_op)
+      wall_time = (time.time() - start) / iters
+      self.report_benchmark(
+          iters=iters,
+          wall_time=wall_time,
+          name=name,
+          extras={"num_ops": len(sess.graph.get_operations())})
+
+  def benchmark_fused_update(self):
+    configs = [
+        ("base", modeling.BertConfig(vocab_size=30522)),
+        ("large", modeling.BertConfig(
+            vocab_size=30522,
+            hidden_size=1024,
+            num_hidden_layers=24,
+            num_attention_heads=16,
+            intermediate_size=4096)),
+    ]
+    for (config_name, config) in configs:
+      for (optimizer_name, optimizer_class) in [
+          ("adam", optimization.AdamWeightDecayOptimizer),
+          ("lamb", optimization.LAMBOptimizer)]:
+        for fused in [False, True]:
+          self._run_benchmark(
+              "%s_%s%s" % (config_name, optimizer_name,
+                           "_fused" if fused else ""),
+              config, optimizer_class, fused)
+
 
 if __name__ == "__main__":
   tf.test.main()
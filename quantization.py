@@ -0,0 +1,118 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Post-training int8 quantization of the dense layers of the encoder."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import numpy as np
+import tensorflow as tf
+
+# The kernels of the dense layers of the encoder, which are quantized.
+_DENSE_KERNEL_RE = re.compile("^bert/encoder/layer_\\d+/.*/kernel$")
+
+
+def quantize_dense_layer(kernel, input_max, smoothing_alpha):
+  """Quantizes the kernel of a dense layer for `modeling.dense_layer`.
+
+  Args:
+    kernel: float numpy array of shape [width, units].
+    input_max: float numpy array of shape [width]. The largest absolute value
+      of each input channel on the calibration data.
+    smoothing_alpha: float. As in SmoothQuant
+      (https://arxiv.org/abs/2211.10438), the input channels are divided by
+      `input_max**alpha / kernel_max**(1 - alpha)` and the rows of the kernel
+      are multiplied by it, so that a few input channels with outliers do not
+      take up the whole int8 range of the input.
+
+  Returns:
+    A tuple of the int8 kernel, the float32 scale of each of its columns and
+    the float32 scale of each input channel.
+  """
+  input_max = np.maximum(input_max, 1e-5)
+  kernel_max = np.maximum(np.max(np.abs(kernel), axis=1), 1e-5)
+  smoothing = input_max**smoothing_alpha / kernel_max**(1.0 - smoothing_alpha)
+  input_scale = smoothing * np.max(input_max / smoothing) / 127.0
+  # The inputs are divided by `input_scale`, so the kernel is multiplied by it.
+  scaled_kernel = kernel * input_scale[:, np.newaxis]
+  kernel_scale = np.maximum(np.max(np.abs(scaled_kernel), axis=0),
+                            1e-12) / 127.0
+  quantized_kernel = np.round(scaled_kernel / kernel_scale).astype(np.int8)
+  return (quantized_kernel, kernel_scale.astype(np.float32),
+          input_scale.astype(np.float32))
+
+
+def get_input_max(variables):
+  """Returns the ranges of the inputs of the dense layers to quantize.
+
+  Args:
+    variables: list of the variables of a float `BertModel`.
+
+  Returns:
+    A dict from the name of the kernel of each dense layer of the encoder to a
+    float Tensor of shape [width], the largest absolute value of each of its
+    input channels in the batch.
+  """
+  input_max = {}
+  for variable in variables:
+    name = variable.op.name
+    if not _DENSE_KERNEL_RE.match(name):
+      continue
+    [matmul] = [x for x in variable.value().consumers() if x.type == "MatMul"]
+    input_max[name] = tf.reduce_max(
+        input_tensor=tf.abs(matmul.inputs[0]), axis=0)
+  return input_max
+
+
+def write_quantized_checkpoint(values, input_max, output_checkpoint,
+                               smoothing_alpha):
+  """Saves the variables of a float model for `int8_inference`.
+
+  Args:
+    values: dict from the name of each variable of the float model to its
+      numpy value.
+    input_max: dict from the name of the kernel of each dense layer to
+      quantize to the largest absolute value of each of its input channels on
+      the calibration data, as measured with `get_input_max`.
+    output_checkpoint: string. The path to save the checkpoint to.
+    smoothing_alpha: float. See `quantize_dense_layer`.
+  """
+  quantized_values = {}
+  for (name, value) in values.items():
+    if name not in input_max:
+      quantized_values[name] = value
+      continue
+    (kernel, kernel_scale, input_scale) = quantize_dense_layer(
+        value, input_max[name], smoothing_alpha)
+    prefix = name[:-len("kernel")]
+    quantized_values[name] = kernel
+    quantized_values[prefix + "kernel_scale"] = kernel_scale
+    quantized_values[prefix + "input_scale"] = input_scale
+
+  with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+    variables = [
+        tf.compat.v1.get_variable(
+            name,
+            shape=value.shape,
+            dtype=tf.as_dtype(value.dtype),
+            initializer=tf.compat.v1.zeros_initializer())
+        for (name, value) in sorted(quantized_values.items())
+    ]
+    sess.run(tf.compat.v1.global_variables_initializer())
+    for variable in variables:
+      variable.load(quantized_values[variable.op.name], sess)
+    tf.compat.v1.train.Saver(variables).save(sess, output_checkpoint)
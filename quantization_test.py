@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import modeling
+import numpy as np
+import quantization
+import tensorflow as tf
+tf.compat.v1.disable_resource_variables()
+
+
+class QuantizationTest(tf.test.TestCase):
+
+  def test_quantize_dense_layer(self):
+    rng = np.random.RandomState(1)
+    inputs = rng.normal(size=[64, 48])
+    # A few input channels with outliers, as in BERT.
+    inputs[:, :3] *= 30.0
+    kernel = rng.normal(scale=0.05, size=[48, 16])
+    for smoothing_alpha in [0.0, 0.5]:
+      (quantized_kernel, kernel_scale,
+       input_scale) = quantization.quantize_dense_layer(
+           kernel, np.max(np.abs(inputs), axis=0), smoothing_alpha)
+      self.assertEqual(quantized_kernel.dtype, np.int8)
+      quantized_inputs = np.round(inputs / input_scale)
+      self.assertLessEqual(np.max(np.abs(quantized_inputs)), 127)
+      output = np.matmul(quantized_inputs, quantized_kernel) * kernel_scale
+      self.assertAllClose(output, np.matmul(inputs, kernel), atol=0.3)
+
+  def _run_model(self, config, input_ids, checkpoint=None):
+    """Returns the pooled output and the checkpoint or ranges of the inputs."""
+    with tf.Graph().as_default(), self.session() as sess:
+      tf.keras.backend.reset_uids()
+      model = modeling.BertModel(
+          config=config, is_training=False, input_ids=tf.constant(input_ids))
+      variables = tf.compat.v1.global_variables()
+      if checkpoint:
+        tf.compat.v1.train.Saver(variables).restore(sess, checkpoint)
+        return (sess.run(model.get_pooled_output()), None)
+      sess.run(tf.compat.v1.global_variables_initializer())
+      checkpoint = os.path.join(self.get_temp_dir(), "float.ckpt")
+      tf.compat.v1.train.Saver(variables).save(sess, checkpoint)
+      (values, input_max) = sess.run(
+          ({x.op.name: x for x in variables},
+           quantization.get_input_max(variables)))
+      return (sess.run(model.get_pooled_output()),
+              (checkpoint, values, input_max))
+
+  def test_int8_inference(self):
+    config = modeling.BertConfig(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=37,
+        # Large weights, so that the output depends on the dense layers.
+        initializer_range=0.2)
+    input_ids = np.random.RandomState(2).randint(0, 99, [8, 12])
+    (float_output, (_, values, input_max)) = self._run_model(config, input_ids)
+    self.assertLen(input_max, 2 * 6)
+
+    int8_checkpoint = os.path.join(self.get_temp_dir(), "int8.ckpt")
+    quantization.write_quantized_checkpoint(values, input_max, int8_checkpoint,
+                                            0.5)
+    self.assertEqual(
+        dict(tf.train.list_variables(int8_checkpoint))[
+            "bert/encoder/layer_0/intermediate/dense/input_scale"], [32])
+    config.int8_inference = True
+    (int8_output, _) = self._run_model(config, input_ids, int8_checkpoint)
+    self.assertAllClose(int8_output, float_output, atol=0.1)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,224 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Quantizes a fine-tuned BERT classifier to int8 for CPU inference."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import modeling
+import numpy as np
+import quantization
+import run_classifier
+import tokenization
+import tensorflow as tf
+tf.compat.v1.disable_resource_variables()
+tf.compat.v1.disable_eager_execution()
+
+flags = tf.compat.v1.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    "num_calibration_examples", 512,
+    "The number of training examples on which the ranges of the inputs of "
+    "the dense layers are measured.")
+
+flags.DEFINE_float(
+    "smoothing_alpha", 0.5,
+    "How much of the range of each input channel of a dense layer is moved "
+    "into its weights before both are quantized, from 0.0 (none) to 1.0 "
+    "(all of it).")
+
+flags.DEFINE_float(
+    "max_accuracy_drop", 0.01,
+    "With `do_eval`, the largest drop of the dev set accuracy of the int8 "
+    "model below that of the float model which is accepted.")
+
+
+def create_classifier(bert_config, num_labels, seq_length):
+  """Returns the input placeholders and the logits of a classifier."""
+  placeholders = {
+      name: tf.compat.v1.placeholder(tf.int32, [None, seq_length], name=name)
+      for name in ["input_ids", "input_mask", "segment_ids"]
+  }
+  (_, _, logits, _) = run_classifier.create_model(
+      bert_config=bert_config,
+      is_training=False,
+      input_ids=placeholders["input_ids"],
+      input_mask=placeholders["input_mask"],
+      segment_ids=placeholders["segment_ids"],
+      labels=tf.zeros_like(placeholders["input_ids"][:, 0]),
+      num_labels=num_labels,
+      use_one_hot_embeddings=False)
+  return (placeholders, logits)
+
+
+def init_from_checkpoint(init_checkpoint):
+  """Initializes the variables of the model from `init_checkpoint`.
+
+  This includes the int8 weights of a model with `int8_inference`, which are
+  not trainable.
+  """
+  (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+      tf.compat.v1.global_variables(), init_checkpoint)
+  tf.compat.v1.train.init_from_checkpoint(init_checkpoint, assignment_map)
+
+
+def feature_batches(features, placeholders, batch_size):
+  """Yields batches of `features` with their feed dicts."""
+  for start in range(0, len(features), batch_size):
+    batch = features[start:start + batch_size]
+    yield (batch, {
+        placeholder: np.array([getattr(x, name) for x in batch])
+        for (name, placeholder) in placeholders.items()
+    })
+
+
+def calibrate(bert_config, num_labels, init_checkpoint, features, batch_size):
+  """Runs the float classifier on `features`.
+
+  Args:
+    bert_config: `BertConfig` of the float model.
+    num_labels: int. The number of classes of the classifier.
+    init_checkpoint: string. The checkpoint of the float classifier.
+    features: list of `run_classifier.InputFeatures`.
+    batch_size: int. The batch size to run the classifier with.
+
+  Returns:
+    A tuple of the values of the variables of the model by name, and of the
+    largest absolute value of each input channel of the quantized dense
+    layers on `features`, by the name of their kernel.
+  """
+  with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+    tf.keras.backend.reset_uids()
+    (placeholders, _) = create_classifier(bert_config, num_labels,
+                                          len(features[0].input_ids))
+    init_from_checkpoint(init_checkpoint)
+
+    model_variables = {x.op.name: x for x in tf.compat.v1.global_variables()}
+    input_max_ops = quantization.get_input_max(model_variables.values())
+
+    sess.run(tf.compat.v1.global_variables_initializer())
+    input_max = {}
+    for (_, feed_dict) in feature_batches(features, placeholders, batch_size):
+      for (name, value) in sess.run(input_max_ops, feed_dict).items():
+        input_max[name] = np.maximum(input_max.get(name, 0.0), value)
+    return (sess.run(model_variables), input_max)
+
+
+def predict(bert_config, num_labels, init_checkpoint, features, batch_size):
+  """Returns the logits of the classifier and the examples per second."""
+  with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+    tf.keras.backend.reset_uids()
+    (placeholders, logits) = create_classifier(bert_config, num_labels,
+                                               len(features[0].input_ids))
+    init_from_checkpoint(init_checkpoint)
+    sess.run(tf.compat.v1.global_variables_initializer())
+
+    all_logits = []
+    start_time = time.time()
+    for (_, feed_dict) in feature_batches(features, placeholders, batch_size):
+      all_logits.append(sess.run(logits, feed_dict))
+    examples_per_sec = len(features) / (time.time() - start_time)
+  return (np.concatenate(all_logits), examples_per_sec)
+
+
+def accuracy(logits, features):
+  """Returns the accuracy of `logits` on the labels of `features`."""
+  labels = np.array([x.label_id for x in features])
+  return np.mean(np.argmax(logits, axis=-1) == labels)
+
+
+def main(_):
+  tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+
+  processors = {
+      "cola": run_classifier.ColaProcessor,
+      "mnli": run_classifier.MnliProcessor,
+      "mrpc": run_classifier.MrpcProcessor,
+      "xnli": run_classifier.XnliProcessor,
+  }
+
+  tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case,
+                                                FLAGS.init_checkpoint)
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  if bert_config.int8_inference:
+    raise ValueError("`bert_config_file` must be that of the float model.")
+
+  task_name = FLAGS.task_name.lower()
+  if task_name not in processors:
+    raise ValueError("Task not found: %s" % (task_name))
+  processor = processors[task_name]()
+  label_list = processor.get_labels()
+
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+
+  tf.io.gfile.makedirs(FLAGS.output_dir)
+
+  calibration_examples = processor.get_train_examples(
+      FLAGS.data_dir)[:FLAGS.num_calibration_examples]
+  calibration_features = run_classifier.convert_examples_to_features(
+      calibration_examples, label_list, FLAGS.max_seq_length, tokenizer)
+  (values, input_max) = calibrate(bert_config, len(label_list),
+                                  FLAGS.init_checkpoint, calibration_features,
+                                  FLAGS.eval_batch_size)
+  tf.compat.v1.logging.info("Quantizing %d dense layers", len(input_max))
+
+  output_checkpoint = os.path.join(FLAGS.output_dir, "model.ckpt")
+  quantization.write_quantized_checkpoint(values, input_max, output_checkpoint,
+                                          FLAGS.smoothing_alpha)
+  int8_config = modeling.BertConfig.from_dict(bert_config.to_dict())
+  int8_config.int8_inference = True
+  with tf.io.gfile.GFile(
+      os.path.join(FLAGS.output_dir, "bert_config.json"), "w") as writer:
+    writer.write(int8_config.to_json_string())
+
+  if FLAGS.do_eval:
+    eval_examples = processor.get_dev_examples(FLAGS.data_dir)
+    eval_features = run_classifier.convert_examples_to_features(
+        eval_examples, label_list, FLAGS.max_seq_length, tokenizer)
+    (float_logits, float_speed) = predict(bert_config, len(label_list),
+                                          FLAGS.init_checkpoint, eval_features,
+                                          FLAGS.eval_batch_size)
+    (int8_logits, int8_speed) = predict(int8_config, len(label_list),
+                                        output_checkpoint, eval_features,
+                                        FLAGS.eval_batch_size)
+    float_accuracy = accuracy(float_logits, eval_features)
+    int8_accuracy = accuracy(int8_logits, eval_features)
+
+    tf.compat.v1.logging.info("***** Eval results *****")
+    tf.compat.v1.logging.info("  float accuracy = %.4f (%.1f examples/sec)",
+                              float_accuracy, float_speed)
+    tf.compat.v1.logging.info("  int8 accuracy = %.4f (%.1f examples/sec)",
+                              int8_accuracy, int8_speed)
+    if float_accuracy - int8_accuracy > FLAGS.max_accuracy_drop:
+      raise ValueError(
+          "The int8 model is %.4f less accurate than the float model, more "
+          "than `max_accuracy_drop`." % (float_accuracy - int8_accuracy))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("data_dir")
+  flags.mark_flag_as_required("task_name")
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("output_dir")
+  tf.compat.v1.app.run()
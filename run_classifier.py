@@ -21,6 +21,8 @@ from __future__ import print_function
 import collections
 import csv
 import os
+import time
+import bucketing
 import modeling
 import optimization
 import tokenization
@@ -69,6 +71,20 @@ flags.DEFINE_integer(
     "Sequences longer than this will be truncated, and sequences shorter "
     "than this will be padded.")
 
+flags.DEFINE_string(
+    "length_buckets", None,
+    "Comma-separated sequence lengths, e.g. 32,64. If set, batches are only "
+    "padded to the smallest of these lengths (or `max_seq_length`) which "
+    "holds all of their sequences, and training batches are drawn from "
+    "examples of similar length. Not supported on TPU, which requires fixed "
+    "shapes.")
+
+flags.DEFINE_string(
+    "compute_type", "float32",
+    "Data type of the transformer layers - float32 (default), float16 or "
+    "bfloat16. The weights are kept in float32, and float16 also enables "
+    "dynamic loss scaling.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_eval", False, "Whether to run eval on the dev set.")
@@ -79,6 +95,12 @@ flags.DEFINE_bool(
 
 flags.DEFINE_integer("train_batch_size", 32, "Total batch size for training.")
 
+flags.DEFINE_integer(
+    "gradient_accumulation_steps", 1,
+    "Number of batches whose gradients are accumulated before each "
+    "optimizer step. The effective batch size is `train_batch_size` times "
+    "this.")
+
 flags.DEFINE_integer("eval_batch_size", 8, "Total batch size for eval.")
 
 flags.DEFINE_integer("predict_batch_size", 8, "Total batch size for predict.")
@@ -399,20 +421,22 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   for (i, label) in enumerate(label_list):
     label_map[label] = i
 
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
+  # The text goes straight to word piece ids; the token strings are only
+  # needed for logging.
+  ids_a = tokenizer.encode(example.text_a)
+  ids_b = None
   if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
+    ids_b = tokenizer.encode(example.text_b)
 
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
+  if ids_b:
+    # Modifies `ids_a` and `ids_b` in place so that the total
     # length is less than the specified length.
     # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+    _truncate_seq_pair(ids_a, ids_b, max_seq_length - 3)
   else:
     # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
+    if len(ids_a) > max_seq_length - 2:
+      ids_a = ids_a[0:(max_seq_length - 2)]
 
   # The convention in BERT is:
   # (a) For sequence pairs:
@@ -432,24 +456,19 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   # For classification tasks, the first vector (corresponding to [CLS]) is
   # used as the "sentence vector". Note that this only makes sense because
   # the entire model is fine-tuned.
-  tokens = []
+  cls_id = tokenizer.vocab["[CLS]"]
+  sep_id = tokenizer.vocab["[SEP]"]
+  input_ids = []
   segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
+  input_ids.append(cls_id)
+  input_ids.extend(ids_a)
+  input_ids.append(sep_id)
+  segment_ids.extend([0] * len(input_ids))
 
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
+  if ids_b:
+    input_ids.extend(ids_b)
+    input_ids.append(sep_id)
+    segment_ids.extend([1] * (len(ids_b) + 1))
 
   # The mask has 1 for real tokens and 0 for padding tokens. Only real
   # tokens are attended to.
@@ -469,6 +488,7 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   if ex_index < 5:
     tf.compat.v1.logging.info("*** Example ***")
     tf.compat.v1.logging.info("guid: %s" % (example.guid))
+    tokens = tokenizer.convert_ids_to_tokens(input_ids[:sum(input_mask)])
     tf.compat.v1.logging.info("tokens: %s" % " ".join(
         [tokenization.printable_text(x) for x in tokens]))
     tf.compat.v1.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
@@ -516,8 +536,12 @@ def file_based_convert_examples_to_features(
 
 
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                                drop_remainder, length_buckets=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `length_buckets` is given, the batches are cut to variable lengths by
+  `bucketing.batch_by_length`.
+  """
 
   name_to_features = {
       "input_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
@@ -552,6 +576,13 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
+    if length_buckets:
+      d = d.map(lambda record: _decode_record(record, name_to_features))
+      return bucketing.batch_by_length(
+          d, batch_size, length_buckets, seq_length,
+          ["input_ids", "input_mask", "segment_ids"], is_training,
+          drop_remainder)
+
     d = d.apply(
         tf.data.experimental.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -581,7 +612,8 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
 
 
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings):
+                 labels, num_labels, use_one_hot_embeddings,
+                 compute_type=tf.float32):
   """Creates a classification model."""
   model = modeling.BertModel(
       config=bert_config,
@@ -589,7 +621,8 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      compute_type=compute_type)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -598,7 +631,7 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
   # instead.
   output_layer = model.get_pooled_output()
 
-  hidden_size = output_layer.shape[-1].value
+  hidden_size = output_layer.shape[-1]
 
   output_weights = tf.compat.v1.get_variable(
       "output_weights", [num_labels, hidden_size],
@@ -627,7 +660,8 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
 
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, gradient_accumulation_steps=1,
+                     compute_type=tf.float32):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -651,14 +685,20 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
 
     (total_loss, per_example_loss, logits, probabilities) = create_model(
         bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels, use_one_hot_embeddings)
+        num_labels, use_one_hot_embeddings, compute_type)
 
     tvars = tf.compat.v1.trainable_variables()
     initialized_variable_names = {}
     scaffold_fn = None
     if init_checkpoint:
+      init_vars = tvars
+      if bert_config.int8_inference:
+        # The int8 weights of a model with `int8_inference` are not trainable.
+        init_vars = tvars + [
+            x for x in tf.compat.v1.model_variables() if x not in tvars]
       (assignment_map, initialized_variable_names
-      ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      ) = modeling.get_assignment_map_from_checkpoint(init_vars,
+                                                      init_checkpoint)
       if use_tpu:
 
         def tpu_scaffold():
@@ -681,7 +721,9 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     if mode == tf.estimator.ModeKeys.TRAIN:
 
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          gradient_accumulation_steps=gradient_accumulation_steps,
+          dynamic_loss_scaling=(compute_type == tf.float16))
 
       output_spec = tf.compat.v1.estimator.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -806,6 +848,9 @@ def main(_):
     raise ValueError(
         "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
 
+  if FLAGS.compute_type not in ("float32", "float16", "bfloat16"):
+    raise ValueError("Unsupported `compute_type`: %s" % FLAGS.compute_type)
+
   bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
   if FLAGS.max_seq_length > bert_config.max_position_embeddings:
@@ -814,6 +859,17 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  if FLAGS.do_train and bert_config.int8_inference:
+    raise ValueError(
+        "`do_train` is not supported with `int8_inference`: the int8 weights "
+        "of the encoder are not trainable. Train the float model instead.")
+
+  length_buckets = None
+  if FLAGS.length_buckets:
+    if FLAGS.use_tpu:
+      raise ValueError("`length_buckets` is not supported on TPU.")
+    length_buckets = [int(x) for x in FLAGS.length_buckets.split(",")]
+
   tf.io.gfile.makedirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -850,7 +906,9 @@ def main(_):
   if FLAGS.do_train:
     train_examples = processor.get_train_examples(FLAGS.data_dir)
     num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        len(train_examples) / (FLAGS.train_batch_size *
+                               FLAGS.gradient_accumulation_steps) *
+        FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
 
   model_fn = model_fn_builder(
@@ -861,7 +919,9 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      gradient_accumulation_steps=FLAGS.gradient_accumulation_steps,
+      compute_type=tf.as_dtype(FLAGS.compute_type))
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -885,7 +945,8 @@ def main(_):
         input_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        length_buckets=length_buckets)
 
     hooks = []
     if FLAGS.enable_timeline:
@@ -894,7 +955,17 @@ def main(_):
         output_dir=FLAGS.output_dir)
       hooks.append(profiler_hook)
 
+    start_time = time.time()
     estimator.train(input_fn=train_input_fn, max_steps=num_train_steps, hooks=hooks)
+    train_time = time.time() - start_time
+    tf.compat.v1.logging.info("***** Training done *****")
+    tf.compat.v1.logging.info(
+        "  Throughput = %.1f examples/sec", num_train_steps *
+        FLAGS.train_batch_size * FLAGS.gradient_accumulation_steps / train_time)
+    if tf.config.list_physical_devices("GPU"):
+      tf.compat.v1.logging.info(
+          "  Peak memory = %.0f MB",
+          tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20)
 
   if FLAGS.do_eval:
     eval_examples = processor.get_dev_examples(FLAGS.data_dir)
@@ -931,7 +1002,8 @@ def main(_):
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=eval_drop_remainder)
+        drop_remainder=eval_drop_remainder,
+        length_buckets=length_buckets)
 
     result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
 
@@ -969,7 +1041,8 @@ def main(_):
         input_file=predict_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=predict_drop_remainder)
+        drop_remainder=predict_drop_remainder,
+        length_buckets=length_buckets)
 
     result = estimator.predict(input_fn=predict_input_fn)
 
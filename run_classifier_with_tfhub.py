@@ -86,7 +86,8 @@ def create_model(is_training, input_ids, input_mask, segment_ids, labels,
 
 
 def model_fn_builder(num_labels, learning_rate, num_train_steps,
-                     num_warmup_steps, use_tpu, bert_hub_module_handle):
+                     num_warmup_steps, use_tpu, bert_hub_module_handle,
+                     gradient_accumulation_steps=1):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -110,7 +111,8 @@ def model_fn_builder(num_labels, learning_rate, num_train_steps,
     output_spec = None
     if mode == tf.estimator.ModeKeys.TRAIN:
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          gradient_accumulation_steps=gradient_accumulation_steps)
 
       output_spec = tf.compat.v1.estimator.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -203,7 +205,9 @@ def main(_):
   if FLAGS.do_train:
     train_examples = processor.get_train_examples(FLAGS.data_dir)
     num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        len(train_examples) / (FLAGS.train_batch_size *
+                               FLAGS.gradient_accumulation_steps) *
+        FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
 
   model_fn = model_fn_builder(
@@ -212,7 +216,8 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      bert_hub_module_handle=FLAGS.bert_hub_module_handle)
+      bert_hub_module_handle=FLAGS.bert_hub_module_handle,
+      gradient_accumulation_steps=FLAGS.gradient_accumulation_steps)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
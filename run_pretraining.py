@@ -18,9 +18,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import os
 import modeling
 import optimization
+import tokenization
 import tensorflow as tf
 tf.compat.v1.disable_resource_variables()
 tf.compat.v1.disable_eager_execution()
@@ -69,12 +71,50 @@ flags.DEFINE_integer(
     "Maximum number of masked LM predictions per sequence. "
     "Must match data generation.")
 
+flags.DEFINE_bool(
+    "compact_records", False,
+    "Whether the input files are compact records, written by "
+    "create_pretraining_data.py with --compact_records.")
+
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Whether the input files are unmasked (written by "
+    "create_pretraining_data.py with --dynamic_masking) and the masked LM "
+    "predictions should be chosen in the input pipeline, with fresh masks "
+    "every time an example is read. Requires `vocab_file`.")
+
+flags.DEFINE_integer(
+    "max_sequences_per_row", 1,
+    "Maximum number of sequences packed into each example. Must match data "
+    "generation: values above 1 read the packed rows written by "
+    "create_pretraining_data.py with --max_sequences_per_row.")
+
+flags.DEFINE_string(
+    "vocab_file", None,
+    "The vocabulary file that the BERT model was trained on. Only used with "
+    "`dynamic_masking`.")
+
+flags.DEFINE_float(
+    "masked_lm_prob", 0.15,
+    "Masked LM probability. Only used with `dynamic_masking`.")
+
+flags.DEFINE_bool(
+    "do_whole_word_mask", False,
+    "Whether to use whole word masking rather than per-WordPiece masking. "
+    "Only used with `dynamic_masking`.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_eval", False, "Whether to run eval on the dev set.")
 
 flags.DEFINE_integer("train_batch_size", 32, "Total batch size for training.")
 
+flags.DEFINE_integer(
+    "gradient_accumulation_steps", 1,
+    "Number of batches whose gradients are accumulated before each "
+    "optimizer step. The effective batch size is `train_batch_size` times "
+    "this. `num_train_steps` counts optimizer steps.")
+
 flags.DEFINE_integer("eval_batch_size", 8, "Total batch size for eval.")
 
 flags.DEFINE_float("learning_rate", 5e-5, "The initial learning rate for Adam.")
@@ -83,6 +123,33 @@ flags.DEFINE_integer("num_train_steps", 100000, "Number of training steps.")
 
 flags.DEFINE_integer("num_warmup_steps", 10000, "Number of warmup steps.")
 
+flags.DEFINE_string(
+    "phase2_input_file", None,
+    "Input TF example files (can be a glob or comma separated) for a second "
+    "training phase, usually with longer sequences. If set, the first "
+    "`phase1_fraction` of `num_train_steps` train on `input_file` and the "
+    "rest on these files. The learning rate schedule, the optimizer state "
+    "and the global step carry over through the checkpoint in `output_dir`.")
+
+flags.DEFINE_float(
+    "phase1_fraction", 0.9,
+    "Fraction of `num_train_steps` trained on `input_file` before switching "
+    "to `phase2_input_file`. Must be strictly between 0 and 1.")
+
+flags.DEFINE_integer(
+    "phase2_max_seq_length", 512,
+    "`max_seq_length` of `phase2_input_file`. Must match data generation.")
+
+flags.DEFINE_integer(
+    "phase2_max_predictions_per_seq", 80,
+    "`max_predictions_per_seq` of `phase2_input_file`. Must match data "
+    "generation.")
+
+flags.DEFINE_integer(
+    "phase2_train_batch_size", None,
+    "Total batch size for the second training phase. Defaults to "
+    "`train_batch_size`.")
+
 flags.DEFINE_integer("save_checkpoints_steps", 1000,
                      "How often to save the model checkpoint.")
 
@@ -121,12 +188,60 @@ flags.DEFINE_bool("use_horovod", False, "Whether to use Horovod.")
 
 flags.DEFINE_string("optimizer_type", "adam", "Optimizer used for training - adam (default), lamb, nadam and nlamb")
 
+flags.DEFINE_bool(
+    "fused_optimizer", False,
+    "Whether the adam and lamb optimizers update all the weights through a "
+    "few flat buffers, which saves kernel launches on GPUs. Checkpoints are "
+    "only compatible with the same setting.")
+
+flags.DEFINE_string(
+    "compute_type", "float32",
+    "Data type of the transformer layers - float32 (default), float16 or "
+    "bfloat16. The weights are kept in float32, and float16 also enables "
+    "dynamic loss scaling.")
+
 flags.DEFINE_integer(
     "num_report_steps", 10,
     "How frequently should summary information be reported and recorded.")
 
 
-class LogSessionRunHook(tf.estimator.SessionRunHook):
+TrainingPhase = collections.namedtuple(
+    "TrainingPhase", ["input_files", "max_seq_length", "max_predictions_per_seq",
+                      "train_batch_size", "last_step"])
+
+
+def get_training_phases(input_files, num_train_steps):
+  """Returns the `TrainingPhase`s of the run, as set by the flags."""
+  phase1 = TrainingPhase(
+      input_files=input_files,
+      max_seq_length=FLAGS.max_seq_length,
+      max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+      train_batch_size=FLAGS.train_batch_size,
+      last_step=num_train_steps)
+  if not FLAGS.phase2_input_file:
+    return [phase1]
+
+  phase1_last_step = int(num_train_steps * FLAGS.phase1_fraction)
+  if not 0 < phase1_last_step < num_train_steps:
+    raise ValueError(
+        "`phase1_fraction` must be strictly between 0 and 1 and leave steps "
+        "for both phases, got %s of %d steps." % (FLAGS.phase1_fraction,
+                                                  num_train_steps))
+
+  phase2_input_files = []
+  for input_pattern in FLAGS.phase2_input_file.split(","):
+    phase2_input_files.extend(tf.io.gfile.glob(input_pattern))
+  phase2 = TrainingPhase(
+      input_files=phase2_input_files,
+      max_seq_length=FLAGS.phase2_max_seq_length,
+      max_predictions_per_seq=FLAGS.phase2_max_predictions_per_seq,
+      train_batch_size=(FLAGS.phase2_train_batch_size or
+                        FLAGS.train_batch_size),
+      last_step=num_train_steps)
+  return [phase1._replace(last_step=phase1_last_step), phase2]
+
+
+class LogSessionRunHook(tf.compat.v1.train.SessionRunHook):
 
     def __init__(self,
                  global_batch_size,
@@ -144,12 +259,15 @@ class LogSessionRunHook(tf.estimator.SessionRunHook):
     def after_create_session(self, session, coord):
       self.elapsed_secs = 0.
       self.count = 0
+      self.last_reported_step = None
+      # The hook only runs on the first worker, whose session uses GPU:0.
+      self.has_gpu = bool(tf.config.list_physical_devices('GPU'))
 
     def before_run(self, run_context):
       self.t0 = time.time()
       global_step = tf.compat.v1.train.get_global_step()
       fetches = [global_step, 'learning_rate:0', 'total_loss:0', 'mlm_loss:0', 'nsp_loss:0']
-      return tf.estimator.SessionRunArgs(fetches=fetches)
+      return tf.compat.v1.train.SessionRunArgs(fetches=fetches)
 
     def _log_and_record(self, global_step, learning_rate, total_loss, mlm_loss, nsp_loss):
       time_per_step = self.elapsed_secs / self.count
@@ -161,6 +279,9 @@ class LogSessionRunHook(tf.estimator.SessionRunHook):
       log_string += ', mlm_oss = %6.4e'%(mlm_loss)
       log_string += ', nsp_loss = %6.4e'%(nsp_loss)
       log_string += ', learning_rate = %6.4e'%(learning_rate)
+      if self.has_gpu:
+        peak_memory = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20
+        log_string += ', peak_memory = %6.0f MB'%(peak_memory)
       tf.compat.v1.logging.info(log_string)
 
       if self.summary_writer is not None:
@@ -168,15 +289,21 @@ class LogSessionRunHook(tf.estimator.SessionRunHook):
         self.summary_writer.add_summary(throughput_summary, global_step)
         total_loss_summary = Summary(value=[Summary.Value(tag='total_loss', simple_value=total_loss)])
         self.summary_writer.add_summary(total_loss_summary, global_step)
+        if self.has_gpu:
+          peak_memory_summary = Summary(value=[Summary.Value(tag='peak_memory', simple_value=peak_memory)])
+          self.summary_writer.add_summary(peak_memory_summary, global_step)
 
     def after_run(self, run_context, run_values):
       self.elapsed_secs += time.time() - self.t0
       self.count += 1
       global_step, learning_rate, total_loss, mlm_loss, nsp_loss = run_values.results[0:5]
-      if (global_step % self.num_report_steps) == 0:
+      # With gradient accumulation, several runs share one global step, and
+      # `global_batch_size` examples are processed by each of them.
+      if (global_step % self.num_report_steps) == 0 and global_step != self.last_reported_step:
         self._log_and_record(global_step, learning_rate, total_loss, mlm_loss, nsp_loss)
         self.elapsed_secs = 0.
         self.count = 0
+        self.last_reported_step = global_step
 
 
 flags.DEFINE_bool("enable_timeline", False,
@@ -189,7 +316,8 @@ flags.DEFINE_integer("num_timeline_steps", 1,
 
 def model_fn_builder(bert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings, use_hvd):
+                     use_one_hot_embeddings, use_hvd,
+                     gradient_accumulation_steps=1, compute_type=tf.float32):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -206,6 +334,14 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
     masked_lm_ids = features["masked_lm_ids"]
     masked_lm_weights = features["masked_lm_weights"]
     next_sentence_labels = features["next_sentence_labels"]
+    # Packed rows hold several sequences, each with its own [CLS] token and
+    # next sentence label.
+    is_packed = "position_ids" in features
+    if is_packed:
+      next_sentence_weights = features["next_sentence_weights"]
+    else:
+      next_sentence_weights = tf.ones_like(next_sentence_labels,
+                                           dtype=tf.float32)
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
@@ -215,7 +351,11 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=segment_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        position_ids=features.get("position_ids"),
+        packed_sequences=is_packed,
+        pooled_positions=features.get("next_sentence_positions"),
+        compute_type=compute_type)
 
     (masked_lm_loss,
      masked_lm_example_loss, masked_lm_log_probs) = get_masked_lm_output(
@@ -224,7 +364,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
     (next_sentence_loss, next_sentence_example_loss,
      next_sentence_log_probs) = get_next_sentence_output(
-         bert_config, model.get_pooled_output(), next_sentence_labels)
+         bert_config, model.get_pooled_output(), next_sentence_labels,
+         next_sentence_weights)
 
     total_loss = masked_lm_loss + next_sentence_loss
 
@@ -260,7 +401,9 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
     output_spec = None
     if mode == tf.estimator.ModeKeys.TRAIN:
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu, use_hvd, FLAGS.optimizer_type)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu, use_hvd, FLAGS.optimizer_type,
+          gradient_accumulation_steps, dynamic_loss_scaling=(compute_type == tf.float16),
+          fused=FLAGS.fused_optimizer)
 
       output_spec = tf.compat.v1.estimator.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -271,7 +414,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
       def metric_fn(masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
                     masked_lm_weights, next_sentence_example_loss,
-                    next_sentence_log_probs, next_sentence_labels):
+                    next_sentence_log_probs, next_sentence_labels,
+                    next_sentence_weights):
         """Computes the loss and accuracy of the model."""
         masked_lm_log_probs = tf.reshape(masked_lm_log_probs,
                                          [-1, masked_lm_log_probs.shape[-1]])
@@ -292,10 +436,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         next_sentence_predictions = tf.argmax(
             input=next_sentence_log_probs, axis=-1, output_type=tf.int32)
         next_sentence_labels = tf.reshape(next_sentence_labels, [-1])
+        next_sentence_weights = tf.reshape(next_sentence_weights, [-1])
         next_sentence_accuracy = tf.compat.v1.metrics.accuracy(
-            labels=next_sentence_labels, predictions=next_sentence_predictions)
+            labels=next_sentence_labels,
+            predictions=next_sentence_predictions,
+            weights=next_sentence_weights)
         next_sentence_mean_loss = tf.compat.v1.metrics.mean(
-            values=next_sentence_example_loss)
+            values=next_sentence_example_loss, weights=next_sentence_weights)
 
         return {
             "masked_lm_accuracy": masked_lm_accuracy,
@@ -307,7 +454,7 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
       eval_metrics = (metric_fn, [
           masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
           masked_lm_weights, next_sentence_example_loss,
-          next_sentence_log_probs, next_sentence_labels
+          next_sentence_log_probs, next_sentence_labels, next_sentence_weights
       ])
       output_spec = tf.compat.v1.estimator.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -367,8 +514,13 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
   return (loss, per_example_loss, log_probs)
 
 
-def get_next_sentence_output(bert_config, input_tensor, labels):
-  """Get loss and log probs for the next sentence prediction."""
+def get_next_sentence_output(bert_config, input_tensor, labels,
+                             label_weights=None):
+  """Get loss and log probs for the next sentence prediction.
+
+  `label_weights` are 1.0 for every real label and 0.0 for the padding
+  labels of packed rows with fewer than the maximum number of sequences.
+  """
 
   # Simple binary classification. Note that 0 is "next sentence" and 1 is
   # "random sentence". This weight matrix is not used after pre-training.
@@ -386,7 +538,13 @@ def get_next_sentence_output(bert_config, input_tensor, labels):
     labels = tf.reshape(labels, [-1])
     one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
     per_example_loss = -tf.reduce_sum(input_tensor=one_hot_labels * log_probs, axis=-1)
-    loss = tf.reduce_mean(input_tensor=per_example_loss)
+    if label_weights is None:
+      loss = tf.reduce_mean(input_tensor=per_example_loss)
+    else:
+      label_weights = tf.reshape(label_weights, [-1])
+      numerator = tf.reduce_sum(input_tensor=label_weights * per_example_loss)
+      denominator = tf.reduce_sum(input_tensor=label_weights) + 1e-5
+      loss = numerator / denominator
     return (loss, per_example_loss, log_probs)
 
 
@@ -410,8 +568,24 @@ def input_fn_builder(input_files,
                      max_seq_length,
                      max_predictions_per_seq,
                      is_training,
-                     num_cpu_threads=4):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     num_cpu_threads=4,
+                     masked_lm_config=None,
+                     compact_records=False,
+                     max_sequences_per_row=1):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `masked_lm_config` (a `MaskedLmConfig`) is given, the input files are
+  expected to be unmasked and the masked LM predictions are chosen by
+  `create_masked_lm_predictions` for every batch.
+
+  If `compact_records` is True, the input files are expected to be compact
+  records, which are padded when they are batched.
+
+  If `max_sequences_per_row` is greater than 1, the input files are expected
+  to hold rows of packed sequences, with `position_ids` and one
+  `next_sentence_positions`, `next_sentence_labels` and
+  `next_sentence_weights` entry per sequence.
+  """
 
   def input_fn(params):
     """The actual input function."""
@@ -424,15 +598,29 @@ def input_fn_builder(input_files,
             tf.io.FixedLenFeature([max_seq_length], tf.int64),
         "segment_ids":
             tf.io.FixedLenFeature([max_seq_length], tf.int64),
-        "masked_lm_positions":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
-        "masked_lm_ids":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
-        "masked_lm_weights":
-            tf.io.FixedLenFeature([max_predictions_per_seq], tf.float32),
         "next_sentence_labels":
             tf.io.FixedLenFeature([1], tf.int64),
     }
+    if max_sequences_per_row > 1:
+      name_to_features.update({
+          "position_ids":
+              tf.io.FixedLenFeature([max_seq_length], tf.int64),
+          "next_sentence_positions":
+              tf.io.FixedLenFeature([max_sequences_per_row], tf.int64),
+          "next_sentence_labels":
+              tf.io.FixedLenFeature([max_sequences_per_row], tf.int64),
+          "next_sentence_weights":
+              tf.io.FixedLenFeature([max_sequences_per_row], tf.float32),
+      })
+    if masked_lm_config is None:
+      name_to_features.update({
+          "masked_lm_positions":
+              tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
+          "masked_lm_ids":
+              tf.io.FixedLenFeature([max_predictions_per_seq], tf.int64),
+          "masked_lm_weights":
+              tf.io.FixedLenFeature([max_predictions_per_seq], tf.float32),
+      })
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
@@ -462,17 +650,180 @@ def input_fn_builder(input_files,
     # size dimensions. For eval, we assume we are evaluating on the CPU or GPU
     # and we *don't* want to drop the remainder, otherwise we wont cover
     # every sample.
-    d = d.apply(
-        tf.data.experimental.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            num_parallel_batches=num_cpu_threads,
-            drop_remainder=True))
+    if compact_records:
+      d = d.batch(batch_size, drop_remainder=True)
+      d = d.map(
+          lambda records: _decode_compact_records(
+              records, max_seq_length, max_predictions_per_seq,
+              masked_lm_config is None),
+          num_parallel_calls=num_cpu_threads)
+    else:
+      d = d.apply(
+          tf.data.experimental.map_and_batch(
+              lambda record: _decode_record(record, name_to_features),
+              batch_size=batch_size,
+              num_parallel_batches=num_cpu_threads,
+              drop_remainder=True))
+
+    if masked_lm_config is not None:
+      # Eval masks are seeded so that every evaluation sees the same masks.
+      seed = None if is_training else 12345
+      d = d.map(
+          lambda features: create_masked_lm_predictions(
+              features, max_predictions_per_seq, masked_lm_config, seed),
+          num_parallel_calls=num_cpu_threads)
     return d
 
   return input_fn
 
 
+class MaskedLmConfig(object):
+  """Configuration for `create_masked_lm_predictions`."""
+
+  def __init__(self, vocab, masked_lm_prob=0.15, do_whole_word_mask=False):
+    """Constructs a MaskedLmConfig.
+
+    Args:
+      vocab: A dict mapping WordPiece tokens to ids.
+      masked_lm_prob: Masked LM probability.
+      do_whole_word_mask: Whether to mask all of the WordPieces of a word.
+    """
+    self.vocab_size = max(vocab.values()) + 1
+    self.mask_id = vocab["[MASK]"]
+    self.masked_lm_prob = masked_lm_prob
+    self.do_whole_word_mask = do_whole_word_mask
+    self.is_special = [False] * self.vocab_size
+    self.is_subword = [False] * self.vocab_size
+    for (token, index) in vocab.items():
+      self.is_special[index] = token == "[CLS]" or token == "[SEP]"
+      self.is_subword[index] = token.startswith("##")
+
+
+def create_masked_lm_predictions(features, max_predictions_per_seq, config,
+                                 seed=None):
+  """Masks a batch of unmasked features for the masked LM objective.
+
+  This follows `create_masked_lm_predictions` in create_pretraining_data.py:
+  up to `round(length * masked_lm_prob)` WordPieces (or whole words) other
+  than [CLS] and [SEP] are chosen, and 80% of them are replaced with [MASK],
+  10% with a random id and 10% are kept.
+
+  Args:
+    features: A dict with int32 `input_ids` and `input_mask` tensors of shape
+      [batch_size, seq_length].
+    max_predictions_per_seq: Maximum number of masked LM predictions per row.
+    config: A `MaskedLmConfig`.
+    seed: Optional random seed.
+
+  Returns:
+    `features` with masked `input_ids` and the `masked_lm_positions`,
+    `masked_lm_ids` and `masked_lm_weights` tensors of shape
+    [batch_size, max_predictions_per_seq].
+  """
+  input_ids = features["input_ids"]
+  input_mask = features["input_mask"]
+  (batch_size, seq_length) = modeling.get_shape_list(input_ids,
+                                                     expected_rank=2)
+
+  is_candidate = tf.logical_and(
+      tf.cast(input_mask, tf.bool),
+      tf.logical_not(tf.gather(tf.constant(config.is_special), input_ids)))
+
+  # Number the candidate words of each row. A "##" WordPiece belongs to the
+  # word before it.
+  is_word_start = is_candidate
+  if config.do_whole_word_mask:
+    has_previous = tf.cumsum(tf.cast(is_candidate, tf.int32), axis=1) > 1
+    is_word_start = tf.logical_and(
+        is_candidate,
+        tf.logical_not(
+            tf.logical_and(
+                tf.gather(tf.constant(config.is_subword), input_ids),
+                has_previous)))
+  word_index = tf.cumsum(tf.cast(is_word_start, tf.int32), axis=1) - 1
+  row_offsets = tf.range(batch_size)[:, None] * seq_length
+  # Non-candidates are counted in one extra segment, which is dropped.
+  word_segments = tf.where(is_candidate, word_index + row_offsets,
+                           tf.fill([batch_size, seq_length],
+                                   batch_size * seq_length))
+  word_lengths = tf.reshape(
+      tf.math.unsorted_segment_sum(
+          tf.ones_like(word_segments), word_segments,
+          batch_size * seq_length + 1)[:-1], [batch_size, seq_length])
+
+  # Packed rows number their sequences in `input_mask`, so count the tokens.
+  lengths = tf.reduce_sum(tf.cast(input_mask > 0, tf.float32), axis=1)
+  num_to_predict = tf.minimum(
+      max_predictions_per_seq,
+      tf.maximum(1, tf.cast(tf.round(lengths * config.masked_lm_prob),
+                            tf.int32)))
+
+  # Visit the words of each row in a random order and take each word which
+  # still fits in the row's budget.
+  scores = tf.where(word_lengths > 0,
+                    tf.random.uniform([batch_size, seq_length],
+                                      seed=_offset_seed(seed, 0)),
+                    tf.fill([batch_size, seq_length], 2.0))
+  order = tf.argsort(scores, axis=1)
+  ordered_lengths = tf.gather(word_lengths, order, batch_dims=1)
+  if config.do_whole_word_mask:
+    def take_if_fits(num_taken, length):
+      fits = tf.logical_and(length > 0,
+                            num_taken + length <= num_to_predict)
+      return num_taken + tf.where(fits, length, tf.zeros_like(length))
+
+    num_taken = tf.transpose(
+        tf.scan(take_if_fits, tf.transpose(ordered_lengths),
+                initializer=tf.zeros([batch_size], tf.int32)))
+    is_taken = num_taken > tf.pad(num_taken[:, :-1], [[0, 0], [1, 0]])
+  else:
+    # Every word is a single WordPiece, so this is just the first
+    # `num_to_predict` of them.
+    is_taken = tf.logical_and(
+        ordered_lengths > 0,
+        tf.cumsum(ordered_lengths, axis=1) <= num_to_predict[:, None])
+  is_word_masked = tf.gather(is_taken, tf.argsort(order, axis=1),
+                             batch_dims=1)
+  is_masked = tf.logical_and(
+      is_candidate,
+      tf.gather(is_word_masked, tf.maximum(word_index, 0), batch_dims=1))
+
+  replacement = tf.random.uniform([batch_size, seq_length],
+                                  seed=_offset_seed(seed, 1))
+  random_ids = tf.random.uniform([batch_size, seq_length],
+                                 maxval=config.vocab_size,
+                                 dtype=tf.int32,
+                                 seed=_offset_seed(seed, 2))
+  masked_ids = tf.where(
+      replacement < 0.8, tf.fill([batch_size, seq_length], config.mask_id),
+      tf.where(replacement < 0.9, input_ids, random_ids))
+
+  # A stable sort puts the masked positions of each row first, in order.
+  masked_lm_positions = tf.argsort(
+      tf.cast(tf.logical_not(is_masked), tf.int32), axis=1,
+      stable=True)[:, :max_predictions_per_seq]
+  masked_lm_weights = tf.less(
+      tf.range(max_predictions_per_seq)[None, :],
+      tf.reduce_sum(tf.cast(is_masked, tf.int32), axis=1)[:, None])
+  masked_lm_positions = tf.where(masked_lm_weights, masked_lm_positions,
+                                 tf.zeros_like(masked_lm_positions))
+
+  features = dict(features)
+  features["input_ids"] = tf.where(is_masked, masked_ids, input_ids)
+  features["masked_lm_positions"] = masked_lm_positions
+  features["masked_lm_ids"] = tf.where(
+      masked_lm_weights,
+      tf.gather(input_ids, masked_lm_positions, batch_dims=1),
+      tf.zeros_like(masked_lm_positions))
+  features["masked_lm_weights"] = tf.cast(masked_lm_weights, tf.float32)
+  return features
+
+
+def _offset_seed(seed, offset):
+  # Random ops with the same seed produce the same numbers.
+  return None if seed is None else seed + offset
+
+
 def _decode_record(record, name_to_features):
   """Decodes a record to a TensorFlow example."""
   example = tf.io.parse_single_example(serialized=record, features=name_to_features)
@@ -488,6 +839,65 @@ def _decode_record(record, name_to_features):
   return example
 
 
+def _decode_compact_records(records, max_seq_length, max_predictions_per_seq,
+                            has_masked_lm):
+  """Decodes a batch of compact records to padded TensorFlow examples.
+
+  Compact records store the ids unpadded as packed bytes of the size given
+  by `id_bytes`, which are padded here as they are decoded. `input_mask`,
+  `segment_ids` and `masked_lm_weights` are derived from the lengths and
+  `segment_a_length`.
+  """
+  name_to_features = {
+      "input_ids": tf.io.FixedLenFeature([], tf.string),
+      "id_bytes": tf.io.FixedLenFeature([1], tf.int64),
+      "segment_a_length": tf.io.FixedLenFeature([1], tf.int64),
+      "next_sentence_labels": tf.io.FixedLenFeature([1], tf.int64),
+  }
+  if has_masked_lm:
+    name_to_features["masked_lm_positions"] = tf.io.FixedLenFeature(
+        [], tf.string)
+    name_to_features["masked_lm_ids"] = tf.io.FixedLenFeature([], tf.string)
+  example = tf.io.parse_example(serialized=records, features=name_to_features)
+
+  id_bytes = tf.cast(example["id_bytes"], tf.int32)
+
+  def decode_ids(name, length):
+    """Decodes little-endian ids of 2 or 4 bytes, as given by `id_bytes`."""
+    values = tf.cast(
+        tf.io.decode_raw(example[name], tf.uint8, fixed_length=length * 4),
+        tf.int32)
+    uint16_values = tf.reshape(values[:, :length * 2], [-1, length, 2])
+    int32_values = tf.reshape(values, [-1, length, 4])
+    ids = tf.where(
+        tf.equal(id_bytes, 2),
+        tf.reduce_sum(uint16_values * [1, 1 << 8], axis=-1),
+        tf.reduce_sum(int32_values * [1, 1 << 8, 1 << 16, 1 << 24], axis=-1))
+    return (ids, tf.strings.length(example[name]) // id_bytes[:, 0])
+
+  features = {}
+  (features["input_ids"], input_length) = decode_ids("input_ids",
+                                                     max_seq_length)
+  positions = tf.range(max_seq_length)[None, :]
+  segment_a_length = tf.cast(example["segment_a_length"], tf.int32)
+  features["input_mask"] = tf.sequence_mask(
+      input_length, max_seq_length, dtype=tf.int32)
+  features["segment_ids"] = tf.cast(
+      tf.logical_and(positions >= segment_a_length,
+                     positions < input_length[:, None]), tf.int32)
+  features["next_sentence_labels"] = tf.cast(example["next_sentence_labels"],
+                                             tf.int32)
+  if has_masked_lm:
+    features["masked_lm_positions"] = tf.cast(
+        tf.io.decode_raw(example["masked_lm_positions"], tf.uint16,
+                         fixed_length=max_predictions_per_seq * 2), tf.int32)
+    (features["masked_lm_ids"], num_masked_lm) = decode_ids(
+        "masked_lm_ids", max_predictions_per_seq)
+    features["masked_lm_weights"] = tf.sequence_mask(
+        num_masked_lm, max_predictions_per_seq, dtype=tf.float32)
+  return features
+
+
 def main(_):
   tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
 
@@ -511,7 +921,27 @@ def main(_):
   if not FLAGS.do_train and not FLAGS.do_eval:
     raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
+  if FLAGS.compute_type not in ("float32", "float16", "bfloat16"):
+    raise ValueError("Unsupported `compute_type`: %s" % FLAGS.compute_type)
+
+  masked_lm_config = None
+  if FLAGS.dynamic_masking:
+    if not FLAGS.vocab_file:
+      raise ValueError("`vocab_file` is required with `dynamic_masking`.")
+    masked_lm_config = MaskedLmConfig(
+        tokenization.load_vocab(FLAGS.vocab_file),
+        masked_lm_prob=FLAGS.masked_lm_prob,
+        do_whole_word_mask=FLAGS.do_whole_word_mask)
+
   bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  if FLAGS.phase2_input_file and (FLAGS.phase2_max_seq_length >
+                                  bert_config.max_position_embeddings):
+    raise ValueError(
+        "Cannot use sequence length %d because the BERT model "
+        "was only trained up to sequence length %d" %
+        (FLAGS.phase2_max_seq_length, bert_config.max_position_embeddings))
+  if FLAGS.compact_records and FLAGS.max_sequences_per_row > 1:
+    raise ValueError("Compact records cannot hold packed sequences.")
 
   tf.io.gfile.makedirs(FLAGS.output_dir)
 
@@ -556,7 +986,9 @@ def main(_):
       num_warmup_steps=FLAGS.num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
       use_one_hot_embeddings=FLAGS.use_tpu,
-      use_hvd=use_hvd)
+      use_hvd=use_hvd,
+      gradient_accumulation_steps=FLAGS.gradient_accumulation_steps,
+      compute_type=tf.as_dtype(FLAGS.compute_type))
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -568,31 +1000,49 @@ def main(_):
       eval_batch_size=FLAGS.eval_batch_size)
 
   if FLAGS.do_train:
-    tf.compat.v1.logging.info("***** Running training *****")
-    tf.compat.v1.logging.info("  Batch size = %d", FLAGS.train_batch_size)
-    train_input_fn = input_fn_builder(
-        input_files=input_files,
-        max_seq_length=FLAGS.max_seq_length,
-        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=True)
-
-    hooks = []
-
-    if (not use_hvd) or (hvd.rank() == 0):
-      global_batch_size = FLAGS.train_batch_size if not use_hvd else FLAGS.train_batch_size * hvd.size()
-      hooks.append(LogSessionRunHook(global_batch_size, FLAGS.num_report_steps, FLAGS.output_dir))
-
-    if use_hvd:
-      # [HVD] Ensure all GPU's start with the same weights.
-      hooks.append(hvd.BroadcastGlobalVariablesHook(0))
-
-    if FLAGS.enable_timeline:
-      profiler_hook = tf.estimator.ProfilerHook(
-        save_steps=FLAGS.num_timeline_steps,
-        output_dir=FLAGS.output_dir)
-      hooks.append(profiler_hook)
-
-    estimator.train(input_fn=train_input_fn, max_steps=FLAGS.num_train_steps, hooks=hooks)
+    # Every phase resumes from the latest checkpoint in `output_dir`, and the
+    # learning rate schedule spans all of `num_train_steps`. A restarted run
+    # skips the phases which are already done.
+    for (phase_index, phase) in enumerate(
+        get_training_phases(input_files, FLAGS.num_train_steps)):
+      tf.compat.v1.logging.info("***** Running training phase %d *****",
+                                phase_index + 1)
+      tf.compat.v1.logging.info("  Batch size = %d", phase.train_batch_size)
+      tf.compat.v1.logging.info("  Sequence length = %d", phase.max_seq_length)
+      tf.compat.v1.logging.info("  Last step = %d", phase.last_step)
+      if phase.train_batch_size != FLAGS.train_batch_size:
+        estimator = tf.compat.v1.estimator.tpu.TPUEstimator(
+            use_tpu=FLAGS.use_tpu,
+            model_fn=model_fn,
+            config=run_config,
+            train_batch_size=phase.train_batch_size,
+            eval_batch_size=FLAGS.eval_batch_size)
+      train_input_fn = input_fn_builder(
+          input_files=phase.input_files,
+          max_seq_length=phase.max_seq_length,
+          max_predictions_per_seq=phase.max_predictions_per_seq,
+          is_training=True,
+          masked_lm_config=masked_lm_config,
+          compact_records=FLAGS.compact_records,
+          max_sequences_per_row=FLAGS.max_sequences_per_row)
+
+      hooks = []
+
+      if (not use_hvd) or (hvd.rank() == 0):
+        global_batch_size = phase.train_batch_size if not use_hvd else phase.train_batch_size * hvd.size()
+        hooks.append(LogSessionRunHook(global_batch_size, FLAGS.num_report_steps, FLAGS.output_dir))
+
+      if use_hvd:
+        # [HVD] Ensure all GPU's start with the same weights.
+        hooks.append(hvd.BroadcastGlobalVariablesHook(0))
+
+      if FLAGS.enable_timeline:
+        profiler_hook = tf.estimator.ProfilerHook(
+          save_steps=FLAGS.num_timeline_steps,
+          output_dir=FLAGS.output_dir)
+        hooks.append(profiler_hook)
+
+      estimator.train(input_fn=train_input_fn, max_steps=phase.last_step, hooks=hooks)
 
   if FLAGS.do_eval:
     tf.compat.v1.logging.info("***** Running evaluation *****")
@@ -602,7 +1052,10 @@ def main(_):
         input_files=input_files,
         max_seq_length=FLAGS.max_seq_length,
         max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=False)
+        is_training=False,
+        masked_lm_config=masked_lm_config,
+        compact_records=FLAGS.compact_records,
+        max_sequences_per_row=FLAGS.max_sequences_per_row)
 
     result = estimator.evaluate(
         input_fn=eval_input_fn, steps=FLAGS.max_eval_steps)
@@ -0,0 +1,254 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import random
+import create_pretraining_data
+import numpy as np
+import tokenization
+import tensorflow as tf
+from absl.testing import flagsaver
+
+# Both scripts define flags such as `input_file`. Let run_pretraining
+# redefine the flags of create_pretraining_data.
+for _name in list(tf.compat.v1.flags.FLAGS):
+  tf.compat.v1.flags.FLAGS[_name].allow_override = True
+import run_pretraining  # pylint: disable=g-import-not-at-top
+
+
+_VOCAB_TOKENS = [
+    "[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "the", "un", "##want",
+    "##ed", "runn", "##ing", "man", "is", "a", "##n", ",", "."
+]
+
+
+def _create_batch(rng, batch_size, seq_length):
+  """Random [CLS] A [SEP] B [SEP] id arrays, padded to `seq_length`."""
+  input_ids = np.zeros([batch_size, seq_length], dtype=np.int32)
+  input_mask = np.zeros([batch_size, seq_length], dtype=np.int32)
+  for i in range(batch_size):
+    length = rng.randint(5, seq_length)
+    ids = [rng.randint(5, len(_VOCAB_TOKENS) - 1) for _ in range(length)]
+    ids[0] = 2
+    ids[rng.randint(2, length - 2)] = 3
+    ids[-1] = 3
+    input_ids[i, :length] = ids
+    input_mask[i, :length] = 1
+  return (input_ids, input_mask)
+
+
+class RunPretrainingTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(RunPretrainingTest, self).setUp()
+    self.vocab = collections.OrderedDict(
+        (token, i) for (i, token) in enumerate(_VOCAB_TOKENS))
+
+  def _mask(self, input_ids, input_mask, max_predictions_per_seq,
+            do_whole_word_mask=False, seed=None):
+    """Runs `create_masked_lm_predictions` on numpy arrays."""
+    config = run_pretraining.MaskedLmConfig(
+        self.vocab, masked_lm_prob=0.15, do_whole_word_mask=do_whole_word_mask)
+    with tf.Graph().as_default(), self.session() as sess:
+      features = run_pretraining.create_masked_lm_predictions(
+          {"input_ids": tf.constant(input_ids),
+           "input_mask": tf.constant(input_mask)},
+          max_predictions_per_seq, config, seed)
+      return sess.run(features)
+
+  def _check_batch(self, do_whole_word_mask):
+    (input_ids, input_mask) = _create_batch(random.Random(1), 200, 32)
+    features = self._mask(input_ids, input_mask, 5, do_whole_word_mask)
+
+    positions = features["masked_lm_positions"]
+    weights = features["masked_lm_weights"]
+    self.assertAllEqual(positions.shape, [200, 5])
+    for i in range(200):
+      length = np.sum(input_mask[i])
+      num_predictions = int(np.sum(weights[i]))
+      num_to_predict = min(5, max(1, int(round(length * 0.15))))
+      row_positions = list(positions[i, :num_predictions])
+
+      self.assertLessEqual(num_predictions, num_to_predict)
+      if not do_whole_word_mask:
+        self.assertEqual(num_predictions, num_to_predict)
+      self.assertAllEqual(weights[i, :num_predictions],
+                          [1.0] * num_predictions)
+      self.assertAllEqual(row_positions, sorted(set(row_positions)))
+      self.assertAllEqual(positions[i, num_predictions:],
+                          [0] * (5 - num_predictions))
+      self.assertAllEqual(features["masked_lm_ids"][i, :num_predictions],
+                          input_ids[i, row_positions])
+      self.assertAllEqual(features["masked_lm_ids"][i, num_predictions:],
+                          [0] * (5 - num_predictions))
+      for j in range(32):
+        if j in row_positions:
+          # Neither padding nor [CLS] and [SEP] are ever masked.
+          self.assertEqual(input_mask[i, j], 1)
+          self.assertNotIn(input_ids[i, j], (2, 3))
+        else:
+          self.assertEqual(features["input_ids"][i, j], input_ids[i, j])
+
+      if do_whole_word_mask:
+        # A "##" piece is masked exactly when the piece before it is.
+        for j in range(1, length):
+          if (_VOCAB_TOKENS[input_ids[i, j]].startswith("##") and
+              input_ids[i, j - 1] not in (2, 3)):
+            self.assertEqual(j in row_positions, j - 1 in row_positions)
+
+  def test_masked_lm_predictions(self):
+    self._check_batch(do_whole_word_mask=False)
+
+  def test_masked_lm_predictions_whole_word(self):
+    self._check_batch(do_whole_word_mask=True)
+
+  def test_masked_lm_predictions_budget(self):
+    # 15% of the 64 tokens of each row would be 10 predictions.
+    input_ids = np.full([50, 64], 5, dtype=np.int32)
+    input_ids[:, 0] = 2
+    input_ids[:, -1] = 3
+    features = self._mask(input_ids, np.ones_like(input_ids), 3)
+    self.assertAllEqual(np.sum(features["masked_lm_weights"], axis=1),
+                        [3.0] * 50)
+    self.assertAllEqual(
+        np.sum(features["input_ids"] != input_ids, axis=1) <= 3, [True] * 50)
+
+  def test_masked_lm_predictions_replacement(self):
+    input_ids = np.full([20000, 8], 5, dtype=np.int32)
+    features = self._mask(input_ids, np.ones_like(input_ids), 1)
+    self.assertAllEqual(features["masked_lm_weights"], np.ones([20000, 1]))
+
+    replaced = np.take_along_axis(features["input_ids"],
+                                  features["masked_lm_positions"], axis=1)
+    # Random replacements are uniform over the vocab, so a few of them are
+    # the original token or [MASK].
+    self.assertNear(np.mean(replaced == 4), 0.8 + 0.1 / 17, 0.01)
+    self.assertNear(np.mean(replaced == 5), 0.1 + 0.1 / 17, 0.01)
+
+  def test_masked_lm_predictions_seed(self):
+    (input_ids, input_mask) = _create_batch(random.Random(2), 100, 32)
+    first = self._mask(input_ids, input_mask, 5, seed=12345)
+    second = self._mask(input_ids, input_mask, 5, seed=12345)
+    other = self._mask(input_ids, input_mask, 5, seed=54321)
+    for name in first:
+      self.assertAllEqual(first[name], second[name])
+    self.assertNotAllEqual(first["masked_lm_positions"],
+                           other["masked_lm_positions"])
+
+  def _read_batch(self, input_files, batch_size, compact_records):
+    input_fn = run_pretraining.input_fn_builder(
+        input_files=input_files,
+        max_seq_length=16,
+        max_predictions_per_seq=4,
+        is_training=False,
+        compact_records=compact_records)
+    with tf.Graph().as_default(), self.session() as sess:
+      dataset = input_fn({"batch_size": batch_size})
+      return sess.run(
+          tf.compat.v1.data.make_one_shot_iterator(dataset).get_next())
+
+  def test_compact_records(self):
+    rng = random.Random(3)
+    padded_files = []
+    compact_files = []
+    # Ids are packed in 2 bytes for the first vocab and in 4 for the others,
+    # and a batch has records of all of them. The last vocab has fewer than
+    # 1 << 16 distinct tokens, but its duplicate lines repeat the first tokens
+    # with ids above that.
+    for (num_lines, num_duplicates) in [(1000, 0), (70000, 0), (65540, 10)]:
+      vocab_file = os.path.join(self.get_temp_dir(), "vocab-%d.txt" % num_lines)
+      with tf.io.gfile.GFile(vocab_file, "w") as writer:
+        writer.write("".join(
+            "token%d\n" % (i % (num_lines - num_duplicates))
+            for i in range(num_lines)))
+      tokenizer = tokenization.FullTokenizer(vocab_file)
+      top_tokens = [x for (x, i) in tokenizer.vocab.items()
+                    if i >= num_lines - 10]
+      instances = []
+      for _ in range(5):
+        length = rng.randint(4, 16)
+        tokens = [rng.choice(top_tokens) for _ in range(length)]
+        segment_a_length = rng.randint(1, length - 1)
+        positions = sorted(rng.sample(range(length), rng.randint(1, 4)))
+        instances.append(
+            create_pretraining_data.TrainingInstance(
+                tokens=tokens,
+                segment_ids=([0] * segment_a_length +
+                             [1] * (length - segment_a_length)),
+                masked_lm_positions=positions,
+                masked_lm_labels=[tokens[i] for i in positions],
+                is_random_next=rng.random() < 0.5))
+      for (files, compact) in [(padded_files, False), (compact_files, True)]:
+        files.append(os.path.join(
+            self.get_temp_dir(), "%s-%d" % (compact, num_lines)))
+        create_pretraining_data.write_instance_to_example_files(
+            instances, tokenizer, 16, 4, [files[-1]], compact=compact)
+
+    padded = self._read_batch(padded_files, 15, compact_records=False)
+    compact = self._read_batch(compact_files, 15, compact_records=True)
+    self.assertGreater(np.max(compact["input_ids"]), 1 << 16)
+    self.assertCountEqual(compact.keys(), padded.keys())
+    for name in padded:
+      self.assertAllEqual(compact[name], padded[name])
+
+  def test_training_phases(self):
+    tf.compat.v1.flags.FLAGS.mark_as_parsed()
+    input_files = ["phase1-00000", "phase1-00001"]
+    with flagsaver.flagsaver(max_seq_length=128, max_predictions_per_seq=20,
+                             train_batch_size=256, phase2_input_file=None):
+      self.assertEqual(
+          run_pretraining.get_training_phases(input_files, 1000),
+          [run_pretraining.TrainingPhase(input_files, 128, 20, 256, 1000)])
+
+    phase2_pattern = os.path.join(self.get_temp_dir(), "phase2-*")
+    phase2_files = [os.path.join(self.get_temp_dir(), "phase2-%05d" % i)
+                    for i in range(2)]
+    for path in phase2_files:
+      with tf.io.gfile.GFile(path, "w") as writer:
+        writer.write("")
+    with flagsaver.flagsaver(
+        max_seq_length=128, max_predictions_per_seq=20, train_batch_size=256,
+        phase2_input_file=phase2_pattern, phase1_fraction=0.9,
+        phase2_max_seq_length=512, phase2_max_predictions_per_seq=80):
+      for (phase2_train_batch_size, expected_batch_size) in [(None, 256),
+                                                             (32, 32)]:
+        with flagsaver.flagsaver(
+            phase2_train_batch_size=phase2_train_batch_size):
+          phases = run_pretraining.get_training_phases(input_files, 1000)
+        self.assertEqual(phases[0], run_pretraining.TrainingPhase(
+            input_files, 128, 20, 256, 900))
+        self.assertCountEqual(phases[1].input_files, phase2_files)
+        self.assertEqual(phases[1]._replace(input_files=None),
+                         run_pretraining.TrainingPhase(
+                             None, 512, 80, expected_batch_size, 1000))
+
+      # Each phase needs at least one step.
+      for (phase1_fraction, num_train_steps) in [(0.0, 1000), (1.0, 1000),
+                                                 (-0.5, 1000), (0.1, 5)]:
+        with flagsaver.flagsaver(phase1_fraction=phase1_fraction):
+          with self.assertRaisesRegex(ValueError, "phase1_fraction"):
+            run_pretraining.get_training_phases(input_files, num_train_steps)
+
+  def test_offset_seed(self):
+    self.assertIsNone(run_pretraining._offset_seed(None, 1))
+    self.assertEqual(run_pretraining._offset_seed(12345, 2), 12347)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -18,11 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
 import collections
 import json
 import math
 import os
 import random
+import time
+import bucketing
 import modeling
 import optimization
 import tokenization
@@ -71,6 +74,14 @@ flags.DEFINE_integer(
     "Sequences longer than this will be truncated, and sequences shorter "
     "than this will be padded.")
 
+flags.DEFINE_string(
+    "length_buckets", None,
+    "Comma-separated sequence lengths, e.g. 128,256. If set, batches are only "
+    "padded to the smallest of these lengths (or `max_seq_length`) which "
+    "holds all of their sequences, and training batches are drawn from "
+    "features of similar length. Not supported on TPU, which requires fixed "
+    "shapes.")
+
 flags.DEFINE_integer(
     "doc_stride", 128,
     "When splitting up a long document into chunks, how much stride to "
@@ -81,12 +92,24 @@ flags.DEFINE_integer(
     "The maximum number of tokens for the question. Questions longer than "
     "this will be truncated to this length.")
 
+flags.DEFINE_string(
+    "compute_type", "float32",
+    "Data type of the transformer layers - float32 (default), float16 or "
+    "bfloat16. The weights are kept in float32, and float16 also enables "
+    "dynamic loss scaling.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_predict", False, "Whether to run eval on the dev set.")
 
 flags.DEFINE_integer("train_batch_size", 32, "Total batch size for training.")
 
+flags.DEFINE_integer(
+    "gradient_accumulation_steps", 1,
+    "Number of batches whose gradients are accumulated before each "
+    "optimizer step. The effective batch size is `train_batch_size` times "
+    "this.")
+
 flags.DEFINE_integer("predict_batch_size", 8,
                      "Total batch size for predictions.")
 
@@ -142,11 +165,6 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
-flags.DEFINE_bool(
-    "verbose_logging", False,
-    "If true, all of the warnings related to data processing will be printed. "
-    "A number of warnings are expected for a normal SQuAD evaluation.")
-
 flags.DEFINE_bool(
     "version_2_with_negative", False,
     "If true, the SQuAD examples contain some that do not have an answer.")
@@ -168,6 +186,10 @@ class SquadExample(object):
   """A single training/test example for simple sequence classification.
 
      For examples without an answer, the start and end position are -1.
+
+     `start_position` and `end_position` index `doc_tokens`, while
+     `char_start_position` and `char_end_position` (both inclusive) index the
+     characters of `" ".join(doc_tokens)`.
   """
 
   def __init__(self,
@@ -177,7 +199,9 @@ class SquadExample(object):
                orig_answer_text=None,
                start_position=None,
                end_position=None,
-               is_impossible=False):
+               is_impossible=False,
+               char_start_position=None,
+               char_end_position=None):
     self.qas_id = qas_id
     self.question_text = question_text
     self.doc_tokens = doc_tokens
@@ -185,6 +209,8 @@ class SquadExample(object):
     self.start_position = start_position
     self.end_position = end_position
     self.is_impossible = is_impossible
+    self.char_start_position = char_start_position
+    self.char_end_position = char_end_position
 
   def __str__(self):
     return self.__repr__()
@@ -219,12 +245,14 @@ class InputFeatures(object):
                segment_ids,
                start_position=None,
                end_position=None,
-               is_impossible=None):
+               is_impossible=None,
+               token_to_char_offsets=None):
     self.unique_id = unique_id
     self.example_index = example_index
     self.doc_span_index = doc_span_index
     self.tokens = tokens
     self.token_to_orig_map = token_to_orig_map
+    self.token_to_char_offsets = token_to_char_offsets
     self.token_is_max_context = token_is_max_context
     self.input_ids = input_ids
     self.input_mask = input_mask
@@ -250,16 +278,25 @@ def read_squad_examples(input_file, is_training):
       paragraph_text = paragraph["context"]
       doc_tokens = []
       char_to_word_offset = []
+      # Maps each character of the paragraph to its position in
+      # `" ".join(doc_tokens)`. Whitespace maps to the end of the word before.
+      char_to_doc_text_offset = []
+      doc_text_length = 0
       prev_is_whitespace = True
       for c in paragraph_text:
         if is_whitespace(c):
           prev_is_whitespace = True
+          char_to_doc_text_offset.append(max(doc_text_length - 1, 0))
         else:
           if prev_is_whitespace:
+            if doc_tokens:
+              doc_text_length += 1
             doc_tokens.append(c)
           else:
             doc_tokens[-1] += c
           prev_is_whitespace = False
+          char_to_doc_text_offset.append(doc_text_length)
+          doc_text_length += 1
         char_to_word_offset.append(len(doc_tokens) - 1)
 
       for qa in paragraph["qas"]:
@@ -267,6 +304,8 @@ def read_squad_examples(input_file, is_training):
         question_text = qa["question"]
         start_position = None
         end_position = None
+        char_start_position = None
+        char_end_position = None
         orig_answer_text = None
         is_impossible = False
         if is_training:
@@ -284,6 +323,9 @@ def read_squad_examples(input_file, is_training):
             start_position = char_to_word_offset[answer_offset]
             end_position = char_to_word_offset[answer_offset + answer_length -
                                                1]
+            char_start_position = char_to_doc_text_offset[answer_offset]
+            char_end_position = char_to_doc_text_offset[answer_offset +
+                                                        answer_length - 1]
             # Only add answers where the text can be exactly recovered from the
             # document. If this CAN'T happen it's likely due to weird Unicode
             # stuff so we will just skip the example.
@@ -310,7 +352,9 @@ def read_squad_examples(input_file, is_training):
             orig_answer_text=orig_answer_text,
             start_position=start_position,
             end_position=end_position,
-            is_impossible=is_impossible)
+            is_impossible=is_impossible,
+            char_start_position=char_start_position,
+            char_end_position=char_end_position)
         examples.append(example)
 
   return examples
@@ -329,15 +373,25 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     if len(query_tokens) > max_query_length:
       query_tokens = query_tokens[0:max_query_length]
 
+    # The whole document is tokenized in one pass. Each WordPiece token is
+    # then mapped back to the whitespace token it came from through its
+    # character offsets.
+    doc_text = " ".join(example.doc_tokens)
+    (all_doc_tokens, all_doc_offsets) = tokenizer.tokenize_with_offsets(
+        doc_text)
+
+    doc_token_starts = []
+    doc_text_length = 0
+    for token in example.doc_tokens:
+      doc_token_starts.append(doc_text_length)
+      doc_text_length += len(token) + 1
+
     tok_to_orig_index = []
+    for (start, _) in all_doc_offsets:
+      tok_to_orig_index.append(bisect.bisect_right(doc_token_starts, start) - 1)
     orig_to_tok_index = []
-    all_doc_tokens = []
-    for (i, token) in enumerate(example.doc_tokens):
-      orig_to_tok_index.append(len(all_doc_tokens))
-      sub_tokens = tokenizer.tokenize(token)
-      for sub_token in sub_tokens:
-        tok_to_orig_index.append(i)
-        all_doc_tokens.append(sub_token)
+    for i in range(len(example.doc_tokens)):
+      orig_to_tok_index.append(bisect.bisect_left(tok_to_orig_index, i))
 
     tok_start_position = None
     tok_end_position = None
@@ -351,8 +405,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       else:
         tok_end_position = len(all_doc_tokens) - 1
       (tok_start_position, tok_end_position) = _improve_answer_span(
-          all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
-          example.orig_answer_text)
+          all_doc_offsets, tok_start_position, tok_end_position,
+          example.char_start_position, example.char_end_position)
 
     # The -3 accounts for [CLS], [SEP] and [SEP]
     max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
@@ -376,6 +430,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     for (doc_span_index, doc_span) in enumerate(doc_spans):
       tokens = []
       token_to_orig_map = {}
+      token_to_char_offsets = {}
       token_is_max_context = {}
       segment_ids = []
       tokens.append("[CLS]")
@@ -389,6 +444,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       for i in range(doc_span.length):
         split_token_index = doc_span.start + i
         token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+        token_to_char_offsets[len(tokens)] = all_doc_offsets[split_token_index]
 
         is_max_context = _check_is_max_context(doc_spans, doc_span_index,
                                                split_token_index)
@@ -475,7 +531,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
           segment_ids=segment_ids,
           start_position=start_position,
           end_position=end_position,
-          is_impossible=example.is_impossible)
+          is_impossible=example.is_impossible,
+          token_to_char_offsets=token_to_char_offsets)
 
       # Run callback
       output_fn(feature)
@@ -483,8 +540,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       unique_id += 1
 
 
-def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
-                         orig_answer_text):
+def _improve_answer_span(doc_offsets, input_start, input_end,
+                         char_start_position, char_end_position):
   """Returns tokenized answer spans that better match the annotated answer."""
 
   # The SQuAD annotations are character based. We first project them to
@@ -509,13 +566,23 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
   # the word "Japanese". Since our WordPiece tokenizer does not split
   # "Japanese", we just use "Japanese" as the annotation. This is fairly rare
   # in SQuAD, but does happen.
-  tok_answer_text = " ".join(tokenizer.tokenize(orig_answer_text))
+  #
+  # The character offsets of the tokens tell us directly whether some tokens
+  # start and end exactly where the annotated answer does.
+  if char_start_position is None or char_end_position is None:
+    return (input_start, input_end)
+
+  new_start = None
+  for i in range(input_start, input_end + 1):
+    if doc_offsets[i][0] == char_start_position:
+      new_start = i
+      break
+  if new_start is None:
+    return (input_start, input_end)
 
-  for new_start in range(input_start, input_end + 1):
-    for new_end in range(input_end, new_start - 1, -1):
-      text_span = " ".join(doc_tokens[new_start:(new_end + 1)])
-      if text_span == tok_answer_text:
-        return (new_start, new_end)
+  for new_end in range(input_end, new_start - 1, -1):
+    if doc_offsets[new_end][1] == char_end_position + 1:
+      return (new_start, new_end)
 
   return (input_start, input_end)
 
@@ -558,7 +625,7 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
 
 
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 use_one_hot_embeddings):
+                 use_one_hot_embeddings, compute_type=tf.float32):
   """Creates a classification model."""
   model = modeling.BertModel(
       config=bert_config,
@@ -566,7 +633,8 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      compute_type=compute_type)
 
   final_hidden = model.get_sequence_output()
 
@@ -599,7 +667,8 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
 
 def model_fn_builder(bert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, gradient_accumulation_steps=1,
+                     compute_type=tf.float32):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -622,7 +691,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         input_ids=input_ids,
         input_mask=input_mask,
         segment_ids=segment_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        compute_type=compute_type)
 
     tvars = tf.compat.v1.trainable_variables()
 
@@ -670,7 +740,9 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
       total_loss = (start_loss + end_loss) / 2.0
 
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          gradient_accumulation_steps=gradient_accumulation_steps,
+          dynamic_loss_scaling=(compute_type == tf.float16))
 
       output_spec = tf.compat.v1.estimator.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -694,8 +766,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
   return model_fn
 
 
-def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+def input_fn_builder(input_file, seq_length, is_training, drop_remainder,
+                     length_buckets=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `length_buckets` is given, the batches are cut to variable lengths by
+  `bucketing.batch_by_length`.
+  """
 
   name_to_features = {
       "unique_ids": tf.io.FixedLenFeature([], tf.int64),
@@ -733,6 +810,13 @@ def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
+    if length_buckets:
+      d = d.map(lambda record: _decode_record(record, name_to_features))
+      return bucketing.batch_by_length(
+          d, batch_size, length_buckets, seq_length,
+          ["input_ids", "input_mask", "segment_ids"], is_training,
+          drop_remainder)
+
     d = d.apply(
         tf.data.experimental.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -749,7 +833,7 @@ RawResult = collections.namedtuple("RawResult",
 
 
 def write_predictions(all_examples, all_features, all_results, n_best_size,
-                      max_answer_length, do_lower_case, output_prediction_file,
+                      max_answer_length, output_prediction_file,
                       output_nbest_file, output_null_log_odds_file):
   """Write final predictions to the json file and log-odds of null if needed."""
   tf.compat.v1.logging.info("Writing predictions to: %s" % (output_prediction_file))
@@ -773,6 +857,7 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
 
   for (example_index, example) in enumerate(all_examples):
     features = example_index_to_features[example_index]
+    doc_text = " ".join(example.doc_tokens)
 
     prelim_predictions = []
     # keep track of the minimum score of null start+end of position 0
@@ -843,22 +928,8 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
         break
       feature = features[pred.feature_index]
       if pred.start_index > 0:  # this is a non-null prediction
-        tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-        orig_doc_start = feature.token_to_orig_map[pred.start_index]
-        orig_doc_end = feature.token_to_orig_map[pred.end_index]
-        orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-        tok_text = " ".join(tok_tokens)
-
-        # De-tokenize WordPieces that have been split off.
-        tok_text = tok_text.replace(" ##", "")
-        tok_text = tok_text.replace("##", "")
-
-        # Clean whitespace
-        tok_text = tok_text.strip()
-        tok_text = " ".join(tok_text.split())
-        orig_text = " ".join(orig_tokens)
-
-        final_text = get_final_text(tok_text, orig_text, do_lower_case)
+        final_text = get_final_text(doc_text, feature.token_to_char_offsets,
+                                    pred.start_index, pred.end_index)
         if final_text in seen_predictions:
           continue
 
@@ -934,100 +1005,23 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
       writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
 
-def get_final_text(pred_text, orig_text, do_lower_case):
+def get_final_text(doc_text, token_to_char_offsets, start_index, end_index):
   """Project the tokenized prediction back to the original text."""
 
-  # When we created the data, we kept track of the alignment between original
-  # (whitespace tokenized) tokens and our WordPiece tokenized tokens. So
-  # now `orig_text` contains the span of our original text corresponding to the
-  # span that we predicted.
-  #
-  # However, `orig_text` may contain extra characters that we don't want in
-  # our prediction.
+  # When we created the features, we kept the span of `doc_text` (the
+  # whitespace-joined document) that each WordPiece token was produced from.
+  # So the prediction is just the original text from the start of its first
+  # token to the end of its last token.
   #
   # For example, let's say:
-  #   pred_text = steve smith
-  #   orig_text = Steve Smith's
-  #
-  # We don't want to return `orig_text` because it contains the extra "'s".
-  #
-  # We don't want to return `pred_text` because it's already been normalized
-  # (the SQuAD eval script also does punctuation stripping/lower casing but
-  # our tokenizer does additional normalization like stripping accent
-  # characters).
+  #   tokens    = steve smith ' s
+  #   doc_text  = Steve Smith's
   #
-  # What we really want to return is "Steve Smith".
-  #
-  # Therefore, we have to apply a semi-complicated alignment heruistic between
-  # `pred_text` and `orig_text` to get a character-to-charcter alignment. This
-  # can fail in certain cases in which case we just return `orig_text`.
-
-  def _strip_spaces(text):
-    ns_chars = []
-    ns_to_s_map = collections.OrderedDict()
-    for (i, c) in enumerate(text):
-      if c == " ":
-        continue
-      ns_to_s_map[len(ns_chars)] = i
-      ns_chars.append(c)
-    ns_text = "".join(ns_chars)
-    return (ns_text, ns_to_s_map)
-
-  # We first tokenize `orig_text`, strip whitespace from the result
-  # and `pred_text`, and check if they are the same length. If they are
-  # NOT the same length, the heuristic has failed. If they are the same
-  # length, we assume the characters are one-to-one aligned.
-  tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
-
-  tok_text = " ".join(tokenizer.tokenize(orig_text))
-
-  start_position = tok_text.find(pred_text)
-  if start_position == -1:
-    if FLAGS.verbose_logging:
-      tf.compat.v1.logging.info(
-          "Unable to find text: '%s' in '%s'" % (pred_text, orig_text))
-    return orig_text
-  end_position = start_position + len(pred_text) - 1
-
-  (orig_ns_text, orig_ns_to_s_map) = _strip_spaces(orig_text)
-  (tok_ns_text, tok_ns_to_s_map) = _strip_spaces(tok_text)
-
-  if len(orig_ns_text) != len(tok_ns_text):
-    if FLAGS.verbose_logging:
-      tf.compat.v1.logging.info("Length not equal after stripping spaces: '%s' vs '%s'",
-                      orig_ns_text, tok_ns_text)
-    return orig_text
-
-  # We then project the characters in `pred_text` back to `orig_text` using
-  # the character-to-character alignment.
-  tok_s_to_ns_map = {}
-  for (i, tok_index) in six.iteritems(tok_ns_to_s_map):
-    tok_s_to_ns_map[tok_index] = i
-
-  orig_start_position = None
-  if start_position in tok_s_to_ns_map:
-    ns_start_position = tok_s_to_ns_map[start_position]
-    if ns_start_position in orig_ns_to_s_map:
-      orig_start_position = orig_ns_to_s_map[ns_start_position]
-
-  if orig_start_position is None:
-    if FLAGS.verbose_logging:
-      tf.compat.v1.logging.info("Couldn't map start position")
-    return orig_text
-
-  orig_end_position = None
-  if end_position in tok_s_to_ns_map:
-    ns_end_position = tok_s_to_ns_map[end_position]
-    if ns_end_position in orig_ns_to_s_map:
-      orig_end_position = orig_ns_to_s_map[ns_end_position]
-
-  if orig_end_position is None:
-    if FLAGS.verbose_logging:
-      tf.compat.v1.logging.info("Couldn't map end position")
-    return orig_text
-
-  output_text = orig_text[orig_start_position:(orig_end_position + 1)]
-  return output_text
+  # A prediction of "steve smith" gives "Steve Smith", with the original
+  # casing and accents and without the extra "'s".
+  (start, _) = token_to_char_offsets[start_index]
+  (_, end) = token_to_char_offsets[end_index]
+  return doc_text[start:end]
 
 
 def _get_best_indexes(logits, n_best_size):
@@ -1132,6 +1126,12 @@ def validate_flags_or_throw(bert_config):
         "The max_seq_length (%d) must be greater than max_query_length "
         "(%d) + 3" % (FLAGS.max_seq_length, FLAGS.max_query_length))
 
+  if FLAGS.length_buckets and FLAGS.use_tpu:
+    raise ValueError("`length_buckets` is not supported on TPU.")
+
+  if FLAGS.compute_type not in ("float32", "float16", "bfloat16"):
+    raise ValueError("Unsupported `compute_type`: %s" % FLAGS.compute_type)
+
 
 def main(_):
   tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
@@ -1140,6 +1140,10 @@ def main(_):
 
   validate_flags_or_throw(bert_config)
 
+  length_buckets = None
+  if FLAGS.length_buckets:
+    length_buckets = [int(x) for x in FLAGS.length_buckets.split(",")]
+
   tf.io.gfile.makedirs(FLAGS.output_dir)
 
   tokenizer = tokenization.FullTokenizer(
@@ -1168,7 +1172,9 @@ def main(_):
     train_examples = read_squad_examples(
         input_file=FLAGS.train_file, is_training=True)
     num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        len(train_examples) / (FLAGS.train_batch_size *
+                               FLAGS.gradient_accumulation_steps) *
+        FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
 
     # Pre-shuffle the input to avoid having to make a very large shuffle
@@ -1183,7 +1189,9 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      gradient_accumulation_steps=FLAGS.gradient_accumulation_steps,
+      compute_type=tf.as_dtype(FLAGS.compute_type))
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -1221,7 +1229,8 @@ def main(_):
         input_file=train_writer.filename,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        length_buckets=length_buckets)
 
     hooks = []
     if FLAGS.enable_timeline:
@@ -1230,7 +1239,17 @@ def main(_):
         output_dir=FLAGS.output_dir)
       hooks.append(profiler_hook)
 
+    start_time = time.time()
     estimator.train(input_fn=train_input_fn, max_steps=num_train_steps, hooks=hooks)
+    train_time = time.time() - start_time
+    tf.compat.v1.logging.info("***** Training done *****")
+    tf.compat.v1.logging.info(
+        "  Throughput = %.1f examples/sec", num_train_steps *
+        FLAGS.train_batch_size * FLAGS.gradient_accumulation_steps / train_time)
+    if tf.config.list_physical_devices("GPU"):
+      tf.compat.v1.logging.info(
+          "  Peak memory = %.0f MB",
+          tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20)
 
   if FLAGS.do_predict:
     eval_examples = read_squad_examples(
@@ -1266,7 +1285,8 @@ def main(_):
         input_file=eval_writer.filename,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=False)
+        drop_remainder=False,
+        length_buckets=length_buckets)
 
     # If running eval on the TPU, you will need to specify the number of
     # steps.
@@ -1290,8 +1310,8 @@ def main(_):
 
     write_predictions(eval_examples, eval_features, all_results,
                       FLAGS.n_best_size, FLAGS.max_answer_length,
-                      FLAGS.do_lower_case, output_prediction_file,
-                      output_nbest_file, output_null_log_odds_file)
+                      output_prediction_file, output_nbest_file,
+                      output_null_log_odds_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import run_squad
+import tokenization
+import tensorflow as tf
+
+
+class RunSquadTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(RunSquadTest, self).setUp()
+    tf.compat.v1.flags.FLAGS.mark_as_parsed()
+    vocab_tokens = [
+        "[PAD]", "[UNK]", "[CLS]", "[SEP]", "le", "cafe", "zoe", ",", "a",
+        "paris", "(", "18", "##95", "-", "1943", ")", "etait", "celebre", ".",
+        "what", "when", "?"
+    ]
+    vocab_file = os.path.join(self.get_temp_dir(), "vocab.txt")
+    with tf.io.gfile.GFile(vocab_file, "w") as writer:
+      writer.write("".join([x + "\n" for x in vocab_tokens]))
+    self.tokenizer = tokenization.FullTokenizer(vocab_file)
+
+  def _read_examples(self, context, questions_and_answers, is_training=True):
+    """Returns the `SquadExample`s of one paragraph with these answers."""
+    qas = []
+    for (i, (question, answer)) in enumerate(questions_and_answers):
+      qas.append({
+          "id": str(i),
+          "question": question,
+          "answers": [{"text": answer, "answer_start": context.index(answer)}],
+      })
+    input_file = os.path.join(self.get_temp_dir(), "train.json")
+    with tf.io.gfile.GFile(input_file, "w") as writer:
+      writer.write(json.dumps(
+          {"data": [{"paragraphs": [{"context": context, "qas": qas}]}]}))
+    return run_squad.read_squad_examples(input_file, is_training=is_training)
+
+  def _convert(self, examples, max_seq_length, doc_stride, is_training=True):
+    features = []
+    run_squad.convert_examples_to_features(
+        examples=examples,
+        tokenizer=self.tokenizer,
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=8,
+        is_training=is_training,
+        output_fn=features.append)
+    return features
+
+  def test_answer_spans(self):
+    context = u"Le Café  Zoë,\tà Paris (1895-1943) était célèbre."
+    questions_and_answers = [
+        # Accents, punctuation and whitespace inside the answer.
+        (u"What?", u"Café  Zoë,\tà Paris"),
+        # Part of the whitespace token "(1895-1943)", split into WordPieces.
+        (u"When?", u"1895"),
+        (u"What?", u"célèbre."),
+    ]
+    expected_tokens = [
+        ["cafe", "zoe", ",", "a", "paris"],
+        ["18", "##95"],
+        ["celebre", "."],
+    ]
+    examples = self._read_examples(context, questions_and_answers)
+    self.assertLen(examples, 3)
+
+    for (max_seq_length, doc_stride) in [(32, 128), (12, 3)]:
+      features = self._convert(examples, max_seq_length, doc_stride)
+      num_answers = [0, 0, 0]
+      for feature in features:
+        if feature.start_position == 0 and feature.end_position == 0:
+          continue
+        example = examples[feature.example_index]
+        num_answers[feature.example_index] += 1
+        self.assertAllEqual(
+            feature.tokens[feature.start_position:feature.end_position + 1],
+            expected_tokens[feature.example_index])
+        # Predictions are taken from `" ".join(doc_tokens)`, so the
+        # whitespace inside the answer is normalized.
+        self.assertEqual(
+            run_squad.get_final_text(
+                " ".join(example.doc_tokens), feature.token_to_char_offsets,
+                feature.start_position, feature.end_position),
+            " ".join(example.orig_answer_text.split()))
+      # Every answer is in at least one of the doc spans.
+      self.assertAllGreater(num_answers, 0)
+
+  def test_write_predictions(self):
+    context = u"Le Café  Zoë,\tà Paris (1895-1943) était célèbre."
+    questions_and_answers = [
+        (u"What?", u"Café  Zoë,\tà Paris"),
+        (u"When?", u"1895"),
+        (u"What?", u"célèbre."),
+    ]
+    train_examples = self._read_examples(context, questions_and_answers)
+    eval_examples = self._read_examples(context, questions_and_answers,
+                                        is_training=False)
+
+    for (max_seq_length, doc_stride) in [(32, 128), (12, 3)]:
+      train_features = self._convert(train_examples, max_seq_length,
+                                     doc_stride)
+      eval_features = self._convert(eval_examples, max_seq_length, doc_stride,
+                                    is_training=False)
+      self.assertEqual([x.unique_id for x in eval_features],
+                       [x.unique_id for x in train_features])
+
+      # The logits of a model which predicts the answer wherever it is in the
+      # doc span.
+      all_results = []
+      for feature in train_features:
+        start_logits = [0.0] * max_seq_length
+        end_logits = [0.0] * max_seq_length
+        if feature.start_position > 0:
+          start_logits[feature.start_position] = 5.0
+          end_logits[feature.end_position] = 5.0
+        all_results.append(
+            run_squad.RawResult(
+                unique_id=feature.unique_id,
+                start_logits=start_logits,
+                end_logits=end_logits))
+
+      output_prediction_file = os.path.join(self.get_temp_dir(),
+                                            "predictions.json")
+      output_nbest_file = os.path.join(self.get_temp_dir(),
+                                       "nbest_predictions.json")
+      run_squad.write_predictions(
+          eval_examples, eval_features, all_results, n_best_size=3,
+          max_answer_length=10, output_prediction_file=output_prediction_file,
+          output_nbest_file=output_nbest_file,
+          output_null_log_odds_file=None)
+
+      with tf.io.gfile.GFile(output_prediction_file) as reader:
+        predictions = json.load(reader)
+      self.assertEqual(predictions, {
+          example.qas_id: " ".join(example.orig_answer_text.split())
+          for example in train_examples
+      })
+      with tf.io.gfile.GFile(output_nbest_file) as reader:
+        nbest = json.load(reader)
+      for example in train_examples:
+        self.assertLessEqual(len(nbest[example.qas_id]), 3)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -18,12 +18,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import mmap
+import multiprocessing
 import re
+import struct
+import sys
 import unicodedata
+import zlib
 import six
 import tensorflow as tf
 
+try:
+  from collections.abc import Mapping
+except ImportError:
+  from collections import Mapping
+
 
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
   """Checks whether the casing config is consistent with the checkpoint name."""
@@ -119,7 +130,19 @@ def printable_text(text):
 
 
 def load_vocab(vocab_file):
-  """Loads a vocabulary file into a dictionary."""
+  """Loads a vocabulary file into a dictionary.
+
+  `vocab_file` can be either a text file with one token per line, or a
+  compiled vocab written by `write_compiled_vocab`. The latter is returned as
+  a `CompiledVocab`, which behaves like a read-only dict.
+  """
+  if is_compiled_vocab(vocab_file):
+    return CompiledVocab(vocab_file)
+  return load_text_vocab(vocab_file)
+
+
+def load_text_vocab(vocab_file):
+  """Loads a text vocabulary file into a dictionary."""
   vocab = collections.OrderedDict()
   index = 0
   with tf.io.gfile.GFile(vocab_file, "r") as reader:
@@ -133,6 +156,178 @@ def load_vocab(vocab_file):
   return vocab
 
 
+# Compiled vocab file layout. All integers are little-endian uint32.
+#
+#   header:  magic, version, num_ids, num_tokens, num_buckets
+#   offsets: num_ids + 1 byte offsets into the blob; id `i` is the UTF-8
+#            string `blob[offsets[i]:offsets[i + 1]]`.
+#   buckets: open-addressing hash table of size num_buckets (a power of two)
+#            indexed by `zlib.crc32` of the token bytes and probed linearly.
+#            Each entry is the token's id + 1, or 0 for an empty bucket.
+#   blob:    The concatenated UTF-8 tokens.
+_COMPILED_VOCAB_MAGIC = b"BERTVOCB"
+_COMPILED_VOCAB_VERSION = 1
+_COMPILED_VOCAB_HEADER = struct.Struct("<8sIIII")
+
+
+def is_compiled_vocab(vocab_file):
+  """Checks whether `vocab_file` was written by `write_compiled_vocab`."""
+  with tf.io.gfile.GFile(vocab_file, "rb") as reader:
+    return reader.read(len(_COMPILED_VOCAB_MAGIC)) == _COMPILED_VOCAB_MAGIC
+
+
+def write_compiled_vocab(vocab_file, output_file):
+  """Converts a text vocab file into the compiled vocab format."""
+  tokens = []
+  with tf.io.gfile.GFile(vocab_file, "r") as reader:
+    while True:
+      token = convert_to_unicode(reader.readline())
+      if not token:
+        break
+      tokens.append(token.strip().encode("utf-8"))
+
+  # As with `load_text_vocab`, a duplicated token keeps all of its ids but
+  # looking it up returns the last one.
+  ids_by_token = {}
+  for (index, token) in enumerate(tokens):
+    ids_by_token[token] = index
+
+  offsets = array.array("I", [0])
+  for token in tokens:
+    offsets.append(offsets[-1] + len(token))
+
+  num_buckets = 1
+  while num_buckets < 2 * len(ids_by_token):
+    num_buckets *= 2
+  buckets = array.array("I", [0] * num_buckets)
+  for (token, index) in ids_by_token.items():
+    bucket = zlib.crc32(token) & (num_buckets - 1)
+    while buckets[bucket]:
+      bucket = (bucket + 1) & (num_buckets - 1)
+    buckets[bucket] = index + 1
+
+  if sys.byteorder != "little":
+    offsets.byteswap()
+    buckets.byteswap()
+
+  with tf.io.gfile.GFile(output_file, "wb") as writer:
+    writer.write(
+        _COMPILED_VOCAB_HEADER.pack(_COMPILED_VOCAB_MAGIC,
+                                    _COMPILED_VOCAB_VERSION, len(tokens),
+                                    len(ids_by_token), num_buckets))
+    writer.write(offsets.tobytes())
+    writer.write(buckets.tobytes())
+    writer.write(b"".join(tokens))
+
+
+class CompiledVocab(Mapping):
+  """A read-only token -> id mapping backed by a memory-mapped vocab file.
+
+  The file is mapped rather than read, so opening it is cheap and every
+  process using the same file shares one physical copy of it. The file must
+  be on a local file system.
+  """
+
+  def __init__(self, vocab_file):
+    self.vocab_file = vocab_file
+    with open(vocab_file, "rb") as reader:
+      self._mmap = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, num_ids, num_tokens,
+     num_buckets) = _COMPILED_VOCAB_HEADER.unpack_from(self._mmap, 0)
+    if magic != _COMPILED_VOCAB_MAGIC:
+      raise ValueError("%s is not a compiled vocab file." % vocab_file)
+    if version != _COMPILED_VOCAB_VERSION:
+      raise ValueError("Unsupported compiled vocab version %d in %s." %
+                       (version, vocab_file))
+    self._num_ids = num_ids
+    self._num_tokens = num_tokens
+    self._num_buckets = num_buckets
+
+    offsets_start = _COMPILED_VOCAB_HEADER.size
+    buckets_start = offsets_start + 4 * (num_ids + 1)
+    self._blob_start = buckets_start + 4 * num_buckets
+    view = memoryview(self._mmap)
+    if sys.byteorder == "little":
+      self._offsets = view[offsets_start:buckets_start].cast("I")
+      self._buckets = view[buckets_start:self._blob_start].cast("I")
+    else:
+      self._offsets = array.array("I", view[offsets_start:buckets_start])
+      self._offsets.byteswap()
+      self._buckets = array.array("I", view[buckets_start:self._blob_start])
+      self._buckets.byteswap()
+    self.inverse = _CompiledInverseVocab(self)
+
+  def __getstate__(self):
+    # Processes that unpickle a vocab map the file themselves.
+    return {"vocab_file": self.vocab_file}
+
+  def __setstate__(self, state):
+    self.__init__(state["vocab_file"])
+
+  def __getitem__(self, token):
+    index = self._lookup(convert_to_unicode(token).encode("utf-8"))
+    if index is None:
+      raise KeyError(token)
+    return index
+
+  def __contains__(self, token):
+    if not isinstance(token, (six.text_type, six.binary_type)):
+      return False
+    return self._lookup(convert_to_unicode(token).encode("utf-8")) is not None
+
+  def __len__(self):
+    return self._num_tokens
+
+  def __iter__(self):
+    """Iterates over the tokens in id order, like the `load_vocab` dict."""
+    if self._num_tokens == self._num_ids:
+      for index in range(self._num_ids):
+        yield self.id_to_token(index)
+      return
+    seen = set()
+    for index in range(self._num_ids):
+      token = self.id_to_token(index)
+      if token not in seen:
+        seen.add(token)
+        yield token
+
+  def id_to_token(self, index):
+    """Returns the token with id `index`."""
+    if index < 0 or index >= self._num_ids:
+      raise KeyError(index)
+    start = self._blob_start + self._offsets[index]
+    end = self._blob_start + self._offsets[index + 1]
+    return self._mmap[start:end].decode("utf-8")
+
+  def _lookup(self, key):
+    """Returns the id of the UTF-8 token `key`, or None if it isn't found."""
+    mask = self._num_buckets - 1
+    bucket = zlib.crc32(key) & mask
+    while True:
+      entry = self._buckets[bucket]
+      if not entry:
+        return None
+      start = self._blob_start + self._offsets[entry - 1]
+      end = self._blob_start + self._offsets[entry]
+      if self._mmap[start:end] == key:
+        return entry - 1
+      bucket = (bucket + 1) & mask
+
+
+class _CompiledInverseVocab(object):
+  """The id -> token side of a `CompiledVocab`."""
+
+  def __init__(self, vocab):
+    self._vocab = vocab
+
+  def __getitem__(self, index):
+    return self._vocab.id_to_token(index)
+
+  def __len__(self):
+    return self._vocab._num_ids
+
+
 def convert_by_vocab(vocab, items):
   """Converts a sequence of [tokens|ids] using the vocab."""
   output = []
@@ -161,11 +356,24 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, cache_size=50000):
     self.vocab = load_vocab(vocab_file)
-    self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    if isinstance(self.vocab, CompiledVocab):
+      self.inv_vocab = self.vocab.inverse
+    else:
+      self.inv_vocab = {v: k for k, v in self.vocab.items()}
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    self.wordpiece_tokenizer = WordpieceTokenizer(
+        vocab=self.vocab, cache_size=cache_size)
+    self._pool = None
+    self._pool_size = 0
+
+  def __getstate__(self):
+    # The worker pool can't be pickled, and workers never need their own.
+    state = self.__dict__.copy()
+    state["_pool"] = None
+    state["_pool_size"] = 0
+    return state
 
   def tokenize(self, text):
     split_tokens = []
@@ -175,6 +383,85 @@ class FullTokenizer(object):
 
     return split_tokens
 
+  def encode(self, text):
+    """Tokenizes `text` straight to word piece ids.
+
+    This gives the same ids as `convert_tokens_to_ids(tokenize(text))`
+    without building the word piece strings.
+
+    Returns:
+      An `array.array("i")` of word piece ids.
+    """
+    output_ids = array.array("i")
+    self.wordpiece_tokenizer.encode_words(
+        self.basic_tokenizer.tokenize(text), output_ids)
+    return output_ids
+
+  def tokenize_with_offsets(self, text):
+    """Tokenizes `text` and returns where in `text` each token came from.
+
+    Returns:
+      A tuple `(tokens, offsets)`. `tokens` is the same as `tokenize(text)`,
+      and `offsets[i]` is the `(start, end)` character span of `text` which
+      produced `tokens[i]`. A word which is mapped to the unknown token gets
+      the span of the whole word.
+    """
+    text = convert_to_unicode(text)
+    tokens = []
+    offsets = []
+    for (token, char_spans) in (
+        self.basic_tokenizer.tokenize_with_char_spans(text)):
+      pieces = self.wordpiece_tokenizer._word_pieces(token)
+      if pieces is None:
+        tokens.append(self.wordpiece_tokenizer.unk_token)
+        offsets.append((char_spans[0][0], char_spans[-1][1]))
+        continue
+
+      start = 0
+      for (i, piece) in enumerate(pieces[0]):
+        # Every piece but the first one has a "##" prefix.
+        end = start + len(piece) - (2 if i > 0 else 0)
+        tokens.append(piece)
+        offsets.append((char_spans[start][0], char_spans[end - 1][1]))
+        start = end
+    return (tokens, offsets)
+
+  def tokenize_batch(self, texts, num_workers=1, chunksize=64):
+    """Tokenizes a list of texts, optionally across a process pool.
+
+    The pool is created on first use and kept for later calls with the same
+    `num_workers`. Each worker receives a copy of this tokenizer once, when
+    it starts, so the vocab is not re-sent with every batch.
+
+    Args:
+      texts: A list of strings.
+      num_workers: Number of worker processes. With 1 (or fewer) the texts
+        are tokenized in the calling process.
+      chunksize: Number of texts sent to a worker per task.
+
+    Returns:
+      A list with the output of `tokenize` for each text, in input order.
+    """
+    if num_workers <= 1 or len(texts) <= chunksize:
+      return [self.tokenize(text) for text in texts]
+
+    if self._pool is None or self._pool_size != num_workers:
+      self.close_pool()
+      self._pool = multiprocessing.Pool(
+          processes=num_workers,
+          initializer=_init_tokenize_worker,
+          initargs=(self,))
+      self._pool_size = num_workers
+    return list(self._pool.imap(_tokenize_in_worker, texts, chunksize))
+
+  def close_pool(self):
+    """Shuts down the worker pool started by `tokenize_batch`, if any."""
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+      self._pool_size = 0
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -182,6 +469,42 @@ class FullTokenizer(object):
     return convert_by_vocab(self.inv_vocab, ids)
 
 
+# Deletes the ASCII characters which `_is_control` treats as control.
+_ASCII_CONTROL_TABLE = dict(
+    (cp, None) for cp in list(range(0, 32)) + [127] if chr(cp) not in "\t\n\r")
+
+# Matches the tokens of cleaned ASCII text. `_is_punctuation` is true for
+# every printable ASCII character which isn't a letter or digit.
+_ASCII_TOKEN_RE = re.compile(r"[0-9A-Za-z]+|[^0-9A-Za-z \t\n\r]")
+
+# Character classes used by `BasicTokenizer.tokenize`.
+_CHAR_WORD = 0
+_CHAR_PUNCTUATION = 1
+_CHAR_WHITESPACE = 2
+_CHAR_CHINESE = 3
+_CHAR_REMOVED = 4
+_CHAR_EMPTY = 5
+_CHAR_IRREGULAR = 6
+
+# Maps each character seen so far to its `(class, normalized form)`, one table
+# for cased and one for uncased tokenization. Entries are filled in by
+# `BasicTokenizer._classify_char`, so the `unicodedata` lookups happen at most
+# once per code point.
+_CHAR_TABLES = {True: {}, False: {}}
+
+# The tokenizer owned by a `tokenize_batch` worker process.
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+  global _worker_tokenizer
+  _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(text):
+  return _worker_tokenizer.tokenize(text)
+
+
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
@@ -196,27 +519,180 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
-    text = self._clean_text(text)
+    if _is_ascii(text):
+      return self._tokenize_ascii(text)
+    return self._tokenize_unicode(text)
 
-    # This was added on November 1st, 2018 for the multilingual and Chinese
-    # models. This is also applied to the English models now, but it doesn't
-    # matter since the English models were not trained on any Chinese data
-    # and generally don't have any Chinese data in them (there are Chinese
-    # characters in the vocabulary because Wikipedia does have some Chinese
-    # words in the English Wikipedia.).
-    text = self._tokenize_chinese_chars(text)
+  def _tokenize_ascii(self, text):
+    """Tokenizes text which only contains ASCII characters.
 
-    orig_tokens = whitespace_tokenize(text)
-    split_tokens = []
-    for token in orig_tokens:
-      if self.do_lower_case:
-        token = token.lower()
-        token = self._run_strip_accents(token)
-      split_tokens.extend(self._run_split_on_punc(token))
+    For ASCII, cleaning only removes control characters, lower casing is
+    `str.lower` and there are no accents or Chinese characters, so every
+    output token is either a run of letters and digits or a single
+    punctuation character.
+    """
+    text = text.translate(_ASCII_CONTROL_TABLE)
+    if self.do_lower_case:
+      text = text.lower()
+    return _ASCII_TOKEN_RE.findall(text)
+
+  def _tokenize_unicode(self, text, output_spans=None):
+    """Tokenizes text which may contain any Unicode characters.
 
-    output_tokens = whitespace_tokenize(" ".join(split_tokens))
+    Args:
+      text: The text to tokenize.
+      output_spans: Optional list. If given, the char spans of each output
+        token, as described in `tokenize_with_char_spans`, are appended to it.
+
+    Returns:
+      A list of tokens.
+    """
+    # This is a single pass over `text` which is equivalent to running
+    # `_clean_text`, `_tokenize_chinese_chars` and `whitespace_tokenize`, and
+    # then lower casing, stripping accents and splitting punctuation on each
+    # whitespace token. Every character is classified once through
+    # `_CHAR_TABLES`, which also holds its lower cased, accent stripped form.
+    #
+    # Lower casing and accent stripping are not always character-local (e.g.
+    # the Greek final sigma, or combining marks that canonical ordering would
+    # move), so whitespace tokens containing such characters are re-done with
+    # the per-token functions.
+    #
+    # The Chinese character handling was added on November 1st, 2018 for the
+    # multilingual and Chinese models. This is also applied to the English
+    # models now, but it doesn't matter since the English models were not
+    # trained on any Chinese data and generally don't have any Chinese data in
+    # them (there are Chinese characters in the vocabulary because Wikipedia
+    # does have some Chinese words in the English Wikipedia.).
+    char_table = _CHAR_TABLES[bool(self.do_lower_case)]
+    with_spans = output_spans is not None
+    output_tokens = []
+    word = []
+    word_spans = []
+    token_start = 0
+    token_output_start = 0
+    token_is_irregular = False
+    for (i, char) in enumerate(text):
+      entry = char_table.get(char)
+      if entry is None:
+        entry = self._classify_char(char)
+        char_table[char] = entry
+      (char_class, normalized) = entry
+
+      if char_class == _CHAR_WORD:
+        word.append(normalized)
+        if with_spans:
+          word_spans.extend([(i, i + 1)] * len(normalized))
+        continue
+      if char_class == _CHAR_EMPTY or char_class == _CHAR_REMOVED:
+        continue
+
+      if word:
+        output_tokens.append("".join(word))
+        word = []
+        if with_spans:
+          output_spans.append(word_spans)
+          word_spans = []
+      if char_class == _CHAR_PUNCTUATION:
+        output_tokens.append(normalized)
+        if with_spans:
+          output_spans.append([(i, i + 1)])
+      elif char_class == _CHAR_IRREGULAR:
+        token_is_irregular = True
+      else:
+        # Whitespace and Chinese characters end the whitespace token.
+        if token_is_irregular:
+          self._replace_irregular(text, token_start, i, char_table,
+                                  token_output_start, output_tokens,
+                                  output_spans)
+          token_is_irregular = False
+        if char_class == _CHAR_CHINESE:
+          output_tokens.append(normalized)
+          if with_spans:
+            output_spans.append([(i, i + 1)] * len(normalized))
+        token_start = i + 1
+        token_output_start = len(output_tokens)
+
+    if word:
+      output_tokens.append("".join(word))
+      if with_spans:
+        output_spans.append(word_spans)
+    if token_is_irregular:
+      self._replace_irregular(text, token_start, len(text), char_table,
+                              token_output_start, output_tokens, output_spans)
     return output_tokens
 
+  def tokenize_with_char_spans(self, text):
+    """Like `tokenize`, but also returns where each character came from.
+
+    Returns:
+      A list of `(token, char_spans)` pairs, with the tokens `tokenize` would
+      return. `char_spans[k]` is the `(start, end)` span of `text` which
+      produced `token[k]`. For the rare tokens whose characters can't be
+      traced back individually, this is the span of the whole whitespace
+      token they came from.
+    """
+    text = convert_to_unicode(text)
+    char_spans = []
+    tokens = self._tokenize_unicode(text, char_spans)
+    return list(zip(tokens, char_spans))
+
+  def _replace_irregular(self, text, start, end, char_table, output_start,
+                         output_tokens, output_spans):
+    """Re-does the output from `output_start` on for `text[start:end]`."""
+    tokens = self._tokenize_irregular(text[start:end], char_table)
+    del output_tokens[output_start:]
+    output_tokens.extend(tokens)
+    if output_spans is not None:
+      del output_spans[output_start:]
+      output_spans.extend([[(start, end)] * len(token) for token in tokens])
+
+  def _classify_char(self, char):
+    """Returns the `_CHAR_TABLES` entry for `char`."""
+    cp = ord(char)
+    if cp == 0 or cp == 0xfffd or _is_control(char):
+      return (_CHAR_REMOVED, "")
+    # `whitespace_tokenize` also splits on characters such as U+2028 which
+    # `_is_whitespace` doesn't consider whitespace.
+    if _is_whitespace(char) or char.isspace():
+      return (_CHAR_WHITESPACE, " ")
+
+    normalized = char
+    if self.do_lower_case:
+      normalized = self._run_strip_accents(char.lower())
+    if self._is_chinese_char(cp):
+      return (_CHAR_CHINESE, normalized)
+
+    if self.do_lower_case:
+      if char == u"\u03a3":
+        # Capital sigma lower cases differently at the end of a word.
+        return (_CHAR_IRREGULAR, "")
+      for c in normalized:
+        # A surviving combining character may be reordered relative to its
+        # neighbours by NFD, and whitespace would change the token boundaries.
+        if unicodedata.combining(c) or c.isspace():
+          return (_CHAR_IRREGULAR, "")
+
+    if not normalized:
+      return (_CHAR_EMPTY, "")
+    if len(normalized) == 1:
+      if _is_punctuation(normalized):
+        return (_CHAR_PUNCTUATION, normalized)
+      return (_CHAR_WORD, normalized)
+    for c in normalized:
+      if _is_punctuation(c):
+        return (_CHAR_IRREGULAR, "")
+    return (_CHAR_WORD, normalized)
+
+  def _tokenize_irregular(self, token, char_table):
+    """Runs the per-token steps of the tokenizer on one whitespace token."""
+    token = "".join(
+        [c for c in token if char_table[c][0] != _CHAR_REMOVED])
+    if self.do_lower_case:
+      token = token.lower()
+      token = self._run_strip_accents(token)
+    return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
+
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
@@ -300,10 +776,34 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
-  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+               cache_size=0):
+    """Constructs a WordpieceTokenizer.
+
+    Args:
+      vocab: A dict mapping vocab tokens to ids.
+      unk_token: Token emitted for words that can't be segmented.
+      max_input_chars_per_word: Longer words are mapped to `unk_token`.
+      cache_size: Maximum number of words whose word pieces are remembered.
+        Least recently used words are evicted first. 0 disables the cache.
+    """
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    self.cache_size = cache_size
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self._cache = collections.OrderedDict()
+    (self.prefix_trie, self.suffix_trie) = build_wordpiece_tries(vocab)
+
+  def __getstate__(self):
+    # Each process (e.g. a `tokenize_batch` worker) starts with its own empty
+    # cache rather than a copy of this one.
+    state = self.__dict__.copy()
+    state["cache_hits"] = 0
+    state["cache_misses"] = 0
+    state["_cache"] = collections.OrderedDict()
+    return state
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -327,36 +827,138 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
+      pieces = self._word_pieces(token)
+      if pieces is None:
         output_tokens.append(self.unk_token)
-        continue
+      else:
+        output_tokens.extend(pieces[0])
+    return output_tokens
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
+  def encode(self, text):
+    """Like `tokenize`, but returns the ids of the word pieces.
 
-      if is_bad:
-        output_tokens.append(self.unk_token)
+    The ids are read straight from the vocab tries, so the word piece strings
+    are never built.
+
+    Args:
+      text: A single token or whitespace separated tokens. This should have
+        already been passed through `BasicTokenizer.
+
+    Returns:
+      An `array.array("i")` of word piece ids.
+    """
+    output_ids = array.array("i")
+    self.encode_words(whitespace_tokenize(convert_to_unicode(text)),
+                      output_ids)
+    return output_ids
+
+  def encode_words(self, words, output_ids):
+    """Appends the word piece ids of each word in `words` to `output_ids`."""
+    for word in words:
+      pieces = self._word_pieces(word)
+      if pieces is None:
+        output_ids.append(self.vocab[self.unk_token])
       else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+        output_ids.extend(pieces[1])
+
+  def _word_pieces(self, word):
+    """Returns `(tokens, ids)` lists for the pieces of `word`, or None."""
+    if len(word) > self.max_input_chars_per_word:
+      return None
+    if self.cache_size <= 0:
+      return self._split_word(word)
+
+    cache = self._cache
+    if word in cache:
+      self.cache_hits += 1
+      # Re-inserting marks the word as the most recently used.
+      pieces = cache.pop(word)
+      cache[word] = pieces
+      return pieces
+
+    self.cache_misses += 1
+    pieces = self._split_word(word)
+    if len(cache) >= self.cache_size:
+      cache.popitem(last=False)
+    cache[word] = pieces
+    return pieces
+
+  def _split_word(self, word):
+    """Splits a single word into word pieces, or returns None if it can't."""
+    sub_tokens = []
+    sub_ids = []
+    trie = self.prefix_trie
+    start = 0
+    while start < len(word):
+      # Walk the trie as far as the word allows, remembering the last node
+      # that completes a vocab entry. This is the same longest match the
+      # shrinking-substring search finds, but in a single forward scan.
+      node = trie
+      cur_piece = None
+      end = start
+      for i in range(start, len(word)):
+        node = node.get(word[i])
+        if node is None:
+          break
+        if _TRIE_PIECE in node:
+          cur_piece = node[_TRIE_PIECE]
+          end = i + 1
+      if cur_piece is None:
+        return None
+      sub_tokens.append(cur_piece[0])
+      sub_ids.append(cur_piece[1])
+      start = end
+      trie = self.suffix_trie
+    return (sub_tokens, sub_ids)
+
+
+# Key under which a trie node stores the `(token, id)` of the vocab entry it
+# completes. Characters are never empty strings, so this can't collide with a
+# child edge.
+_TRIE_PIECE = ""
+
+
+def build_wordpiece_tries(vocab):
+  """Builds the prefix tries used by `WordpieceTokenizer`.
+
+  Args:
+    vocab: A dict mapping vocab tokens to ids (e.g. from `load_vocab`).
+
+  Returns:
+    A tuple `(prefix_trie, suffix_trie)` of nested dicts keyed by character.
+    `prefix_trie` holds every token and is used to match the start of a word.
+    `suffix_trie` holds the "##" continuation tokens with the "##" stripped
+    and is used for every piece after the first. A node that completes a
+    token stores its `(token, id)` under `_TRIE_PIECE`.
+  """
+  prefix_trie = {}
+  suffix_trie = {}
+  for (token, index) in vocab.items():
+    piece = (token, index)
+    _insert_into_trie(prefix_trie, token, piece)
+    if token.startswith("##"):
+      _insert_into_trie(suffix_trie, token[2:], piece)
+  return (prefix_trie, suffix_trie)
+
+
+def _insert_into_trie(trie, key, piece):
+  """Adds `key` to `trie`, marking its final node with `piece`."""
+  # The greedy search never matches an empty piece, so neither do we.
+  if not key:
+    return
+  node = trie
+  for char in key:
+    node = node.setdefault(char, {})
+  node[_TRIE_PIECE] = piece
+
+
+def _is_ascii(text):
+  """Checks whether `text` only contains ASCII characters."""
+  try:
+    return text.isascii()
+  except AttributeError:
+    # `isascii` was added in Python 3.7.
+    return all(ord(char) < 128 for char in text)
 
 
 def _is_whitespace(char):
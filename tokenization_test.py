@@ -18,6 +18,7 @@ from __future__ import print_function
 
 import os
 import tempfile
+import time
 import tokenization
 import six
 import tensorflow as tf
@@ -48,6 +49,109 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+    self.assertAllEqual(
+        tokenizer.encode(u"UNwant\u00E9d,running wantedX"),
+        [7, 4, 5, 10, 8, 9, 0])
+
+  def test_tokenize_with_offsets(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      if six.PY2:
+        vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+      else:
+        vocab_writer.write("".join(
+            [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    text = u" UNwantéd,\trunning  Foo"
+    (tokens, offsets) = tokenizer.tokenize_with_offsets(text)
+    self.assertAllEqual(tokens, tokenizer.tokenize(text))
+    self.assertAllEqual(
+        [text[start:end] for (start, end) in offsets],
+        ["UN", "want", u"éd", ",", "runn", "ing", "Foo"])
+
+  def test_compiled_vocab(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ",", u"\u535A"
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write("".join(
+          [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+    compiled_vocab_file = vocab_file + ".bin"
+    tokenization.write_compiled_vocab(vocab_file, compiled_vocab_file)
+
+    self.assertFalse(tokenization.is_compiled_vocab(vocab_file))
+    self.assertTrue(tokenization.is_compiled_vocab(compiled_vocab_file))
+
+    text_tokenizer = tokenization.FullTokenizer(vocab_file)
+    tokenizer = tokenization.FullTokenizer(compiled_vocab_file)
+    os.unlink(vocab_file)
+
+    self.assertIsInstance(tokenizer.vocab, tokenization.CompiledVocab)
+    self.assertEqual(len(tokenizer.vocab), len(vocab_tokens))
+    self.assertEqual(list(tokenizer.vocab.keys()), vocab_tokens)
+    self.assertEqual(dict(tokenizer.vocab), dict(text_tokenizer.vocab))
+    self.assertNotIn("wanted", tokenizer.vocab)
+
+    tokens = tokenizer.tokenize(u"UNwant\u00E9d,running \u535A")
+    self.assertAllEqual(
+        tokens, ["un", "##want", "##ed", ",", "runn", "##ing", u"\u535A"])
+    ids = tokenizer.convert_tokens_to_ids(tokens)
+    self.assertAllEqual(ids, [7, 4, 5, 10, 8, 9, 11])
+    self.assertAllEqual(tokenizer.convert_ids_to_tokens(ids), tokens)
+
+    os.unlink(compiled_vocab_file)
+
+  def test_tokenize_batch(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      if six.PY2:
+        vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+      else:
+        vocab_writer.write("".join(
+            [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    texts = [u"UNwant\u00E9d,running", u"", u"wa runn", u"unwantedX"] * 10
+    expected = [tokenizer.tokenize(text) for text in texts]
+
+    self.assertAllEqual(tokenizer.tokenize_batch(texts), expected)
+    self.assertAllEqual(
+        tokenizer.tokenize_batch(texts, num_workers=2, chunksize=3), expected)
+    tokenizer.close_pool()
+
+  def test_basic_tokenizer_ascii(self):
+    texts = [
+        u" \tHeLLo!how  \n Are yoU?  ",
+        u"a\x00b\x05c\x7fd\x0be\x1cf",
+        u"$5.00 (approx.) -- `quoted' ^_^ {x|y}~",
+        u"",
+    ]
+
+    for do_lower_case in [True, False]:
+      tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+      for text in texts:
+        self.assertEqual(
+            tokenizer._tokenize_ascii(text),
+            tokenizer._tokenize_unicode(text))
+
   def test_chinese(self):
     tokenizer = tokenization.BasicTokenizer()
 
@@ -70,6 +174,32 @@ class TokenizationTest(tf.test.TestCase):
         tokenizer.tokenize(u" \tHeLLo!how  \n Are yoU?  "),
         ["HeLLo", "!", "how", "Are", "yoU", "?"])
 
+  def test_basic_tokenizer_matches_multi_pass(self):
+    sample_file = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "sample_text.txt")
+    with open(sample_file, "rb") as reader:
+      texts = [tokenization.convert_to_unicode(line) for line in reader]
+    texts.extend([
+        u"UNwant\u00E9d,running",
+        u" \tHeLLo!how  \n Are yoU?  ",
+        u"H\u00E9llo",
+        u"ah\u535A\u63A8zz",
+        u"\u039F\u0394\u039F\u03A3. \u03A3\u0391 \u03A3",
+        u"\u0130stanbul",
+        u"\uF900\u00C5ngstr\u00F6m\u2028x\u00A0y",
+        u"a\u0000b\uFFFDc\u0005d\u200Be",
+        u"\u1FEFx\u0301\u0345y",
+        u"\u0928\u092E\u0938\u094D\u0924\u0947",
+        u"\u0645\u0631\u062D\u0628\u0627",
+    ])
+
+    for do_lower_case in [True, False]:
+      tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+      for text in texts:
+        self.assertEqual(
+            tokenizer.tokenize(text),
+            _multi_pass_basic_tokenize(tokenizer, text))
+
   def test_wordpiece_tokenizer(self):
     vocab_tokens = [
         "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
@@ -90,6 +220,55 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+  def test_wordpiece_tokenizer_longest_match(self):
+    vocab_tokens = [
+        "[UNK]", "un", "una", "unaff", "##a", "##aff", "##affa", "##able",
+        "##b", "##le"
+    ]
+
+    vocab = {}
+    for (i, token) in enumerate(vocab_tokens):
+      vocab[token] = i
+    tokenizer = tokenization.WordpieceTokenizer(vocab=vocab)
+
+    self.assertAllEqual(
+        tokenizer.tokenize("unaffable"), ["unaff", "##able"])
+    self.assertAllEqual(
+        tokenizer.tokenize("unaffab unab"), ["unaff", "##a", "##b", "una",
+                                             "##b"])
+    self.assertAllEqual(tokenizer.tokenize("unaffabc"), ["[UNK]"])
+
+  def test_wordpiece_tokenizer_cache(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing"
+    ]
+
+    vocab = {}
+    for (i, token) in enumerate(vocab_tokens):
+      vocab[token] = i
+    tokenizer = tokenization.WordpieceTokenizer(vocab=vocab, cache_size=2)
+
+    self.assertAllEqual(
+        tokenizer.tokenize("unwanted running unwanted"),
+        ["un", "##want", "##ed", "runn", "##ing", "un", "##want", "##ed"])
+    self.assertEqual(tokenizer.cache_hits, 1)
+    self.assertEqual(tokenizer.cache_misses, 2)
+
+    # "running" is the least recently used word, so "unwantedX" evicts it.
+    self.assertAllEqual(
+        tokenizer.tokenize("unwantedX unwantedX running"),
+        ["[UNK]", "[UNK]", "runn", "##ing"])
+    self.assertEqual(tokenizer.cache_hits, 2)
+    self.assertEqual(tokenizer.cache_misses, 4)
+
+    tokenizer = tokenization.WordpieceTokenizer(vocab=vocab, cache_size=0)
+    self.assertAllEqual(
+        tokenizer.tokenize("unwanted unwanted"),
+        ["un", "##want", "##ed", "un", "##want", "##ed"])
+    self.assertEqual(tokenizer.cache_hits, 0)
+    self.assertEqual(tokenizer.cache_misses, 0)
+
   def test_convert_tokens_to_ids(self):
     vocab_tokens = [
         "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
@@ -133,5 +312,50 @@ class TokenizationTest(tf.test.TestCase):
     self.assertFalse(tokenization._is_punctuation(u" "))
 
 
+class TokenizationBenchmark(tf.test.Benchmark):
+
+  def _run_benchmark(self, name, tokenize_fn, texts, iters=20):
+    start = time.time()
+    for _ in range(iters):
+      for text in texts:
+        tokenize_fn(text)
+    wall_time = (time.time() - start) / iters
+    self.report_benchmark(
+        iters=iters,
+        wall_time=wall_time,
+        name=name,
+        extras={"texts_per_sec": len(texts) / wall_time})
+
+  def benchmark_basic_tokenizer_ascii(self):
+    sample_file = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "sample_text.txt")
+    with open(sample_file, "rb") as reader:
+      texts = [tokenization.convert_to_unicode(line) for line in reader]
+    texts = [text for text in texts if tokenization._is_ascii(text)]
+
+    tokenizer = tokenization.BasicTokenizer(do_lower_case=True)
+    self._run_benchmark("basic_tokenizer_ascii_fast_path",
+                        tokenizer.tokenize, texts)
+    self._run_benchmark("basic_tokenizer_unicode_path",
+                        tokenizer._tokenize_unicode, texts)
+    self._run_benchmark(
+        "basic_tokenizer_multi_pass",
+        lambda text: _multi_pass_basic_tokenize(tokenizer, text), texts)
+
+
+def _multi_pass_basic_tokenize(tokenizer, text):
+  """The original, one step at a time, `BasicTokenizer.tokenize`."""
+  text = tokenization.convert_to_unicode(text)
+  text = tokenizer._clean_text(text)
+  text = tokenizer._tokenize_chinese_chars(text)
+  split_tokens = []
+  for token in tokenization.whitespace_tokenize(text):
+    if tokenizer.do_lower_case:
+      token = token.lower()
+      token = tokenizer._run_strip_accents(token)
+    split_tokens.extend(tokenizer._run_split_on_punc(token))
+  return tokenization.whitespace_tokenize(" ".join(split_tokens))
+
+
 if __name__ == "__main__":
   tf.test.main()